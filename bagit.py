@@ -1,23 +1,54 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+from contextlib import ExitStack
+from importlib import import_module
 
-from bagit_modules.bag import Bag
-from bagit_modules.bagging import make_bag
 from bagit_modules.docs import read_global_docs
 from bagit_modules.errors import BagError
-from bagit_modules.logging import LOGGER, configure_logging
-from bagit_modules.parsing import make_parser
 from bagit_modules.translation_catalog import _
 from bagit_modules.versioning import get_version
 
-version = get_version()
-
 __doc__ = read_global_docs()
 
+#: Names only imported when first used: most programs using bagit as a
+#: library, and many command lines, never need some of them, and worker
+#: processes started with spawn import this script again when it is run
+_LAZY_NAMES = {
+    "Bag": "bagit_modules.bag",
+    "make_bag": "bagit_modules.bagging",
+    "LOGGER": "bagit_modules.logging",
+    "configure_logging": "bagit_modules.logging",
+    "ArchivedBag": "bagit_modules.archive",
+    "archive_format": "bagit_modules.archive",
+    "make_bag_archive": "bagit_modules.writer",
+    "make_parser": "bagit_modules.parsing",
+    "Throttle": "bagit_modules.throttle",
+}
+
+
+def __getattr__(name):
+    if name in ("version", "VERSION"):
+        return get_version()
+    if name in _LAZY_NAMES:
+        return getattr(import_module(_LAZY_NAMES[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 def main():
+    from bagit_modules.archive import ArchivedBag, archive_format
+    from bagit_modules.bag import Bag
+    from bagit_modules.bagging import make_bag
+    from bagit_modules.logging import LOGGER, configure_logging
+    from bagit_modules.events import recording_events
+    from bagit_modules.metrics import MetricsFile
+    from bagit_modules.profiling import Profiler, profiling
+    from bagit_modules.parsing import make_parser
+    from bagit_modules.throttle import Throttle, lower_priority
+    from bagit_modules.writer import make_bag_archive
+
     # Command line argument parsing
     parser = make_parser()
     args = parser.parse_args()
@@ -26,30 +57,108 @@ def main():
 
     # Version check
     if "--version" in sys.argv:
-        print(_("bagit-python version %s") % version)
+        print(_("bagit-python version %s") % get_version())
         sys.exit(0)
 
     # Argument validations
-    if args.processes <= 0:
+    if args.processes != "auto" and args.processes <= 0:
         parser.error(_("The number of processes must be greater than 0"))
 
+    if args.device_processes is not None and args.device_processes <= 0:
+        parser.error(_("The number of processes per device must be greater than 0"))
+
     if args.fast and not args.validate:
         parser.error(_("--fast is only allowed as an option for --validate!"))
 
     if args.completeness_only and not args.validate:
         parser.error(_("--completeness-only is only allowed as an option for --validate!"))
 
+    if args.algorithms and not args.validate:
+        parser.error(_("--algorithms is only allowed as an option for --validate!"))
+
+    if args.destination and args.validate:
+        parser.error(_("--destination is only allowed when creating a bag!"))
+
+    if args.destination and len(args.directory) > 1:
+        parser.error(_("--destination requires a single source directory!"))
+
+    if args.archive and (args.validate or args.destination or len(args.directory) > 1):
+        parser.error(_("--archive requires creating a bag from a single source directory!"))
+
+    # --profile-mode implies --profile:
+    profile_mode = args.profile_mode or ("phases" if args.profile else None)
+
+    if args.archive:
+        # Archives are written by a single serial pass over the source:
+        ignored = [
+            option
+            for option, used in (
+                ("--processes", args.processes != 1),
+                ("--device-processes", args.device_processes is not None),
+                ("--start-method", args.start_method is not None),
+                ("--pipeline", args.pipeline),
+                ("--cache", args.cache != "normal"),
+                ("--order", args.order != "path"),
+                ("--max-bytes-per-second", args.max_bytes_per_second),
+                ("--max-files-per-second", args.max_files_per_second),
+                ("--metrics", args.metrics),
+                ("--profile", profile_mode),
+                ("--events", args.events),
+            )
+            if used
+        ]
+        if ignored:
+            parser.error(_("--archive cannot be combined with %s") % ", ".join(ignored))
+
+    if args.nice or args.ionice:
+        # This process only exists to do the work, so it lowers its own
+        # priority, which every worker inherits, even if it reads the files
+        # itself:
+        lower_priority(args.nice, args.ionice)
+
+    throttle = None
+    if args.max_bytes_per_second or args.max_files_per_second:
+        try:
+            throttle = Throttle(
+                bytes_per_second=args.max_bytes_per_second,
+                files_per_second=args.max_files_per_second,
+            )
+        except ValueError as e:
+            parser.error(str(e))
+
+    metrics = MetricsFile(args.metrics) if args.metrics else None
+
+    # A single stream records the events of every bag:
+    open_files = ExitStack()
+    events = open_files.enter_context(recording_events(args.events))
+
     error_occurred = False
 
     if args.validate:
         for bag_dir in args.directory:
+            # Opening the bag parses the manifests, which is profiled too:
+            profiler = Profiler(profile_mode) if profile_mode else None
             try:
-                bag = Bag(bag_dir)
-                bag.validate(
-                    processes=args.processes,
-                    fast=args.fast,
-                    completeness_only=args.completeness_only,
-                )
+                with profiling(profiler, bag_dir):
+                    if os.path.isfile(bag_dir) and archive_format(bag_dir):
+                        bag = ArchivedBag(bag_dir, algorithms=args.checksums)
+                    else:
+                        bag = Bag(bag_dir)
+                    bag.validate(
+                        processes=args.processes,
+                        fast=args.fast,
+                        completeness_only=args.completeness_only,
+                        pipeline=args.pipeline,
+                        algorithms=args.algorithms or "all",
+                        cache=args.cache,
+                        throttle=throttle,
+                        order=args.order,
+                        device_processes=args.device_processes,
+                        start_method=args.start_method,
+                        metrics=metrics,
+                        profile=profiler,
+                        events=events,
+                    )
                 if args.fast:
                     LOGGER.info(_("%s valid according to Payload-Oxum"), bag_dir)
                 elif args.completeness_only:
@@ -62,14 +171,41 @@ def main():
                 )
                 error_occurred = True
 
+    elif args.archive:
+        try:
+            make_bag_archive(
+                args.directory[0],
+                args.archive,
+                bag_info=args.bag_info,
+                checksums=args.checksums,
+            )
+        except Exception as exc:
+            LOGGER.error(
+                _("Failed to create bag archive %(archive)s: %(error)s"),
+                {"archive": args.archive, "error": exc},
+                exc_info=True,
+            )
+            error_occurred = True
+
     else:
         for bag_dir in args.directory:
+            profiler = Profiler(profile_mode) if profile_mode else None
             try:
                 make_bag(
                     bag_dir,
                     bag_info=args.bag_info,
                     processes=args.processes,
                     checksums=args.checksums,
+                    pipeline=args.pipeline,
+                    dest=args.destination,
+                    cache=args.cache,
+                    throttle=throttle,
+                    order=args.order,
+                    device_processes=args.device_processes,
+                    start_method=args.start_method,
+                    metrics=metrics,
+                    profile=profiler,
+                    events=events,
                 )
             except Exception as exc:
                 LOGGER.error(
@@ -79,6 +215,7 @@ def main():
                 )
                 error_occurred = True
 
+    open_files.close()
     sys.exit(1 if error_occurred else 0)
 
 
@@ -0,0 +1,599 @@
+"""
+Serialized bags.
+
+ArchiveWriter appends the members of a bag to a tar (optionally compressed)
+or zip archive, hashing payload files as they are appended; BagWriter uses it
+to write bags straight into archives without assembling them on disk.
+
+Serialized bags can also be validated in place by ArchivedBag, which reads
+the members straight from the archive without writing anything to disk.
+"""
+
+import codecs
+import io
+import itertools
+import os
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from os.path import isfile
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.bag import Bag
+from bagit_modules.concurrency import map_with_workers
+from bagit_modules.constants import HASH_BLOCK_SIZE
+from bagit_modules.errors import BagError, BagValidationError
+from bagit_modules.hashing import get_hashers, hash_bytes, hash_stream
+from bagit_modules.logging import LOGGER, file_log_level
+from bagit_modules.progress import as_progress
+from bagit_modules.string_ops import force_unicode, normalize_unicode
+
+#: PAX global header recording the manifest algorithms of a tar archive, so a
+#: streaming reader knows how to hash the payload before reaching the manifests
+PAX_ALGORITHMS_HEADER = "BAGIT.manifest-algorithms"
+
+#: Tar members of unknown size are buffered in memory up to this many bytes
+TAR_SPOOL_SIZE = 64 * 1024 * 1024
+
+#: Archive formats keyed by file name suffix, most specific first
+ARCHIVE_FORMATS = [
+    (".tar.gz", "tar.gz"),
+    (".tgz", "tar.gz"),
+    (".tar.bz2", "tar.bz2"),
+    (".tbz2", "tar.bz2"),
+    (".tar.xz", "tar.xz"),
+    (".txz", "tar.xz"),
+    (".tar", "tar"),
+    (".zip", "zip"),
+]
+
+
+def archive_format(filename):
+    """Returns the archive format implied by a file name, or None"""
+    lower = filename.lower()
+    for suffix, fmt in ARCHIVE_FORMATS:
+        if lower.endswith(suffix):
+            return fmt
+    return None
+
+
+def archive_bag_name(filename):
+    """Returns the name of the bag directory inside an archive called filename"""
+    name = os.path.basename(filename)
+    lower = name.lower()
+    for suffix, _fmt in ARCHIVE_FORMATS:
+        if lower.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+class ArchiveWriter(object):
+    """
+    Appends members to a tar or zip archive, which may be a path or a
+    writable binary file object. Tar archives written to a file object use
+    the streaming mode so that pipes and sockets work as targets.
+    """
+
+    def __init__(self, target, fmt, algorithms=None):
+        self.format = fmt
+
+        if fmt == "zip":
+            self.archive = zipfile.ZipFile(
+                target, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+            )
+        elif fmt in ("tar", "tar.gz", "tar.bz2", "tar.xz"):
+            compression = fmt[4:]
+            options = {"format": tarfile.PAX_FORMAT}
+            if algorithms:
+                options["pax_headers"] = {PAX_ALGORITHMS_HEADER: ",".join(algorithms)}
+            if isinstance(target, str):
+                self.archive = tarfile.open(target, mode="w:" + compression, **options)
+            else:
+                self.archive = tarfile.open(fileobj=target, mode="w|" + compression, **options)
+        else:
+            raise BagError(_("Unsupported archive format: %s") % fmt)
+
+    def add_directory(self, arcname, mtime=None, mode=0o755):
+        mtime = time.time() if mtime is None else mtime
+        if self.format == "zip":
+            info = zipfile.ZipInfo(arcname.rstrip("/") + "/", date_time=_zip_date_time(mtime))
+            info.external_attr = (stat.S_IFDIR | mode) << 16 | 0x10
+            self.archive.writestr(info, b"")
+        else:
+            info = tarfile.TarInfo(arcname.rstrip("/"))
+            info.type = tarfile.DIRTYPE
+            info.mtime = mtime
+            info.mode = mode
+            self.archive.addfile(info)
+
+    def add_bytes(self, arcname, data, mtime=None, mode=0o644):
+        mtime = time.time() if mtime is None else mtime
+        if self.format == "zip":
+            info = zipfile.ZipInfo(arcname, date_time=_zip_date_time(mtime))
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.compress_type = self.archive.compression
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.size = len(data)
+            info.mtime = mtime
+            info.mode = mode
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def add_stream(self, arcname, fileobj, size, algorithms, mtime=None, mode=0o644):
+        """
+        Appends size bytes read from fileobj, hashing them on the way.
+        Returns ({algorithm: hexdigest}, byte count).
+
+        If size is None fileobj is read to the end. Tar headers must record
+        the size before the data, so in that case the data is spooled to a
+        temporary file once it exceeds TAR_SPOOL_SIZE bytes.
+        """
+        mtime = time.time() if mtime is None else mtime
+        reader = _HashingReader(fileobj, algorithms)
+
+        if self.format == "zip":
+            info = zipfile.ZipInfo(arcname, date_time=_zip_date_time(mtime))
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.compress_type = self.archive.compression
+            info.file_size = size or 0
+            force_zip64 = size is None or size > zipfile.ZIP64_LIMIT
+            with self.archive.open(info, mode="w", force_zip64=force_zip64) as member:
+                for block in iter(lambda: reader.read(HASH_BLOCK_SIZE), b""):
+                    member.write(block)
+        elif size is None:
+            with tempfile.SpooledTemporaryFile(max_size=TAR_SPOOL_SIZE) as spool:
+                for block in iter(lambda: reader.read(HASH_BLOCK_SIZE), b""):
+                    spool.write(block)
+                info = tarfile.TarInfo(arcname)
+                info.size = spool.tell()
+                info.mtime = mtime
+                info.mode = mode
+                spool.seek(0)
+                self.archive.addfile(info, spool)
+            return reader.hexdigests(), reader.total_bytes
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.size = size
+            info.mtime = mtime
+            info.mode = mode
+            self.archive.addfile(info, reader)
+
+        if size is not None and reader.total_bytes != size:
+            raise BagError(
+                _("%(filename)s changed size while it was being archived")
+                % {"filename": arcname}
+            )
+
+        return reader.hexdigests(), reader.total_bytes
+
+    def close(self):
+        self.archive.close()
+
+
+class _HashingReader(object):
+    """Binary file wrapper which hashes every byte read through it"""
+
+    def __init__(self, fileobj, algorithms):
+        self.fileobj = fileobj
+        self.hashers = list(get_hashers(algorithms).items())
+        self.total_bytes = 0
+
+    def read(self, size=-1):
+        block = self.fileobj.read(size)
+        self.total_bytes += len(block)
+        for alg, hasher in self.hashers:
+            hasher.update(block)
+        return block
+
+    def hexdigests(self):
+        return {alg: h.hexdigest() for alg, h in self.hashers}
+
+
+def _zip_date_time(mtime):
+    # Zip timestamps cannot represent dates before 1980:
+    return time.localtime(max(mtime, 315532800))[:6]
+
+
+class ArchivedBag(Bag):
+    """
+    A bag serialized as a tar or zip archive, read and validated directly
+    from the archive without extracting it.
+
+    Only the tag files are read when the bag is opened; payload members are
+    only read by validate(), and only when it checks their fixity. Zip
+    payload members are hashed in parallel when processes > 1. Tar archives
+    can only be hashed in order, in a single pass which computes every
+    algorithm the validation needs together with any passed as algorithms,
+    so that later validations choosing them need not read the archive
+    again. Opening an uncompressed tar archive seeks past the payload, while
+    a compressed one has to be decompressed to find its tag files.
+
+    ArchivedBag is read-only.
+    """
+
+    def __init__(self, path, archive_type=None, algorithms=None):
+        self.archive_type = archive_type or archive_format(path)
+        self.hash_algorithms = algorithms
+        #: Name of the directory containing the bag within the archive
+        self.bag_name = None
+        #: Maps payload paths relative to the bag to their size in bytes
+        self.payload_sizes = {}
+        self._member_names = {}
+        self._tag_data = {}
+        self._payload_digests = {}
+        self._has_data_dir = False
+        super(ArchivedBag, self).__init__(path)
+
+    def _open(self):
+        if not isfile(self.path):
+            raise BagError(_("Expected bag archive does not exist: %s") % self.path)
+
+        if self.archive_type == "zip":
+            self._read_zip()
+        elif self.archive_type in ("tar", "tar.gz", "tar.bz2", "tar.xz"):
+            self._read_tar()
+        else:
+            raise BagError(_("Unable to determine the archive format for %s") % self.path)
+
+        super(ArchivedBag, self)._open()
+
+    def _isfile(self, path):
+        rel_path = os.path.relpath(path, self.path)
+        return rel_path in self._tag_data or rel_path in self.payload_sizes
+
+    def _open_text_file(self, path, encoding):
+        data = io.BytesIO(self._tag_data[os.path.relpath(path, self.path)])
+        data.name = path
+        return io.TextIOWrapper(data, encoding=encoding)
+
+    def _stat_tag_files(self):
+        # The archive cannot be saved, so its tag files are never compared:
+        return {}
+
+    def _member_path(self, name, is_dir=False):
+        """
+        Returns the path of an archive member relative to the bag, or None
+        for the directory containing the bag itself
+        """
+        while name.startswith("./"):
+            name = name[2:]
+        parts = [i for i in name.split("/") if i]
+
+        if self.bag_name is None:
+            if parts[0] == "data" or (len(parts) == 1 and not is_dir):
+                self.bag_name = ""
+            else:
+                self.bag_name = parts[0]
+
+        if self.bag_name:
+            if parts[0] != self.bag_name:
+                raise BagValidationError(
+                    _("%(member)s is outside of the bag directory %(bag)s")
+                    % {"member": name, "bag": self.bag_name}
+                )
+            parts = parts[1:]
+
+        if not parts:
+            return None
+        return os.path.normpath(os.path.join(*parts))
+
+    def _add_member(self, member_name, rel_path, size, is_dir):
+        if is_dir:
+            if rel_path == "data":
+                self._has_data_dir = True
+            return False
+
+        if rel_path.startswith("data" + os.sep):
+            self._has_data_dir = True
+            self.payload_sizes[rel_path] = size
+            self._member_names[rel_path] = member_name
+            return True
+
+        return False
+
+    def _read_zip(self):
+        with zipfile.ZipFile(self.path) as archive:
+            infos = archive.infolist()
+            self.bag_name = _find_bag_name(i.filename for i in infos)
+
+            for info in infos:
+                rel_path = self._member_path(info.filename, info.is_dir())
+                if rel_path is None:
+                    continue
+                if not self._add_member(info.filename, rel_path, info.file_size, info.is_dir()):
+                    if not info.is_dir():
+                        self._tag_data[rel_path] = archive.read(info)
+
+    def _read_tar(self):
+        """Reads the tag files of the tar archive into memory, recording its payload members"""
+        # Opened for random access, so that the payload is skipped by seeking:
+        with tarfile.open(self.path, mode="r:*") as archive:
+            members = archive.getmembers()
+            self.bag_name = _find_bag_name(i.name for i in members)
+
+            for member in members:
+                rel_path = self._member_path(member.name, member.isdir())
+                if rel_path is None:
+                    continue
+                if not (member.isfile() or member.isdir()):
+                    LOGGER.warning(
+                        _(
+                            "Ignoring %(member)s in %(archive)s: only regular files and"
+                            " directories are supported"
+                        ),
+                        {"member": member.name, "archive": self.path},
+                    )
+                    continue
+
+                is_payload = self._add_member(member.name, rel_path, member.size, member.isdir())
+                if not is_payload and member.isfile():
+                    self._tag_data[rel_path] = archive.extractfile(member).read()
+
+    def _hash_tar_payload(self, algorithms, progress=None):
+        """Streams the tar archive once, hashing every payload member with algorithms"""
+        rel_paths = {name: rel_path for rel_path, name in self._member_names.items()}
+
+        with tarfile.open(self.path, mode="r|*") as archive:
+            for member in archive:
+                rel_path = rel_paths.get(member.name)
+                if rel_path is None or not member.isfile():
+                    continue
+                digests, byte_count = hash_stream(archive.extractfile(member), algorithms)
+                self._payload_digests.setdefault(rel_path, {}).update(digests)
+                if progress is not None:
+                    progress.advance(1, byte_count)
+
+    def payload_files(self):
+        for rel_path in self.payload_sizes:
+            self._register_filesystem_name(rel_path)
+            yield rel_path
+
+    def _measure_payload(self):
+        return len(self.payload_sizes), sum(self.payload_sizes.values())
+
+    def save(
+        self, processes=1, manifests=False, executor=None, start_method=None, progress=None, events=None
+    ):
+        raise BagError(_("Bags inside archives cannot be saved: %s") % self.path)
+
+    def validate(
+        self,
+        processes=1,
+        fast=False,
+        completeness_only=False,
+        pipeline=False,
+        executor=None,
+        algorithms="all",
+        cache="normal",
+        throttle=None,
+        order="path",
+        device_processes=None,
+        start_method=None,
+        progress=None,
+        metrics=None,
+        profile=None,
+        events=None,
+    ):
+        """
+        Checks the structure and contents are valid, as Bag.validate() does,
+        reading everything from the archive. pipeline, cache, throttle, order
+        and device_processes have no effect: the archive is always read in a
+        single pass.
+        processes, executor and start_method only apply to zip archives.
+        """
+        return super(ArchivedBag, self).validate(
+            processes=processes,
+            fast=fast,
+            completeness_only=completeness_only,
+            executor=executor,
+            algorithms=algorithms,
+            cache=cache,
+            throttle=throttle,
+            order=order,
+            device_processes=device_processes,
+            start_method=start_method,
+            progress=progress,
+            metrics=metrics,
+            profile=profile,
+            events=events,
+        )
+
+    def _validate_structure_payload_directory(self):
+        if not self._has_data_dir:
+            raise BagValidationError(
+                _("Expected data directory %s does not exist") % os.path.join(self.path, "data")
+            )
+
+    def _validate_structure_tag_files(self):
+        if not list(self.manifest_files()):
+            raise BagValidationError(_("No manifest files found"))
+
+    def _validate_bagittxt(self):
+        if self._tag_data["bagit.txt"].startswith(codecs.BOM_UTF8):
+            raise BagValidationError(_("bagit.txt must not contain a byte-order mark"))
+
+    def _validate_contents(
+        self, processes=1, fast=False, completeness_only=False, algorithms=None, executor=None, **hash_options
+    ):
+        if fast and not self.has_oxum():
+            raise BagValidationError(
+                _("Fast validation requires bag-info.txt to include Payload-Oxum")
+            )
+
+        progress = as_progress(hash_options.get("progress"))
+
+        with progress.phase("oxum"):
+            self._validate_oxum(self.payload_sizes.values())
+
+        if fast:
+            return
+
+        with progress.phase("completeness"):
+            self._validate_completeness()
+
+        if completeness_only:
+            return
+
+        with progress.phase("hashing", *self._measure_payload()):
+            hash_results = self._calculate_archive_hashes(
+                processes,
+                executor=executor,
+                algorithms=algorithms,
+                start_method=hash_options.get("start_method"),
+                progress=progress,
+                profiler=hash_options.get("profiler"),
+                events=hash_options.get("events"),
+            )
+
+        with progress.phase("fixity"):
+            self._check_hash_results(hash_results)
+
+    def _calculate_archive_hashes(self, processes, executor=None, algorithms=None, start_method=None,
+                                  progress=None, profiler=None, events=None):
+        """
+        Returns (rel_path, f_hashes, hashes) tuples for every manifest entry,
+        with algorithms (by default all of the bag's), recording each payload
+        file to events, an events.EventLog, if one is provided
+        """
+        selected = self.algorithms if algorithms is None else algorithms
+
+        payload = {}
+        for entry in self.entries:
+            rel_path = self.normalized_filesystem_names.get(normalize_unicode(entry), entry)
+            if rel_path in self.payload_sizes:
+                payload[rel_path] = [i for i in self.entries[entry] if i in selected]
+
+        if self.archive_type == "zip":
+            self._hash_zip_payload(payload, processes, executor=executor, start_method=start_method,
+                                   progress=progress, profiler=profiler)
+        else:
+            missing = set()
+            for rel_path, algorithms in payload.items():
+                missing.update(set(algorithms).difference(self._payload_digests.get(rel_path, {})))
+            if missing:
+                self._hash_tar_payload(sorted(missing.union(self.hash_algorithms or ())), progress)
+            elif progress is not None:
+                # The members were hashed by an earlier validation:
+                progress.advance(len(payload), sum(self.payload_sizes[i] for i in payload))
+
+        hash_results = []
+        for entry, hashes in self.entries.items():
+            rel_path = self.normalized_filesystem_names.get(normalize_unicode(entry), entry)
+            algorithms = [i for i in hashes if i in selected]
+            if rel_path in self._payload_digests:
+                digests = self._payload_digests[rel_path]
+                f_hashes = {alg: digests[alg] for alg in algorithms}
+                if events is not None:
+                    events.file(rel_path, self.payload_sizes[rel_path], f_hashes)
+            elif rel_path in self._tag_data:
+                f_hashes = hash_bytes(self._tag_data[rel_path], algorithms) if algorithms else {}
+            else:
+                continue
+            hash_results.append((rel_path, f_hashes, hashes))
+
+        return hash_results
+
+    def _hash_zip_payload(self, payload, processes, executor=None, start_method=None, progress=None,
+                          profiler=None):
+        log_level = file_log_level()
+        # Identifies the zip archives opened for this call, so that they can be closed:
+        job_id = (os.getpid(), next(_zip_job_ids))
+        args = [
+            (self.path, job_id, self._member_names[rel_path], rel_path, algorithms, log_level)
+            for rel_path, algorithms in payload.items()
+        ]
+
+        def report(result):
+            progress.advance(1, self.payload_sizes[result[0]])
+
+        on_result = report if progress is not None and progress.callback is not None else None
+
+        try:
+            results = map_with_workers(
+                _hash_zip_member,
+                args,
+                processes=processes,
+                executor=executor,
+                start_method=start_method,
+                on_result=on_result,
+                profiler=profiler,
+            )
+        finally:
+            # Worker processes close theirs when they read another archive or exit:
+            _close_zip_archives(job_id)
+
+        self._payload_digests.update(results)
+
+
+#: Each worker thread keeps the zip archive it last read open, so that it only
+#: parses the central directory once per call to _hash_zip_payload()
+_zip_archives = threading.local()
+
+#: The zip archives open in this process's threads, by job id
+_open_zip_archives = {}
+_open_zip_archives_lock = threading.Lock()
+
+_zip_job_ids = itertools.count()
+
+
+def _open_zip_archive(path, job_id):
+    current = getattr(_zip_archives, "current", None)
+    if current is not None and current[0] == job_id:
+        return current[1]
+    if current is not None:
+        _close_zip_archive(current)
+
+    archive = zipfile.ZipFile(path)
+    _zip_archives.current = (job_id, archive)
+    with _open_zip_archives_lock:
+        _open_zip_archives.setdefault(job_id, []).append(archive)
+    return archive
+
+
+def _close_zip_archive(current):
+    job_id, archive = current
+    archive.close()
+    with _open_zip_archives_lock:
+        archives = _open_zip_archives.get(job_id, [])
+        if archive in archives:
+            archives.remove(archive)
+        if not archives:
+            _open_zip_archives.pop(job_id, None)
+
+
+def _close_zip_archives(job_id):
+    """Closes the zip archives opened by this process's threads for job_id"""
+    with _open_zip_archives_lock:
+        archives = _open_zip_archives.pop(job_id, [])
+    for archive in archives:
+        archive.close()
+
+
+def _hash_zip_member(args):
+    path, job_id, member_name, rel_path, algorithms, log_level = args
+    if LOGGER.isEnabledFor(log_level):
+        LOGGER.log(log_level, _("Verifying checksum for file %s"), rel_path)
+
+    try:
+        with _open_zip_archive(path, job_id).open(member_name) as member:
+            digests, byte_count = hash_stream(member, algorithms)
+    except (OSError, zipfile.BadZipFile) as e:
+        digests = {alg: force_unicode(e) for alg in algorithms}
+
+    return rel_path, digests
+
+
+def _find_bag_name(names):
+    """Returns the directory containing bagit.txt in a list of member names"""
+    bag_name = None
+    for name in names:
+        parts = [i for i in name.split("/") if i and i != "."]
+        if parts == ["bagit.txt"]:
+            return ""
+        if len(parts) == 2 and parts[1] == "bagit.txt":
+            bag_name = parts[0]
+    return bag_name
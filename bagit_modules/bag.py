@@ -1,20 +1,28 @@
 import codecs
-import multiprocessing
 import os
+import time
 import warnings
 from os.path import abspath, isfile, isdir
-from urllib.parse import urlparse
 
 from bagit_modules.translation_catalog import _
+from bagit_modules.concurrency import START_METHODS
 from bagit_modules.constants import UNICODE_BYTE_ORDER_MARK
-from bagit_modules.concurrency import posix_multiprocessing_worker_initializer
+from bagit_modules.events import recording_events
 from bagit_modules.string_ops import force_unicode, normalize_unicode
-from bagit_modules.hashing import calc_hashes, CHECKSUM_ALGOS
-from bagit_modules.tagging import make_tag_file, load_tag_file
+from bagit_modules.hashcore import CACHE_POLICIES
+from bagit_modules.hashing import get_hashers, hash_bytes, select_algorithms, CHECKSUM_ALGOS
+from bagit_modules.tagging import format_tag_file, read_tag_file
 from bagit_modules.filenames import decode_filename
-from bagit_modules.manifests import make_manifests, make_tagmanifest_file
-from bagit_modules.io import can_bag, can_read, open_text_file
+from bagit_modules.manifests import TagManifestBuilder, make_manifests
+from bagit_modules.io import can_bag, can_read, find_tag_files, open_text_file
 from bagit_modules.logging import LOGGER
+from bagit_modules.metrics import collect_metrics
+from bagit_modules.pipeline import BackgroundStatWalk
+from bagit_modules.planning import measure_tree, planned_workers
+from bagit_modules.profiling import PROFILE_MODES, profiling
+from bagit_modules.progress import as_progress, log_summaries, observe
+from bagit_modules.timing import PhaseTimer
+from bagit_modules.workers import HASH_ORDERS, hash_files
 from bagit_modules.errors import BagError, BagValidationError, ChecksumMismatch, FileMissing, UnexpectedFile
 
 
@@ -46,6 +54,7 @@ class Bag(object):
 
         self.algorithms = []
         self.tag_file_name = None
+        self._tag_file_stats = {}
         self.path = abspath(path)
         if path:
             # if path ends in a path separator, strip it off
@@ -75,10 +84,11 @@ class Bag(object):
         # the required version and encoding.
         bagit_file_path = os.path.join(self.path, "bagit.txt")
 
-        if not isfile(bagit_file_path):
+        if not self._isfile(bagit_file_path):
             raise BagError(_("Expected bagit.txt does not exist: %s") % bagit_file_path)
 
-        self.tags = tags = load_tag_file(bagit_file_path)
+        with self._open_text_file(bagit_file_path, encoding="utf-8-sig") as bagit_file:
+            self.tags = tags = read_tag_file(bagit_file)
 
         required_tags = ("BagIt-Version", "Tag-File-Character-Encoding")
         missing_tags = [i for i in required_tags if i not in tags]
@@ -116,23 +126,34 @@ class Bag(object):
             raise BagValidationError(_("Unsupported encoding: %s") % self.encoding)
 
         info_file_path = os.path.join(self.path, self.tag_file_name)
-        if os.path.exists(info_file_path):
-            self.info = load_tag_file(info_file_path, encoding=self.encoding)
+        if self._isfile(info_file_path):
+            with self._open_text_file(info_file_path, encoding=self.encoding) as info_file:
+                self.info = read_tag_file(info_file)
 
+        started = time.perf_counter()
         self._load_manifests()
+        self._load_seconds = time.perf_counter() - started
 
     def manifest_files(self):
         for filename in ["manifest-%s.txt" % a for a in CHECKSUM_ALGOS]:
             f = os.path.join(self.path, filename)
-            if isfile(f):
+            if self._isfile(f):
                 yield f
 
     def tagmanifest_files(self):
         for filename in ["tagmanifest-%s.txt" % a for a in CHECKSUM_ALGOS]:
             f = os.path.join(self.path, filename)
-            if isfile(f):
+            if self._isfile(f):
                 yield f
 
+    # Tag files are read through these so that subclasses such as
+    # ArchivedBag can load them from somewhere other than the filesystem:
+    def _isfile(self, path):
+        return isfile(path)
+
+    def _open_text_file(self, path, encoding):
+        return open_text_file(path, "r", encoding=encoding)
+
     def compare_manifests_with_fs(self):
         """
         Compare the filenames in the manifests to the filenames present on the
@@ -141,9 +162,12 @@ class Bag(object):
         local filesystem, respectively.
         """
 
+        return self._compare_manifests(self.payload_files())
+
+    def _compare_manifests(self, payload_files):
         # We compare the filenames after Unicode normalization so we can
         # reliably detect normalization changes after bag creation:
-        files_on_fs = set(normalize_unicode(i) for i in self.payload_files())
+        files_on_fs = set(normalize_unicode(i) for i in payload_files)
         files_in_manifest = set(
             normalize_unicode(i) for i in self.payload_entries().keys()
         )
@@ -175,7 +199,7 @@ class Bag(object):
 
     def payload_files(self):
         """Returns a list of filenames which are present on the local filesystem"""
-        payload_dir = os.path.join(os.path.dirname(os.path.abspath(self.path)), 'data')
+        payload_dir = os.path.join(self.path, "data")
 
         for dir_path, _, filenames in os.walk(payload_dir):
             for f in filenames:
@@ -187,9 +211,12 @@ class Bag(object):
                     os.path.join(dir_path, normalized_f), start=self.path
                 )
 
-                self.normalized_filesystem_names[normalize_unicode(rel_path)] = rel_path
+                self._register_filesystem_name(rel_path)
                 yield rel_path
 
+    def _register_filesystem_name(self, rel_path):
+        self.normalized_filesystem_names[normalize_unicode(rel_path)] = rel_path
+
     def payload_entries(self):
         """Return a dictionary of items """
         # Don't use dict comprehension (compatibility with Python < 2.7)
@@ -199,7 +226,9 @@ class Bag(object):
             if key.startswith("data" + os.sep)
         )
 
-    def save(self, processes=1, manifests=False):
+    def save(
+        self, processes=1, manifests=False, executor=None, start_method=None, progress=None, events=None
+    ):
         """
         save will persist any changes that have been made to the bag
         metadata (self.info).
@@ -211,7 +240,20 @@ class Bag(object):
         a corrupted bag.
 
         If you want to control the number of processes that are used when
-        recalculating checksums use the processes parameter.
+        recalculating checksums use the processes parameter, or pass any
+        concurrent.futures.Executor as executor to reuse an existing pool.
+        processes="auto" chooses serial hashing, threads or processes to
+        suit the size of the payload, and start_method how a new pool starts
+        its processes. progress, a function taking a progress.ProgressEvent,
+        is told about each phase and the progress of the hashing, and events
+        (see events.py) receives a JSON line for each phase and file hashed.
+
+        When only the metadata is saved, the digests of the other tag files
+        are taken from the tag manifests loaded when the bag was opened
+        unless their size or modification time has changed since, only the
+        changed entries are updated and the payload manifests are not parsed
+        again. Nothing is written if neither the metadata nor any other tag
+        file has changed.
         """
         # Error checking
         if not self.path:
@@ -223,6 +265,74 @@ class Bag(object):
                 % self.path
             )
 
+        # The payload is only read or rewritten when regenerating manifests:
+        if manifests:
+            self._check_payload_permissions()
+        else:
+            self._check_tag_file_permissions()
+
+        # Change working directory to bag directory so helper functions work
+        old_dir = os.path.abspath(os.path.curdir)
+        os.chdir(self.path)
+
+        try:
+            # Files written through the builder are hashed as they are written:
+            tagmanifests = TagManifestBuilder(self.path, self.algorithms, encoding=self.encoding)
+
+            # Generate new manifest files
+            if manifests:
+                planned = planned_workers(processes, executor, self.algorithms, lambda: measure_tree("data"))
+                with recording_events(events) as event_log, planned as (processes, executor):
+                    if event_log is not None:
+                        progress = event_log.observe(progress)
+                    total_bytes, total_files = make_manifests(
+                        "data",
+                        processes,
+                        algorithms=self.algorithms,
+                        encoding=self.encoding,
+                        tagmanifests=tagmanifests,
+                        executor=executor,
+                        start_method=start_method,
+                        progress=log_summaries(progress),
+                        events=event_log,
+                    )
+
+                # Update Payload-Oxum
+                LOGGER.info(_("Updating Payload-Oxum in %s"), self.tag_file_name)
+                self.info["Payload-Oxum"] = "%s.%s" % (total_bytes, total_files)
+
+            tag_file_data = format_tag_file(self.info).encode("utf-8")
+
+            if not manifests:
+                known_digests = self.tagfile_entries()
+                tag_file_digests = hash_bytes(tag_file_data, tagmanifests.algorithms)
+                changed = self._changed_tag_files()
+
+                if not changed and self._tagmanifests_current(self.tag_file_name, tag_file_digests):
+                    LOGGER.info(_("%s is unchanged; not saving"), self.tag_file_name)
+                    return
+
+                # Tag files edited since the bag was opened are hashed again:
+                for filename, digests in known_digests.items():
+                    if filename != self.tag_file_name and filename not in changed:
+                        tagmanifests.reuse(filename, digests)
+
+            tagmanifests.write(self.tag_file_name, tag_file_data)
+
+            # Update tag-manifest for changes to manifest & bag-info files
+            with as_progress(progress).phase("tag manifests"):
+                tag_digests = tagmanifests.save()
+
+            if manifests:
+                # Reload the manifests
+                self._load_manifests()
+            else:
+                self._update_tagfile_entries(tag_digests)
+                self._tag_file_stats = self._stat_tag_files()
+        finally:
+            os.chdir(old_dir)
+
+    def _check_payload_permissions(self):
         unbaggable = can_bag(self.path)
         if unbaggable:
             LOGGER.error(
@@ -249,30 +359,66 @@ class Bag(object):
                 _("Read permissions are required to calculate file fixities")
             )
 
-        # Change working directory to bag directory so helper functions work
-        old_dir = os.path.abspath(os.path.curdir)
-        os.chdir(self.path)
-
-        # Generate new manifest files
-        if manifests:
-            total_bytes, total_files = make_manifests(
-                "data", processes, algorithms=self.algorithms, encoding=self.encoding
+    def _check_tag_file_permissions(self):
+        unreadable_files = [
+            os.path.join(self.path, f)
+            for f in find_tag_files(self.path)
+            if not os.access(os.path.join(self.path, f), os.R_OK)
+        ]
+        if unreadable_files:
+            LOGGER.error(
+                _("The following files do not have read permissions:\n%s"),
+                unreadable_files,
+            )
+            raise BagError(
+                _("Read permissions are required to calculate file fixities")
             )
 
-            # Update Payload-Oxum
-            LOGGER.info(_("Updating Payload-Oxum in %s"), self.tag_file_name)
-            self.info["Payload-Oxum"] = "%s.%s" % (total_bytes, total_files)
+    def _tagmanifests_current(self, filename, digests):
+        """
+        Returns True if every tag manifest already exists and lists filename
+        with the provided digests
+        """
+        recorded = self.entries.get(filename, {})
 
-        make_tag_file(self.tag_file_name, self.info)
+        for alg, digest in digests.items():
+            if not self._isfile(os.path.join(self.path, "tagmanifest-%s.txt" % alg)):
+                return False
+            if recorded.get(alg, "").lower() != digest:
+                return False
 
-        # Update tag-manifest for changes to manifest & bag-info files
-        for alg in self.algorithms:
-            make_tagmanifest_file(alg, self.path, encoding=self.encoding)
+        return True
 
-        # Reload the manifests
-        self._load_manifests()
+    def _stat_tag_files(self):
+        """Returns {filename: (size, modification time)} for every tag file other than the tag manifests"""
+        stats = {}
+        for filename in find_tag_files(self.path):
+            st = os.stat(os.path.join(self.path, filename))
+            stats[filename] = (st.st_size, st.st_mtime_ns)
+        return stats
+
+    def _changed_tag_files(self):
+        """Returns the tag files which have been changed, added or removed since the manifests were loaded"""
+        stats = self._stat_tag_files()
+        return {
+            filename
+            for filename in set(stats).union(self._tag_file_stats)
+            if stats.get(filename) != self._tag_file_stats.get(filename)
+        }
+
+    def _update_tagfile_entries(self, tag_digests):
+        """Replaces the in-memory tag file entries without reparsing any manifest"""
+        if self.version_info < (0, 97):
+            # Tag manifests are not loaded into self.entries for older bags
+            return
+
+        for filename in list(self.tagfile_entries()):
+            if filename not in tag_digests:
+                del self.entries[filename]
 
-        os.chdir(old_dir)
+        for filename, digests in tag_digests.items():
+            self.entries[filename] = dict(digests)
+            self.normalized_manifest_names[normalize_unicode(filename)] = filename
 
     def tagfile_entries(self):
         return dict(
@@ -290,7 +436,7 @@ class Bag(object):
         entries for existing files).
         """
         for tagfilepath in self.tagfile_entries().keys():
-            if not os.path.isfile(os.path.join(self.path, tagfilepath)):
+            if not self._isfile(os.path.join(self.path, tagfilepath)):
                 yield tagfilepath
 
     def fetch_entries(self):
@@ -304,10 +450,8 @@ class Bag(object):
 
         fetch_file_path = os.path.join(self.path, "fetch.txt")
 
-        if isfile(fetch_file_path):
-            with open_text_file(
-                fetch_file_path, "r", encoding=self.encoding
-            ) as fetch_file:
+        if self._isfile(fetch_file_path):
+            with self._open_text_file(fetch_file_path, encoding=self.encoding) as fetch_file:
                 for line in fetch_file:
                     url, file_size, filename = line.strip().split(None, 2)
 
@@ -334,33 +478,194 @@ class Bag(object):
     def has_oxum(self):
         return "Payload-Oxum" in self.info
 
-    def validate(self, processes=1, fast=False, completeness_only=False):
+    def validate(
+        self,
+        processes=1,
+        fast=False,
+        completeness_only=False,
+        pipeline=False,
+        executor=None,
+        algorithms="all",
+        cache="normal",
+        throttle=None,
+        order="path",
+        device_processes=None,
+        start_method=None,
+        progress=None,
+        metrics=None,
+        profile=None,
+        events=None,
+    ):
         """Checks the structure and contents are valid.
 
         If you supply the parameter fast=True the Payload-Oxum (if present) will
         be used to check that the payload files are present and accounted for,
         instead of re-calculating fixities and comparing them against the
         manifest. By default validate() will re-calculate fixities (fast=False).
-        """
 
-        self._validate_structure()
-        self._validate_bagittxt()
-
-        self.validate_fetch()
-
-        self._validate_contents(
-            processes=processes, fast=fast, completeness_only=completeness_only
-        )
+        If pipeline=True the manifest entries are hashed while the payload
+        directory is walked in the background, and Payload-Oxum and
+        completeness are both checked from that single walk as soon as it
+        ends, stopping the hashing if either fails. Errors are reported in the
+        same order as the default mode.
+
+        Files are hashed on executor, any concurrent.futures.Executor, if one
+        is provided instead of on a new pool of processes. processes="auto"
+        chooses serial hashing, threads or processes, and how many, from the
+        size of the payload and the CPUs available.
+
+        algorithms chooses which manifests' checksums are verified: "all"
+        (the default), "strongest", "fastest" on this machine, or a list of
+        algorithm names. Files listed only in manifests which were not
+        chosen are still verified with the best of their own algorithms.
+
+        cache selects how payload files are read: "normal" leaves the page
+        cache to the kernel, "drop" evicts each file's pages once they have
+        been hashed and "direct" bypasses the page cache with O_DIRECT where
+        the filesystem supports it.
+
+        throttle, a throttle.Throttle, limits the combined bytes and files
+        per second read by all of the workers and can lower their priority,
+        so that background fixity checks give way to other users of the
+        same storage.
+
+        order is the order in which files are read: "path", the default,
+        follows the manifests, "inode" sorts them by inode number and
+        "physical" by the position of their data on disk, which greatly
+        reduces seeking on spinning disks.
+
+        device_processes limits the number of workers reading from each
+        device at once, so that a payload spanning several disks or volumes
+        keeps all of them busy. processes still sets the total.
+
+        start_method chooses how a new pool starts its worker processes:
+        "fork", "spawn" or "forkserver", by default the platform's.
+
+        progress, a function taking a progress.ProgressEvent, is called as
+        each phase starts and ends and with periodic updates on the files
+        and bytes hashed, the throughput and the estimated time remaining.
+
+        metrics, a filename or metrics.MetricsFile, receives the bytes and
+        files hashed, the time taken by each phase and algorithm, the peak
+        memory use, the worker utilization and the errors found once the
+        validation finishes, in JSON if the filename ends in .json and in
+        the Prometheus text format otherwise.
+
+        profile logs the time taken by each phase, including loading the
+        manifests when the bag was opened, if it is "phases" or True. With
+        "cprofile" this process and every worker are also profiled and the
+        merged statistics are logged (see profiling.py).
+
+        events, a filename, "-" for stdout or a writable text file, receives
+        a JSON line for every phase and every file hashed (see events.py).
+        """
+        if cache not in CACHE_POLICIES:
+            raise BagError(_("Unknown cache policy: %s") % cache)
+        if order not in HASH_ORDERS:
+            raise BagError(_("Unknown hashing order: %s") % order)
+        if device_processes is not None and device_processes <= 0:
+            raise BagError(_("The number of processes per device must be greater than 0"))
+        if start_method is not None and start_method not in START_METHODS:
+            raise BagError(_("Unknown start method: %s") % start_method)
+        if isinstance(profile, str) and profile not in PROFILE_MODES:
+            raise BagError(_("Unknown profile mode: %s") % profile)
+
+        hash_options = {
+            "executor": executor,
+            "cache": cache,
+            "throttle": throttle,
+            "order": order,
+            "device_processes": device_processes,
+            "start_method": start_method,
+        }
+
+        recording = collect_metrics(metrics, "validate", self.path, progress)
+        with recording as run, profiling(profile, self.path) as profiler, \
+                recording_events(events) as event_log:
+            progress = run.progress if profiler is None else profiler.observe(run.progress)
+            if event_log is not None:
+                progress = event_log.observe(progress)
+            hash_options["progress"] = log_summaries(progress)
+            hash_options["profiler"] = profiler
+            hash_options["events"] = event_log
+            if profiler is not None:
+                profiler.timer.add("load manifests", self._load_seconds)
+
+            self._validate_structure()
+            self._validate_bagittxt()
+
+            self.validate_fetch()
+
+            selected = None
+            if not (fast or completeness_only):
+                selected = self._select_algorithms(algorithms)
+                run.algorithms = selected
+            elif processes == "auto":
+                # Nothing will be hashed:
+                processes = 1
+
+            workers = planned_workers(processes, executor, selected, self._measure_payload)
+            with workers as (processes, executor):
+                hash_options["executor"] = executor
+                run.set_workers(processes, executor, start_method)
+
+                if pipeline:
+                    self._validate_contents_pipelined(
+                        processes=processes,
+                        fast=fast,
+                        completeness_only=completeness_only,
+                        algorithms=selected,
+                        **hash_options
+                    )
+                else:
+                    self._validate_contents(
+                        processes=processes,
+                        fast=fast,
+                        completeness_only=completeness_only,
+                        algorithms=selected,
+                        **hash_options
+                    )
 
         return True
 
-    def is_valid(self, fast=False, completeness_only=False):
+    def is_valid(
+        self,
+        fast=False,
+        completeness_only=False,
+        pipeline=False,
+        executor=None,
+        algorithms="all",
+        cache="normal",
+        throttle=None,
+        order="path",
+        device_processes=None,
+        start_method=None,
+        progress=None,
+        metrics=None,
+        profile=None,
+        events=None,
+    ):
         """Returns validation success or failure as boolean.
         Optional fast parameter passed directly to validate().
         """
 
         try:
-            self.validate(fast=fast, completeness_only=completeness_only)
+            self.validate(
+                fast=fast,
+                completeness_only=completeness_only,
+                pipeline=pipeline,
+                executor=executor,
+                algorithms=algorithms,
+                cache=cache,
+                throttle=throttle,
+                order=order,
+                device_processes=device_processes,
+                start_method=start_method,
+                progress=progress,
+                metrics=metrics,
+                profile=profile,
+                events=events,
+            )
         except BagError:
             return False
 
@@ -368,6 +673,8 @@ class Bag(object):
 
     def _load_manifests(self):
         self.entries = {}
+        # Recorded so that save() can tell which tag files were edited since:
+        self._tag_file_stats = self._stat_tag_files()
         manifests = list(self.manifest_files())
 
         if self.version_info >= (0, 97):
@@ -387,9 +694,7 @@ class Bag(object):
             if alg not in self.algorithms:
                 self.algorithms.append(alg)
 
-            with open_text_file(
-                manifest_filename, "r", encoding=self.encoding
-            ) as manifest_file:
+            with self._open_text_file(manifest_filename, encoding=self.encoding) as manifest_file:
                 if manifest_file.encoding.startswith("UTF"):
                     # We'll check the first character to see if it's a BOM:
                     if manifest_file.read(1) == UNICODE_BYTE_ORDER_MARK:
@@ -509,6 +814,7 @@ class Bag(object):
 
         Raises `BagError` for errors and otherwise returns no value
         """
+        from urllib.parse import urlparse
 
         for url, file_size, filename in self.fetch_entries():
             # fetch_entries will raise a BagError for unsafe filenames
@@ -519,26 +825,155 @@ class Bag(object):
             if not all((parsed_url.scheme, parsed_url.netloc)):
                 raise BagError(_("Malformed URL in fetch.txt: %s") % url)
 
-    def _validate_contents(self, processes=1, fast=False, completeness_only=False):
+    def _measure_payload(self):
+        """
+        Returns the number of payload files listed in the manifests and their
+        total size, taken from Payload-Oxum where possible
+        """
+        rel_paths = [i for i in self.entries if i.startswith("data" + os.sep)]
+
+        oxum = self.info.get("Payload-Oxum")
+        if isinstance(oxum, str):
+            byte_count = oxum.strip().partition(".")[0]
+            if byte_count.isdigit():
+                return len(rel_paths), int(byte_count)
+
+        byte_count = 0
+        for rel_path in rel_paths:
+            try:
+                byte_count += os.stat(os.path.join(self.path, rel_path)).st_size
+            except OSError:
+                pass
+        return len(rel_paths), byte_count
+
+    def _select_algorithms(self, policy):
+        """
+        Returns the supported manifest algorithms to verify under policy (see
+        select_algorithms()), adding the best algorithm of any entry which
+        none of the chosen algorithms cover so that every file is checked
+        """
+        available = list(get_hashers(self.algorithms))
+
+        try:
+            selected = select_algorithms(available, policy)
+        except ValueError as e:
+            raise BagError(force_unicode(e))
+
+        if len(selected) < len(available):
+            fallback = policy if policy in ("strongest", "fastest") else "strongest"
+            for hashes in self.entries.values():
+                if not any(alg in hashes for alg in selected):
+                    candidates = [i for i in available if i in hashes]
+                    if candidates:
+                        selected.extend(select_algorithms(candidates, fallback))
+
+            LOGGER.info(
+                _("Verifying %(selected)s checksums for %(bag)s"),
+                {"selected": ", ".join(selected), "bag": self},
+            )
+
+        return selected
+
+    def _validate_contents(
+        self, processes=1, fast=False, completeness_only=False, algorithms=None, **hash_options
+    ):
         if fast and not self.has_oxum():
             raise BagValidationError(
                 _("Fast validation requires bag-info.txt to include Payload-Oxum")
             )
 
+        progress = as_progress(hash_options.get("progress"))
+
         # Perform the fast file count + size check so we can fail early:
-        self._validate_oxum()
+        with progress.phase("oxum"):
+            self._validate_oxum()
 
         if fast:
             return
 
-        self._validate_completeness()
+        with progress.phase("completeness"):
+            self._validate_completeness()
 
         if completeness_only:
             return
 
-        self._validate_entries(processes)
+        self._validate_entries(processes, algorithms=algorithms, **hash_options)
+
+    def _validate_contents_pipelined(
+        self, processes=1, fast=False, completeness_only=False, algorithms=None, **hash_options
+    ):
+        if fast and not self.has_oxum():
+            raise BagValidationError(
+                _("Fast validation requires bag-info.txt to include Payload-Oxum")
+            )
+
+        timer = PhaseTimer()
+        progress = as_progress(hash_options.get("progress"))
+        walker = BackgroundStatWalk(self.path, os.path.join(self.path, "data"))
+        walker.start()
+        checked = []
+
+        def check_payload():
+            payload = walker.results()
+            timer.add("walk", walker.elapsed)
+            progress.add("walk", walker.elapsed)
+
+            for rel_path, size in payload:
+                self._register_filesystem_name(rel_path)
+
+            checked.append(True)
+            with timer.phase("oxum"), progress.phase("oxum"):
+                self._validate_oxum(size for rel_path, size in payload)
+
+            if not fast:
+                with timer.phase("completeness"), progress.phase("completeness"):
+                    self._validate_completeness(rel_path for rel_path, size in payload)
+
+        def check_walk(event):
+            # Raising from a progress update stops the hashing:
+            if event.kind == "update" and not checked and not walker.is_alive():
+                check_payload()
+
+        try:
+            hash_results = []
+            if not (fast or completeness_only):
+                # Hashing starts right away using the names in the manifests;
+                # the walk running alongside supplies the metadata for
+                # everything else, which is checked once it ends
+                with timer.phase("hashing"):
+                    hash_results = self._calculate_entry_hashes(
+                        processes,
+                        self.entries.keys(),
+                        algorithms=algorithms,
+                        **dict(hash_options, progress=observe(progress, check_walk))
+                    )
 
-    def _validate_oxum(self):
+            if not checked:
+                check_payload()
+
+            if fast or completeness_only:
+                return
+
+            # Entries stored under a different Unicode normalization than the
+            # filesystem could not be opened by name and are hashed again:
+            renamed = [
+                i[0]
+                for i in hash_results
+                if self.normalized_filesystem_names.get(normalize_unicode(i[0]), i[0]) != i[0]
+            ]
+            if renamed:
+                hash_options["executor"] = None
+                renamed_results = self._calculate_entry_hashes(
+                    1, renamed, algorithms=algorithms, **hash_options
+                )
+                hash_results = [i for i in hash_results if i[0] not in renamed] + renamed_results
+
+            with timer.phase("fixity"), progress.phase("fixity"):
+                self._check_hash_results(hash_results)
+        finally:
+            timer.log_summary(self.path)
+
+    def _validate_oxum(self, payload_sizes=None):
         oxum = self.info.get("Payload-Oxum")
 
         if oxum is None:
@@ -550,7 +985,7 @@ class Bag(object):
             LOGGER.warning(_("bag-info.txt defines multiple Payload-Oxum values!"))
             oxum = oxum[0]
 
-        oxum_byte_count, oxum_file_count = oxum.split(".", 1)
+        oxum_byte_count, oxum_file_count = oxum.strip().split(".", 1)
 
         if not oxum_byte_count.isdigit() or not oxum_file_count.isdigit():
             raise BagError(_("Malformed Payload-Oxum value: %s") % oxum)
@@ -560,9 +995,13 @@ class Bag(object):
         total_bytes = 0
         total_files = 0
 
-        for payload_file in self.payload_files():
-            payload_file = os.path.join(self.path, payload_file)
-            total_bytes += os.stat(payload_file).st_size
+        if payload_sizes is None:
+            payload_sizes = (
+                os.stat(os.path.join(self.path, i)).st_size for i in self.payload_files()
+            )
+
+        for size in payload_sizes:
+            total_bytes += size
             total_files += 1
 
         if oxum_file_count != total_files or oxum_byte_count != total_bytes:
@@ -580,15 +1019,18 @@ class Bag(object):
                 }
             )
 
-    def _validate_completeness(self):
+    def _validate_completeness(self, payload_files=None):
         """
         Verify that the actual file manifests match the files in the data directory
         """
         errors = list()
 
+        if payload_files is None:
+            payload_files = self.payload_files()
+
         # First we'll make sure there's no mismatch between the filesystem
         # and the list of files in the manifest(s)
-        only_in_manifests, only_on_fs = self.compare_manifests_with_fs()
+        only_in_manifests, only_on_fs = self._compare_manifests(payload_files)
         for path in only_in_manifests:
             e = FileMissing(path)
             LOGGER.warning(force_unicode(e))
@@ -601,47 +1043,69 @@ class Bag(object):
         if errors:
             raise BagValidationError(_("Bag is incomplete"), errors)
 
-    def _validate_entries(self, processes):
+    def _validate_entries(self, processes, algorithms=None, **hash_options):
         """
         Verify that the actual file contents match the recorded hashes stored in the manifest files
         """
-        errors = list()
-
-        if os.name == "posix":
-            worker_init = posix_multiprocessing_worker_initializer
-        else:
-            worker_init = None
-
-        args = (
-            (
-                self.path,
-                self.normalized_filesystem_names.get(rel_path, rel_path),
-                hashes,
-                self.algorithms,
-            )
-            for rel_path, hashes in self.entries.items()
+        hash_results = self._calculate_entry_hashes(
+            processes,
+            (self.normalized_filesystem_names.get(i, i) for i in self.entries.keys()),
+            algorithms=algorithms,
+            **hash_options
         )
+        with as_progress(hash_options.get("progress")).phase("fixity"):
+            self._check_hash_results(hash_results)
+
+    def _calculate_entry_hashes(self, processes, rel_paths, algorithms=None, **hash_options):
+        """
+        Hashes the named files, which must be keys of self.entries or their
+        filesystem equivalents, with algorithms (by default all of the bag's)
+        returning (rel_path, f_hashes, hashes) tuples where f_hashes maps each
+        algorithm to the raw digest bytes, or to an error message if the file
+        could not be read. Every file is recorded to hash_options["events"],
+        an events.EventLog, if there is one; the other hash_options are passed
+        on to hash_files().
+        """
+        events = hash_options.pop("events", None)
+        rel_paths = list(rel_paths)
+        algorithms = list(get_hashers(self.algorithms if algorithms is None else algorithms))
 
         try:
-            if processes == 1:
-                hash_results = [calc_hashes(i) for i in args]
-            else:
-                try:
-                    pool = multiprocessing.Pool(
-                        processes if processes else None, initializer=worker_init
-                    )
-                    hash_results = pool.map(calc_hashes, args)
-                finally:
-                    pool.terminate()
+            results = hash_files(self.path, rel_paths, algorithms, processes=processes, **hash_options)
+
+            hash_results = []
+            for rel_path, (digests, size, error) in zip(rel_paths, results):
+                manifest_name = self.normalized_manifest_names.get(normalize_unicode(rel_path), rel_path)
+                hashes = self.entries[manifest_name]
+                if error is not None:
+                    f_hashes = {alg: error for alg in algorithms if alg in hashes}
+                else:
+                    f_hashes = {alg: digest for alg, digest in zip(algorithms, digests) if alg in hashes}
+                hash_results.append((rel_path, f_hashes, hashes))
+                if events is not None:
+                    events.file(rel_path, size, f_hashes, error)
 
+        except BagError:
+            raise
         # Any unhandled exceptions are probably fatal
         except:
             LOGGER.exception(_("Unable to calculate file hashes for %s"), self)
             raise
 
+        return hash_results
+
+    def _check_hash_results(self, hash_results):
+        errors = list()
+
         for rel_path, f_hashes, hashes in hash_results:
             for alg, computed_hash in f_hashes.items():
                 stored_hash = hashes[alg]
+                if isinstance(computed_hash, bytes):
+                    # Raw digests from the workers are compared without
+                    # formatting every one of them as hex:
+                    if _digest_bytes(stored_hash) == computed_hash:
+                        continue
+                    computed_hash = computed_hash.hex()
                 if stored_hash.lower() != computed_hash:
                     e = ChecksumMismatch(
                         rel_path, alg, stored_hash.lower(), computed_hash
@@ -685,3 +1149,11 @@ class Bag(object):
         bag_path = os.path.normpath(bag_path)
         common = os.path.commonprefix((bag_path, real_path))
         return not (common == bag_path)
+
+
+def _digest_bytes(hexdigest):
+    """Returns the bytes of a hex digest from a manifest, or None if it is malformed"""
+    try:
+        return bytes.fromhex(hexdigest)
+    except ValueError:
+        return None
@@ -1,18 +1,31 @@
 import os
+import shutil
 import warnings
 from datetime import date
 
 from bagit_modules.docs import PROJECT_URL
 from bagit_modules.translation_catalog import _
 from bagit_modules.bag import Bag
+from bagit_modules.concurrency import START_METHODS
 from bagit_modules.constants import DEFAULT_CHECKSUMS
 from bagit_modules.errors import BagError
-from bagit_modules.io import open_text_file
+from bagit_modules.events import recording_events
+from bagit_modules.hashcore import CACHE_POLICIES
+from bagit_modules.hashing import get_hashers
 from bagit_modules.logging import LOGGER
-from bagit_modules.manifests import make_manifests, make_tagmanifest_file
-from bagit_modules.tagging import make_tag_file
+from bagit_modules.manifests import TagManifestBuilder, format_manifest, make_manifests
+from bagit_modules.metrics import collect_metrics
+from bagit_modules.pipeline import SourceScan, hash_payload
+from bagit_modules.planning import measure_tree, planned_workers
+from bagit_modules.profiling import PROFILE_MODES, profiling
+from bagit_modules.progress import as_progress, log_summaries, observe
+from bagit_modules.tagging import format_tag_file
+from bagit_modules.timing import PhaseTimer
+from bagit_modules.workers import HASH_ORDERS
 from bagit_modules.versioning import get_version
 
+BAGIT_TXT = """BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"""
+
 
 def make_bag(
     bag_dir,
@@ -20,82 +33,350 @@ def make_bag(
     processes=1,
     checksums=None,
     checksum=None,
-    encoding="utf-8"
+    encoding="utf-8",
+    pipeline=False,
+    dest=None,
+    executor=None,
+    cache="normal",
+    throttle=None,
+    order="path",
+    device_processes=None,
+    start_method=None,
+    progress=None,
+    metrics=None,
+    profile=None,
+    events=None,
 ):
     """
     Convert a given directory into a bag. You can pass in arbitrary
     key/value pairs to put into the bag-info.txt metadata file as
     the bag_info dictionary.
+
+    If pipeline is True the directory is traversed only once: files are
+    hashed as they are discovered and the manifests, Payload-Oxum and tag
+    manifests are produced from the results held in memory. The time spent
+    in each phase is logged at the end.
+
+    If dest is provided bag_dir is left untouched and only needs to be
+    readable: its contents are copied into the payload of a new bag at dest,
+    which must not exist or be empty. Each file is hashed while it is copied
+    (or reflinked, where the filesystem supports it) so the source is read
+    only once. This always uses the pipeline.
+
+    Files are hashed on executor, any concurrent.futures.Executor, if one is
+    provided. It is left running so that a single warm pool can be shared by
+    many bags; otherwise a new pool is started for every call when processes
+    is greater than 1. processes="auto" measures the payload first and picks
+    serial hashing, threads or processes, and how many, to suit its size
+    and the CPUs available (see planning.plan_execution()).
+
+    cache selects how payload files are read: "normal" leaves the page cache
+    to the kernel, "drop" evicts each file's pages once they have been
+    hashed and "direct" bypasses the page cache with O_DIRECT where the
+    filesystem supports it.
+
+    throttle, a throttle.Throttle, limits the combined bytes and files per
+    second read by all of the workers and can lower their priority.
+
+    order is the order in which files are hashed: "path", the default,
+    follows the directory tree, "inode" sorts them by inode number and
+    "physical" by the position of their data on disk, which greatly reduces
+    seeking on spinning disks. The manifests are written in the same order
+    whichever is used. Any order other than "path" makes the pipeline wait
+    for the whole traversal before hashing starts.
+
+    device_processes limits the number of workers reading from each device
+    at once, so that when the payload spans several disks or volumes the
+    workers are spread across all of them. processes still sets the total.
+    Like order, it makes the pipeline wait for the whole traversal.
+
+    start_method chooses how a new pool starts its worker processes: "fork",
+    "spawn" or "forkserver", by default the platform's. Spawned workers and
+    those of a fork server only import the hashing core.
+
+    progress, a function taking a progress.ProgressEvent, is called as each
+    phase starts and ends and with periodic updates on the files and bytes
+    hashed, the throughput and the estimated time remaining.
+
+    metrics, a filename or metrics.MetricsFile, receives the bytes and files
+    hashed, the time taken by each phase and algorithm, the peak memory use
+    and the worker utilization once the bag has been made, in JSON if the
+    filename ends in .json and in the Prometheus text format otherwise.
+
+    profile logs the time taken by each phase if it is "phases" or True.
+    With "cprofile" this process and every worker are also profiled and
+    the merged statistics are logged (see profiling.py).
+
+    events, a filename, "-" for stdout or a writable text file, receives a
+    JSON line for every phase and every file hashed (see events.py).
     """
 
     checksums = _set_checksums(checksum, checksums)
     bag_dir = os.path.abspath(bag_dir)
-    LOGGER.info(_("Creating bag for directory %s"), bag_dir)
-    _validate_bag_dir(bag_dir)
 
-    try:
-        # Create data directory and move existing items into it
+    if cache not in CACHE_POLICIES:
+        raise BagError(_("Unknown cache policy: %s") % cache)
+    if order not in HASH_ORDERS:
+        raise BagError(_("Unknown hashing order: %s") % order)
+    if device_processes is not None and device_processes <= 0:
+        raise BagError(_("The number of processes per device must be greater than 0"))
+    if start_method is not None and start_method not in START_METHODS:
+        raise BagError(_("Unknown start method: %s") % start_method)
+    if isinstance(profile, str) and profile not in PROFILE_MODES:
+        raise BagError(_("Unknown profile mode: %s") % profile)
+
+    hash_options = {
+        "executor": executor,
+        "cache": cache,
+        "throttle": throttle,
+        "order": order,
+        "device_processes": device_processes,
+        "start_method": start_method,
+    }
+
+    run_path = bag_dir if dest is None else os.path.abspath(dest)
+    planned = planned_workers(processes, executor, checksums, lambda: measure_tree(bag_dir))
+    recording = collect_metrics(metrics, "create", run_path, progress)
+    with recording as run, profiling(profile, run_path) as profiler, recording_events(events) as event_log, \
+            planned as (processes, executor):
+        progress = run.progress if profiler is None else profiler.observe(run.progress)
+        if event_log is not None:
+            progress = event_log.observe(progress)
+        hash_options["executor"] = executor
+        hash_options["progress"] = log_summaries(progress)
+        hash_options["profiler"] = profiler
+        hash_options["events"] = event_log
+        run.algorithms = list(get_hashers(checksums))
+        run.set_workers(processes, executor, start_method)
+
+        if dest is not None:
+            dest = os.path.abspath(dest)
+            LOGGER.info(_("Creating bag in %(dest)s from %(source)s"), {"dest": dest, "source": bag_dir})
+            created = _validate_copy_dirs(bag_dir, dest)
+            try:
+                _make_bag_pipelined(
+                    dest,
+                    bag_info,
+                    processes,
+                    checksums,
+                    encoding,
+                    source_dir=bag_dir,
+                    **hash_options
+                )
+            except Exception:
+                LOGGER.exception(_("An error occurred creating a bag in %s"), dest)
+                if created:
+                    shutil.rmtree(dest, ignore_errors=True)
+                raise
+
+            return Bag(dest)
+
+        LOGGER.info(_("Creating bag for directory %s"), bag_dir)
+        _validate_bag_dir(bag_dir, check_permissions=not pipeline)
+
+        if pipeline:
+            try:
+                _make_bag_pipelined(bag_dir, bag_info, processes, checksums, encoding, **hash_options)
+            except Exception:
+                LOGGER.exception(_("An error occurred creating a bag in %s"), bag_dir)
+                raise
+
+            return Bag(bag_dir)
+
+        # Change working directory to bag directory so helper functions work
+        old_dir = os.path.abspath(os.path.curdir)
+
+        try:
+            os.chdir(bag_dir)
+
+            # Create data directory and move existing items into it
+            with hash_options["progress"].phase("move"):
+                _move_into_data_dir(bag_dir)
+
+            tagmanifests = TagManifestBuilder(bag_dir, checksums, encoding="utf-8")
+
+            total_bytes, total_files = make_manifests(
+                "data",
+                processes,
+                algorithms=checksums,
+                encoding=encoding,
+                tagmanifests=tagmanifests,
+                **hash_options
+            )
+
+            with hash_options["progress"].phase("tag files"):
+                LOGGER.info(_("Creating bagit.txt"))
+                tagmanifests.write("bagit.txt", BAGIT_TXT.encode("utf-8"))
+
+                LOGGER.info(_("Creating bag-info.txt"))
+                bag_info = _make_bag_info(bag_info, total_bytes, total_files)
+                tagmanifests.write("bag-info.txt", format_tag_file(bag_info).encode("utf-8"))
+
+            with hash_options["progress"].phase("tag manifests"):
+                tagmanifests.save()
+
+        except Exception:
+            LOGGER.exception(_("An error occurred creating a bag in %s"), bag_dir)
+            raise
+
+        finally:
+            os.chdir(old_dir)
+
+        return Bag(bag_dir)
+
+
+def _make_bag_pipelined(
+    bag_dir, bag_info, processes, checksums, encoding, source_dir=None, events=None, **hash_options
+):
+    timer = PhaseTimer()
+    progress = as_progress(hash_options.get("progress"))
+    scan = SourceScan(bag_dir if source_dir is None else source_dir)
+
+    # Drop any algorithms hashlib does not support once, up front:
+    checksums = list(get_hashers(checksums))
+
+    def permissions():
+        found = scan.permissions()
+        if source_dir is not None:
+            # Copying only requires that the source can be read:
+            found["unwritable_dirs"] = found["unwritable_files"] = []
+        return found
+
+    def check_scan(event):
+        # Once the traversal has ended any permission problem is raised from
+        # the next progress update, which stops the remaining work:
+        if event.kind == "update" and scan.finished:
+            _report_directory_permissions(permissions())
+
+    hash_options["progress"] = observe(progress, check_scan)
+
+    if source_dir is not None:
         data_dir = os.path.join(bag_dir, "data")
-        if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
-
-        for item in os.listdir(bag_dir):
-            item_path = os.path.join(bag_dir, item)
-            if item_path != data_dir:
-                os.rename(item_path, os.path.join(data_dir, item))
-
-        total_bytes, total_files = make_manifests(
-            data_dir,
-            processes,
-            algorithms=checksums,
-            encoding=encoding
-        )
 
+        with timer.phase("copying"):
+            results = hash_payload(
+                source_dir,
+                scan.files(),
+                checksums,
+                processes,
+                dest_dir=data_dir,
+                **hash_options
+            )
+            for directory in scan.directories:
+                os.makedirs(os.path.join(data_dir, directory), exist_ok=True)
+
+        _report_directory_permissions(permissions())
+
+        existing_data_dir = False
+    else:
+        # Workers consume the traversal as it runs. Nothing is modified until it
+        # has finished, so permission problems still abort before any file moves:
+        with timer.phase("hashing"):
+            results = hash_payload(bag_dir, scan.files(), checksums, processes, **hash_options)
+
+        _report_directory_permissions(permissions())
+
+        with timer.phase("move"), progress.phase("move"):
+            existing_data_dir = os.path.isdir(os.path.join(bag_dir, "data"))
+            _move_into_data_dir(bag_dir)
+
+    manifest_data = {alg: [] for alg in checksums}
+    total_bytes = 0
+
+    for rel_path, digests, byte_count in results:
+        if not (existing_data_dir and rel_path.startswith("data/")):
+            rel_path = "data/" + rel_path
+        for alg, digest in digests.items():
+            manifest_data[alg].append((rel_path, digest))
+        total_bytes += byte_count
+        if events is not None:
+            events.file(rel_path, byte_count, digests)
+
+    tagmanifests = TagManifestBuilder(bag_dir, checksums, encoding="utf-8")
+
+    with timer.phase("manifests"), progress.phase("manifests"):
+        for alg, entries in manifest_data.items():
+            tagmanifests.write(f"manifest-{alg}.txt", format_manifest(entries, encoding))
+
+    with timer.phase("tag files"), progress.phase("tag files"):
         LOGGER.info(_("Creating bagit.txt"))
-        txt = """BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"""
-        bagit_file_path = os.path.join(bag_dir, "bagit.txt")
-        with open_text_file(bagit_file_path, "w") as bagit_file:
-            bagit_file.write(txt)
+        tagmanifests.write("bagit.txt", BAGIT_TXT.encode("utf-8"))
 
         LOGGER.info(_("Creating bag-info.txt"))
-        if bag_info is None:
-            bag_info = {}
-
-        # Allow 'Bagging-Date' and 'Bag-Software-Agent' to be overridden
-        if "Bagging-Date" not in bag_info:
-            bag_info["Bagging-Date"] = date.strftime(date.today(), "%Y-%m-%d")
-        if "Bag-Software-Agent" not in bag_info:
-            bag_info["Bag-Software-Agent"] = "bagit.py v%s <%s>" % (
-                get_version(),
-                PROJECT_URL,
-            )
+        bag_info = _make_bag_info(bag_info, total_bytes, len(results))
+        tagmanifests.write("bag-info.txt", format_tag_file(bag_info).encode("utf-8"))
+
+    with timer.phase("tag manifests"), progress.phase("tag manifests"):
+        tagmanifests.save()
+
+    timer.log_summary(bag_dir)
 
-        bag_info["Payload-Oxum"] = "%s.%s" % (total_bytes, total_files)
-        bag_info_file_path = os.path.join(bag_dir, "bag-info.txt")
-        make_tag_file(bag_info_file_path, bag_info)
 
-        for c in checksums:
-            make_tagmanifest_file(c, bag_dir, encoding="utf-8")
+def _move_into_data_dir(bag_dir):
+    data_dir = os.path.join(bag_dir, "data")
+    if not os.path.exists(data_dir):
+        os.mkdir(data_dir)
 
-    except Exception:
-        LOGGER.exception(_("An error occurred creating a bag in %s"), bag_dir)
-        raise
+    for item in os.listdir(bag_dir):
+        item_path = os.path.join(bag_dir, item)
+        if item_path != data_dir:
+            os.rename(item_path, os.path.join(data_dir, item))
 
-    return Bag(bag_dir)
 
+def _make_bag_info(bag_info, total_bytes, total_files):
+    if bag_info is None:
+        bag_info = {}
+
+    # Allow 'Bagging-Date' and 'Bag-Software-Agent' to be overridden
+    if "Bagging-Date" not in bag_info:
+        bag_info["Bagging-Date"] = date.strftime(date.today(), "%Y-%m-%d")
+    if "Bag-Software-Agent" not in bag_info:
+        bag_info["Bag-Software-Agent"] = "bagit.py v%s <%s>" % (
+            get_version(),
+            PROJECT_URL,
+        )
 
-def _validate_bag_dir(bag_dir):
+    bag_info["Payload-Oxum"] = "%s.%s" % (total_bytes, total_files)
+    return bag_info
+
+
+def _validate_bag_dir(bag_dir, check_permissions=True):
     if not os.path.isdir(bag_dir):
         LOGGER.error(_("Bag directory %s does not exist"), bag_dir)
         raise RuntimeError(_("Bag directory %s does not exist") % bag_dir)
     if os.path.abspath(os.getcwd()).startswith(bag_dir):
         raise RuntimeError(_("Bagging a parent of the current directory is not supported"))
-    _inspect_directory_permissions(bag_dir)
+    if check_permissions:
+        _inspect_directory_permissions(bag_dir)
     if not os.path.isdir(bag_dir):
         LOGGER.error(_("Bag directory %s does not exist"), bag_dir)
         raise RuntimeError(_("Bag directory %s does not exist") % bag_dir)
 
 
+def _validate_copy_dirs(source_dir, bag_dir):
+    """
+    Checks the source and destination for a copying make_bag and creates the
+    destination, returning True if it did not already exist
+    """
+    if not os.path.isdir(source_dir):
+        LOGGER.error(_("Bag directory %s does not exist"), source_dir)
+        raise RuntimeError(_("Bag directory %s does not exist") % source_dir)
+    if not os.access(source_dir, os.R_OK):
+        raise BagError(_("Read permissions are required to calculate file fixities"))
+    if os.path.commonpath([source_dir, bag_dir]) == source_dir:
+        raise RuntimeError(_("The destination of a bag cannot be inside its source directory"))
+
+    if not os.path.exists(bag_dir):
+        os.makedirs(os.path.join(bag_dir, "data"))
+        return True
+
+    if not os.path.isdir(bag_dir) or os.listdir(bag_dir):
+        raise RuntimeError(_("The bag destination %s must be an empty directory") % bag_dir)
+
+    os.mkdir(os.path.join(bag_dir, "data"))
+    return False
+
+
 def _set_checksums(checksum, checksums):
     if checksum is not None:
         warnings.warn(
@@ -109,7 +390,10 @@ def _set_checksums(checksum, checksums):
 
 
 def _inspect_directory_permissions(bag_dir):
-    permissions = _check_directory_permissions(bag_dir)
+    _report_directory_permissions(_check_directory_permissions(bag_dir))
+
+
+def _report_directory_permissions(permissions):
     if permissions["unreadable_dirs"] or permissions["unreadable_files"]:
         LOGGER.error(_("The following directories and files do not have read permissions:"))
         for path in permissions["unreadable_dirs"] + permissions["unreadable_files"]:
@@ -1,6 +1,180 @@
+import collections
+import os
+import queue
 import signal
 
+#: Number of items handed to a worker at a time
+WORKER_CHUNK_SIZE = 16
+
+#: Ways of starting worker processes (see multiprocessing.get_all_start_methods)
+START_METHODS = ("fork", "spawn", "forkserver")
+
+#: Modules the fork server imports once, so that the workers forked from it
+#: start with the hashing core loaded
+FORKSERVER_PRELOAD = ["bagit_modules.hashcore"]
+
 
 def posix_multiprocessing_worker_initializer():
     """Ignore SIGINT in multiprocessing workers on POSIX systems"""
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_pool_context(start_method=None):
+    """
+    Returns the multiprocessing context for start_method, the platform's
+    default if it is None, raising ValueError if it is not available
+    """
+    # Only imported when needed, as it is slow to import:
+    import multiprocessing
+
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return context
+
+
+def shares_process_state(processes=1, executor=None, start_method=None):
+    """
+    Returns whether the workers map_with_workers() would use for these
+    arguments run in this process or are forked from it, and so share its
+    state such as the logging configuration
+    """
+    if executor is not None:
+        # Process pools record how they start workers; others are threads:
+        context = getattr(executor, "_mp_context", None)
+        return context is None or context.get_start_method() == "fork"
+    if processes == 1:
+        return True
+    return get_pool_context(start_method).get_start_method() == "fork"
+
+
+def reaps_workers(processes=1, executor=None, start_method=None):
+    """
+    Returns whether the resource usage of the workers map_with_workers()
+    would use for these arguments is counted in this process's, as it is
+    for threads and for the children of a pool which is closed and joined
+    before it returns, but not for an executor's worker processes or for
+    the workers of a fork server, which are not this process's children
+    """
+    if executor is not None:
+        return getattr(executor, "_mp_context", None) is None
+    if processes == 1:
+        return True
+    return get_pool_context(start_method).get_start_method() != "forkserver"
+
+
+def map_with_workers(func, iterable, processes=1, executor=None, chunksize=WORKER_CHUNK_SIZE,
+                     initializer=None, initargs=(), start_method=None, on_result=None, profiler=None):
+    """
+    Returns a list of func applied to every item of iterable, in order.
+
+    If executor, any concurrent.futures.Executor, is provided the work is
+    submitted to it and it is left running so that callers can reuse a warm
+    pool for many bags. Otherwise a multiprocessing.Pool is started for this
+    call if processes is greater than 1 (0 or None uses one worker per CPU)
+    and the items are processed in this process if it is 1. iterable is
+    consumed lazily so that workers can start while it is still being
+    produced.
+
+    initializer replaces posix_multiprocessing_worker_initializer for a new
+    pool, and is not used with an executor or in this process. A new pool
+    starts its processes with start_method (see START_METHODS), by default
+    the platform's. If on_result is provided it is called in this process
+    with each result, in order, as soon as it is available. The workers
+    profile func if profiler, a profiling.Profiler, asks them to.
+    """
+    if profiler is not None:
+        func = profiler.wrap(func)
+
+    if executor is not None:
+        return _collect(executor.map(func, iterable, chunksize=chunksize), on_result)
+
+    if processes == 1:
+        return _collect((func(i) for i in iterable), on_result)
+
+    if initializer is None and os.name == "posix":
+        initializer = posix_multiprocessing_worker_initializer
+
+    context = get_pool_context(start_method)
+    with context.Pool(processes or None, initializer=initializer, initargs=initargs) as pool:
+        return _collect(pool.imap(func, iterable, chunksize=chunksize), on_result)
+
+
+def _collect(results, on_result):
+    if on_result is None:
+        return list(results)
+
+    collected = []
+    for result in results:
+        on_result(result)
+        collected.append(result)
+    return collected
+
+
+def map_by_group(func, groups, limit, processes=1, executor=None, initializer=None, initargs=(),
+                 start_method=None, on_result=None, profiler=None):
+    """
+    Returns a list of func applied to every item of every list in groups, in
+    order, running at most limit items of each group at once.
+
+    The groups take turns to start their items so that every group, such as
+    the files on one storage device, is kept busy. The workers are chosen as
+    for map_with_workers(), and limit has no effect when the items are
+    processed in this process. on_result is called in this process with
+    each result as soon as it is available, in the order they finish.
+    """
+    if profiler is not None:
+        func = profiler.wrap(func)
+
+    if executor is None and processes == 1:
+        return _collect((func(i) for group in groups for i in group), on_result)
+
+    if executor is not None:
+        def submit(item, done):
+            future = executor.submit(func, item)
+            future.add_done_callback(done)
+            return future.result
+
+        return _run_groups(submit, groups, limit, on_result)
+
+    if initializer is None and os.name == "posix":
+        initializer = posix_multiprocessing_worker_initializer
+
+    context = get_pool_context(start_method)
+    with context.Pool(processes or None, initializer=initializer, initargs=initargs) as pool:
+        def submit(item, done):
+            return pool.apply_async(func, (item,), callback=done, error_callback=done).get
+
+        return _run_groups(submit, groups, limit, on_result)
+
+
+def _run_groups(submit, groups, limit, on_result=None):
+    # submit(item, done) starts an item, arranges for done(result) to be
+    # called when it finishes and returns a function fetching its result
+    finished = queue.Queue()
+    waiting = [collections.deque(group) for group in groups]
+    running = [0] * len(waiting)
+    results = [[] for group in waiting]
+
+    def start(index):
+        # The getter is stored before this thread takes the item off the queue:
+        get_result = []
+        running[index] += 1
+        get_result.append(submit(waiting[index].popleft(), lambda result: finished.put((index, get_result))))
+        results[index].append(get_result)
+
+    # Fill every group up to the limit, one item from each group at a time:
+    for _round in range(limit):
+        for index, group in enumerate(waiting):
+            if group:
+                start(index)
+
+    while any(running):
+        index, get_result = finished.get()
+        running[index] -= 1
+        if on_result is not None:
+            on_result(get_result[0]())
+        if waiting[index]:
+            start(index)
+
+    return [get_result[0]() for group_results in results for get_result in group_results]
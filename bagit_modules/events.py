@@ -0,0 +1,91 @@
+"""
+A stream of machine-readable events for tools which need per-file records.
+
+make_bag(), Bag.save() and Bag.validate() accept events=, a filename, "-"
+for stdout, a writable text file or an EventLog, and append one JSON object
+per line to it: the start and end of each phase, the periodic progress
+updates and a record for every file hashed with its path relative to the
+bag, its size and its hex digests, or the error which stopped it being
+read. Unlike the log, the stream is meant to be parsed, so its records do
+not change with the log mode or the language.
+
+File records are written in the calling process as each hashing run
+finishes, not while its files are being read.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from bagit_modules.progress import observe
+
+
+class EventLog(object):
+    """Writes events as JSON lines to a file object"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, event, **fields):
+        record = {"event": event, "time": time.time()}
+        record.update(fields)
+        self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def file(self, path, size, digests=None, error=None):
+        """Records a file hashed: digests maps algorithms to raw or hex digests"""
+        fields = {"path": path, "bytes": size}
+        if error is not None:
+            fields["error"] = error
+        else:
+            fields["digests"] = {
+                alg: digest.hex() if isinstance(digest, bytes) else digest for alg, digest in digests.items()
+            }
+        self.write("file", **fields)
+
+    def observe(self, progress=None):
+        """
+        Returns a progress.Progress recording every event as a phase record
+        and passing it on to progress, a callback or Progress
+        """
+        def record(event):
+            self.write(
+                "phase",
+                kind=event.kind,
+                phase=event.phase,
+                files_done=event.files_done,
+                files_total=event.files_total,
+                bytes_done=event.bytes_done,
+                bytes_total=event.bytes_total,
+                elapsed=event.elapsed,
+                throughput=event.throughput,
+            )
+            if event.kind != "update":
+                self.stream.flush()
+
+        return observe(progress, record)
+
+
+@contextmanager
+def recording_events(events):
+    """
+    Yields an EventLog for events (see the module documentation), or None
+    if it is None, closing any file it opened when the block exits
+    """
+    if events is None or isinstance(events, EventLog):
+        yield events
+        return
+
+    if events == "-":
+        try:
+            yield EventLog(sys.stdout)
+        finally:
+            sys.stdout.flush()
+        return
+
+    if hasattr(events, "write"):
+        yield EventLog(events)
+        return
+
+    with open(events, "a", encoding="utf-8") as f:
+        yield EventLog(f)
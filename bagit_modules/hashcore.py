@@ -0,0 +1,262 @@
+"""
+The hashing core run by worker processes.
+
+With the spawn and forkserver start methods every worker is a fresh
+interpreter which imports the module of each function it is sent. The
+functions workers run therefore live here, apart from the rest of
+bagit_modules, and only import what reading and hashing files needs: not
+logging, gettext catalogs, multiprocessing or concurrent.futures. The
+parent only sends a per-file log message when the worker shares its logging
+configuration, and the logger is imported then.
+"""
+
+import errno
+import hashlib
+import io
+import mmap
+import os
+from array import array
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.concurrency import posix_multiprocessing_worker_initializer
+from bagit_modules.constants import HASH_BLOCK_SIZE
+from bagit_modules.string_ops import force_unicode
+
+#: Page cache policies for reading payload files: normal leaves caching to
+#: the kernel, drop advises sequential access and evicts each range from the
+#: page cache once it has been hashed, and direct bypasses the page cache with
+#: O_DIRECT where the filesystem supports it (falling back to drop otherwise)
+CACHE_POLICIES = ("normal", "drop", "direct")
+
+#: Bytes consumed between POSIX_FADV_DONTNEED calls under the drop policy
+CACHE_DROP_INTERVAL = 8 * 1024 * 1024
+
+#: Alignment of the offsets and sizes of O_DIRECT reads
+DIRECT_IO_ALIGNMENT = 4096
+
+_zeros = None
+
+
+def read_blocks(full_path, cache="normal", throttle=None):
+    """
+    Yields the contents of a file as memoryviews of up to HASH_BLOCK_SIZE
+    bytes, reading it according to the cache policy (see CACHE_POLICIES) and
+    waiting as needed to stay within the rates of throttle, if provided.
+    The blocks share one buffer, so each must be used before the next one is
+    requested.
+
+    The holes in sparse files are produced from a buffer of zeros instead of
+    being read, where the platform can find them with SEEK_DATA and
+    SEEK_HOLE, so only the allocated data costs any I/O.
+    """
+    if cache not in CACHE_POLICIES:
+        raise ValueError(_("Unknown cache policy: %s") % cache)
+
+    if throttle is not None:
+        throttle.file()
+
+    fd = None
+    direct = False
+    if cache == "direct" and hasattr(os, "O_DIRECT"):
+        try:
+            fd = os.open(full_path, os.O_RDONLY | os.O_DIRECT)
+            direct = True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    if fd is None:
+        fd = os.open(full_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    try:
+        if cache != "normal":
+            _fadvise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+        # Anonymous maps are page-aligned, as O_DIRECT requires:
+        buf = mmap.mmap(-1, HASH_BLOCK_SIZE) if direct else bytearray(HASH_BLOCK_SIZE)
+        view = memoryview(buf)
+        reader = io.FileIO(fd, closefd=False)
+        dropped = 0
+
+        for offset, length, is_data in _file_extents(fd):
+            if not is_data:
+                zeros = _zero_block()
+                while length:
+                    size = min(length, HASH_BLOCK_SIZE)
+                    yield zeros[:size]
+                    length -= size
+                continue
+
+            position = os.lseek(fd, offset, os.SEEK_SET)
+
+            while length is None or length > 0:
+                wanted = HASH_BLOCK_SIZE if length is None else min(length, HASH_BLOCK_SIZE)
+                if direct:
+                    # O_DIRECT reads must be whole blocks, even at the end:
+                    wanted = min(HASH_BLOCK_SIZE, -(-wanted // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT)
+
+                try:
+                    size = reader.readinto(view[:wanted])
+                except OSError as e:
+                    if not direct or e.errno != errno.EINVAL:
+                        raise
+                    # Some filesystems accept O_DIRECT when opening but not reading:
+                    import fcntl
+
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                    direct = False
+                    continue
+
+                if length is not None:
+                    size = min(size, length)
+                    length -= size
+                if not size:
+                    break
+
+                yield view[:size]
+                if throttle is not None:
+                    throttle.consume(size)
+
+                position += size
+                if cache == "drop" and position - dropped >= CACHE_DROP_INTERVAL:
+                    _fadvise(fd, dropped, position - dropped, "POSIX_FADV_DONTNEED")
+                    dropped = position
+
+        if cache != "normal" and not direct:
+            _fadvise(fd, dropped, 0, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
+
+
+def _file_extents(fd):
+    """
+    Yields (offset, length, is_data) tuples covering an open file. Files
+    which are not sparse, or whose holes cannot be found, are a single data
+    extent with a length of None, meaning that it runs to the end of the file.
+    """
+    st = os.fstat(fd)
+    allocated = getattr(st, "st_blocks", None)
+
+    if not hasattr(os, "SEEK_DATA") or allocated is None or allocated * 512 >= st.st_size:
+        yield 0, None, True
+        return
+
+    position = 0
+    while position < st.st_size:
+        try:
+            data = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole remains:
+                data = st.st_size
+            elif position == 0:
+                yield 0, None, True
+                return
+            else:
+                raise
+
+        data = min(data, st.st_size)
+        if data > position:
+            yield position, data - position, False
+        if data >= st.st_size:
+            return
+
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), st.st_size)
+        yield data, hole - data, True
+        position = hole
+
+
+def _zero_block():
+    """Returns a shared, read-only block of HASH_BLOCK_SIZE zero bytes"""
+    global _zeros
+    if _zeros is None:
+        _zeros = memoryview(bytes(HASH_BLOCK_SIZE))
+    return _zeros
+
+
+def _fadvise(fd, offset, length, advice):
+    """Calls posix_fadvise() where the platform provides it"""
+    advice = getattr(os, advice, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:  # The advice is optional, and some filesystems reject it
+        pass
+
+
+#: Path tables installed in this process, keyed by job id
+_tables = {}
+
+
+def install_table(job_id, table, worker=True):
+    """Pool initializer which makes a job's path table available to hash_range()"""
+    if worker and os.name == "posix":
+        posix_multiprocessing_worker_initializer()
+    _tables[job_id] = table
+
+
+def remove_table(job_id):
+    _tables.pop(job_id, None)
+
+
+def hash_range(args):
+    """Hashes paths[start:stop] of an installed path table"""
+    job_id, start, stop = args
+    base_dir, paths, algorithms, message, cache, throttle = _tables[job_id]
+    return hash_batch((base_dir, paths[start:stop], algorithms, message, cache, throttle))
+
+
+def hash_batch(args):
+    """
+    Hashes a list of paths relative to base_dir, returning a tuple of the
+    concatenated raw digests for every file and algorithm (zero-filled for
+    files which could not be read), an array of the file sizes and a
+    {batch offset: error message} dictionary. Files are read following the
+    cache policy (see CACHE_POLICIES) within the limits of throttle, which
+    may be None, and message, a (level, message) tuple, is logged for each
+    file unless it is None.
+    """
+    base_dir, paths, algorithms, message, cache, throttle = args
+    digests = bytearray()
+
+    if throttle is not None:
+        throttle.enter_worker()
+    sizes = array("q")
+    errors = {}
+
+    # The algorithms were checked by the parent, and copying fresh hashers
+    # is cheaper than looking them up again:
+    prototypes = [hashlib.new(alg) for alg in algorithms]
+
+    logger = None
+    if message is not None:
+        from bagit_modules.logging import LOGGER as logger
+
+        level, message = message
+
+    for offset, rel_path in enumerate(paths):
+        full_path = os.path.join(base_dir, rel_path)
+        if logger is not None:
+            logger.log(level, message, full_path)
+
+        hashers = [i.copy() for i in prototypes]
+        total_bytes = 0
+        try:
+            for block in read_blocks(full_path, cache, throttle):
+                total_bytes += len(block)
+                for hasher in hashers:
+                    hasher.update(block)
+        except (OSError, IOError) as e:
+            errors[offset] = _("Could not read %(filename)s: %(error)s") % {
+                "filename": full_path,
+                "error": force_unicode(e),
+            }
+            for hasher in hashers:
+                digests += bytes(hasher.digest_size)
+        else:
+            for hasher in hashers:
+                digests += hasher.digest()
+
+        sizes.append(total_bytes)
+
+    return bytes(digests), sizes, errors
@@ -1,11 +1,12 @@
 import hashlib
 import os
+import time
 
 from bagit_modules.translation_catalog import _
 from bagit_modules.constants import HASH_BLOCK_SIZE
 from bagit_modules.string_ops import force_unicode
 from bagit_modules.errors import BagValidationError
-from bagit_modules.logging import LOGGER
+from bagit_modules.logging import LOGGER, file_log_level
 
 
 def calc_hashes(args):
@@ -61,12 +62,175 @@ def get_hashers(algorithms):
     return hashers
 
 
+#: Algorithms bags commonly use, strongest first, for the "strongest" policy
+ALGORITHM_STRENGTH = [
+    "sha512",
+    "sha3_512",
+    "blake2b",
+    "sha384",
+    "sha3_384",
+    "sha256",
+    "sha3_256",
+    "blake2s",
+    "sha224",
+    "sha3_224",
+    "sha1",
+    "md5",
+]
+
+#: Policies accepted by select_algorithms() besides an explicit list
+ALGORITHM_POLICIES = ("all", "strongest", "fastest")
+
+#: Bytes hashed per algorithm when measuring throughput
+THROUGHPUT_SAMPLE_SIZE = 1024 * 1024
+
+#: Throughput in bytes per second measured on this machine, per algorithm
+_throughput = {}
+
+
+def hash_throughput(algorithms):
+    """
+    Returns {algorithm: bytes per second} for this machine. Each algorithm is
+    measured once per process, on a buffer held in memory, so the result
+    reflects the CPU and hashlib build rather than any storage.
+    """
+    sample = None
+
+    for alg in algorithms:
+        if alg in _throughput:
+            continue
+        if sample is None:
+            sample = bytes(THROUGHPUT_SAMPLE_SIZE)
+
+        try:
+            hashlib.new(alg)
+        except ValueError:
+            continue
+
+        best = None
+        for _attempt in range(3):
+            hasher = hashlib.new(alg)
+            started = time.perf_counter()
+            hasher.update(sample)
+            hasher.digest()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        _throughput[alg] = THROUGHPUT_SAMPLE_SIZE / max(best, 1e-9)
+        LOGGER.debug(_("Measured %(algorithm)s throughput at %(rate).0f MB/s"), {
+            "algorithm": alg, "rate": _throughput[alg] / 1e6
+        })
+
+    return {alg: _throughput[alg] for alg in algorithms if alg in _throughput}
+
+
+def select_algorithms(algorithms, policy="all"):
+    """
+    Chooses which of the available algorithms to verify according to policy:
+
+    all
+        every algorithm, the default
+    strongest
+        the single strongest algorithm, ranked by ALGORITHM_STRENGTH
+    fastest
+        the single algorithm with the highest throughput on this machine
+    a list, or a comma-separated string, of algorithm names
+        those of the listed algorithms which are available
+
+    Raises ValueError for an unknown policy or if none of the listed
+    algorithms are available.
+    """
+    algorithms = list(algorithms)
+
+    if policy is None or policy == "all":
+        return algorithms
+
+    if isinstance(policy, str) and policy not in ALGORITHM_POLICIES:
+        policy = [i.strip() for i in policy.split(",") if i.strip()]
+
+    if policy == "strongest":
+        def strength(alg):
+            return ALGORITHM_STRENGTH.index(alg) if alg in ALGORITHM_STRENGTH else len(ALGORITHM_STRENGTH)
+
+        return sorted(algorithms, key=strength)[:1]
+
+    if policy == "fastest":
+        throughput = hash_throughput(algorithms)
+        if not throughput:
+            return algorithms[:1]
+        return [max(throughput, key=throughput.get)]
+
+    if isinstance(policy, str) or not policy:
+        raise ValueError(_("Unknown algorithm selection policy: %s") % policy)
+
+    selected = [i for i in policy if i in algorithms]
+    for alg in policy:
+        if alg not in algorithms:
+            LOGGER.warning(_("Ignoring requested algorithm %s: it is not available"), alg)
+    if not selected:
+        raise ValueError(
+            _("None of the requested algorithms (%s) are available") % ", ".join(policy)
+        )
+    return selected
+
+
+def hash_file(full_path, algorithms):
+    """
+    Reads a file once, feeding every block to a fresh hasher for each algorithm.
+    Returns a ({algorithm: hexdigest}, byte count) tuple.
+    """
+    with open(full_path, "rb") as f:
+        return hash_stream(f, algorithms)
+
+
+def hash_stream(fileobj, algorithms):
+    """Like hash_file() for a binary file object which is read to the end"""
+    hashers = get_hashers(algorithms)
+    total_bytes = 0
+
+    for block in iter(lambda: fileobj.read(HASH_BLOCK_SIZE), b''):
+        total_bytes += len(block)
+        for hasher in hashers.values():
+            hasher.update(block)
+
+    return {alg: h.hexdigest() for alg, h in hashers.items()}, total_bytes
+
+
+def hash_bytes(data, algorithms):
+    """Returns {algorithm: hexdigest} for an in-memory byte string"""
+    hashers = get_hashers(algorithms)
+    for hasher in hashers.values():
+        hasher.update(data)
+    return {alg: h.hexdigest() for alg, h in hashers.items()}
+
+
+class HashingWriter(object):
+    """
+    Binary file wrapper which feeds every byte written through it to a set of
+    hashers, so a file's digests are known without reading it back from disk
+    """
+
+    def __init__(self, fileobj, algorithms):
+        self.fileobj = fileobj
+        self.hashers = get_hashers(algorithms)
+
+    def write(self, data):
+        self.fileobj.write(data)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self):
+        return {alg: h.hexdigest() for alg, h in self.hashers.items()}
+
+
 def _calculate_file_hashes(full_path, f_hashers):
     """
     Returns a dictionary of (algorithm, hexdigest) values for the provided
     filename
     """
-    LOGGER.info(_("Verifying checksum for file %s"), full_path)
+    log_level = file_log_level()
+    if LOGGER.isEnabledFor(log_level):
+        LOGGER.log(log_level, _("Verifying checksum for file %s"), full_path)
 
     hashers = list(f_hashers.values())  # Get hashers once before the loop
 
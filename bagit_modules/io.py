@@ -38,7 +38,7 @@ def find_tag_files(bag_dir):
         full_path = os.path.join(bag_dir, item)
         if item != "data" and os.path.isfile(full_path) and not item.startswith("tagmanifest-"):
             yield item
-        elif os.path.isdir(full_path):
+        elif item != "data" and os.path.isdir(full_path):
             for dir_name, _, filenames in os.walk(full_path):
                 for filename in filenames:
                     if not filename.startswith("tagmanifest-"):
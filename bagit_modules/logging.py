@@ -1,9 +1,38 @@
 import logging
 
 from bagit_modules.module import MODULE_NAME
+from bagit_modules.translation_catalog import _
 
 LOGGER = logging.getLogger(MODULE_NAME)
 
+#: How the files being hashed are logged: "file" logs a line for each file
+#: at INFO, while "summary" logs those lines at DEBUG and a summary of the
+#: progress at INFO every SUMMARY_INTERVAL seconds
+LOG_MODES = ("file", "summary")
+
+#: Seconds between two progress summaries
+SUMMARY_INTERVAL = 10.0
+
+_log_mode = "file"
+
+
+def set_log_mode(mode):
+    """Chooses how the files being hashed are logged (see LOG_MODES)"""
+    global _log_mode
+
+    if mode not in LOG_MODES:
+        raise ValueError(_("Unknown log mode: %s") % mode)
+    _log_mode = mode
+
+
+def get_log_mode():
+    return _log_mode
+
+
+def file_log_level():
+    """Returns the level at which a line is logged for each file hashed"""
+    return logging.DEBUG if _log_mode == "summary" else logging.INFO
+
 
 def configure_logging(opts):
     log_format = "%(asctime)s - %(levelname)s - %(message)s"
@@ -15,3 +44,4 @@ def configure_logging(opts):
         logging.basicConfig(filename=opts.log, level=level, format=log_format)
     else:
         logging.basicConfig(level=level, format=log_format)
+    set_log_mode(opts.log_mode)
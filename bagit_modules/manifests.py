@@ -1,83 +1,179 @@
 from collections import defaultdict
-from functools import partial
-import hashlib
-import multiprocessing
+from contextlib import contextmanager
 import os
 import re
 
 from bagit_modules.translation_catalog import _
 from bagit_modules.constants import HASH_BLOCK_SIZE, DEFAULT_CHECKSUMS
-from bagit_modules.hashing import get_hashers
+from bagit_modules.hashing import HashingWriter, get_hashers, hash_file
 from bagit_modules.filenames import encode_filename, decode_filename
 from bagit_modules.io import walk, find_tag_files, open_text_file
-from bagit_modules.logging import LOGGER
+from bagit_modules.errors import BagError
+from bagit_modules.logging import LOGGER, file_log_level
+from bagit_modules.pipeline import walk_order_key
+from bagit_modules.progress import as_progress
+from bagit_modules.workers import hash_files
+
+
+def make_manifests(data_dir, processes, algorithms=DEFAULT_CHECKSUMS, encoding="utf-8", tagmanifests=None,
+                   executor=None, cache="normal", throttle=None, order="path", device_processes=None,
+                   start_method=None, progress=None, profiler=None, events=None):
+    """
+    Hashes every file under data_dir and writes a manifest for each algorithm
+    into the current directory, returning the Payload-Oxum byte and file counts.
+
+    If a TagManifestBuilder is provided the manifests are written through it,
+    which records their digests as they are written. If an executor is
+    provided the files are hashed on it instead of a new pool of processes.
+    Files are read following the cache policy (see hashcore.CACHE_POLICIES)
+    within the limits of throttle, a throttle.Throttle, if one is provided,
+    and in order (see workers.HASH_ORDERS), with at most device_processes
+    workers reading from each device if it is given. A new pool starts its
+    processes with start_method, the hashing is reported to progress and the
+    workers are profiled by profiler if they are provided. Every file hashed
+    is recorded to events, an events.EventLog, if one is provided. The
+    manifests are always sorted by path.
+    """
+    if executor is not None:
+        LOGGER.info(_("Using %(executor)s to generate manifests: %(algorithms)s"),
+                    {"executor": type(executor).__name__, "algorithms": ", ".join(algorithms)})
+    else:
+        LOGGER.info(_("Using %(process_count)d processes to generate manifests: %(algorithms)s"),
+                    {"process_count": processes, "algorithms": ", ".join(algorithms)})
+
+    algorithms = list(get_hashers(algorithms))
+    filenames = list(walk(data_dir))
+    results = hash_files(
+        "",
+        filenames,
+        algorithms,
+        processes=processes,
+        executor=executor,
+        kind="create",
+        cache=cache,
+        throttle=throttle,
+        order=order,
+        device_processes=device_processes,
+        start_method=start_method,
+        progress=progress,
+        profiler=profiler,
+    )
 
+    manifest_data = defaultdict(list)
+    total_bytes = 0
 
-def make_manifests(data_dir, processes, algorithms=DEFAULT_CHECKSUMS, encoding="utf-8"):
-    LOGGER.info(_("Using %(process_count)d processes to generate manifests: %(algorithms)s"),
-                {"process_count": processes, "algorithms": ", ".join(algorithms)})
+    for filename, (digests, byte_count, error) in zip(filenames, results):
+        if events is not None:
+            file_digests = dict(zip(algorithms, digests)) if error is None else None
+            events.file(filename, byte_count, file_digests, error)
+        if error is not None:
+            raise BagError(error)
+        decoded_filename = decode_filename(filename)
+        for alg, digest in zip(algorithms, digests):
+            manifest_data[alg].append((digest.hex(), decoded_filename))
+        total_bytes += byte_count
+
+    with as_progress(progress).phase("manifests"):
+        for algorithm, values in manifest_data.items():
+            manifest_filename = f"manifest-{algorithm}.txt"
+            if tagmanifests is not None:
+                with tagmanifests.open(manifest_filename) as manifest:
+                    for digest, filename in values:
+                        manifest.write(f"{digest}  {encode_filename(filename)}\n".encode(encoding))
+            else:
+                with open_text_file(manifest_filename, "w", encoding=encoding) as manifest:
+                    for digest, filename in values:
+                        manifest.write(f"{digest}  {encode_filename(filename)}\n")
+
+    if not filenames:
+        LOGGER.warning(_("No files processed. Returning (0, 0) for bytes and file counts."))
 
-    manifest_line_generator = partial(generate_manifest_lines, algorithms=algorithms)
+    return total_bytes, len(filenames)
 
-    if processes > 1:
-        with multiprocessing.Pool(processes=processes) as pool:
-            checksums = pool.map(manifest_line_generator, walk(data_dir))
-    else:
-        checksums = map(manifest_line_generator, walk(data_dir))
 
-    manifest_data = defaultdict(list)
-    num_files = defaultdict(int)
-    total_bytes = defaultdict(int)
+def make_tagmanifest_file(alg, bag_dir, encoding="utf-8"):
+    builder = TagManifestBuilder(bag_dir, [alg], encoding=encoding)
+    builder.save()
 
-    for batch in checksums:
-        for alg, digest, filename, byte_count in batch:
-            manifest_data[alg].append((digest, filename))
-            num_files[alg] += 1
-            total_bytes[alg] += byte_count
 
-    # We'll use sets of the values for the error checks and eventually return the payload oxum values
-    byte_value_set = set(total_bytes.values())
-    file_count_set = set(num_files.values())
+class TagManifestBuilder(object):
+    """
+    Builds the tag manifests for every algorithm at once.
 
-    if len(byte_value_set) > 1:
-        raise RuntimeError(_("Expected the same number of bytes for each checksum"))
+    Each tag file is hashed a single time with a fresh set of hashers for all
+    of the algorithms. Tag files written through write() or open() are hashed
+    from the bytes as they are written, and digests already known for
+    unchanged files can be supplied through reuse(), so only the remaining tag
+    files need to be read from disk when save() is called.
+    """
 
-    if len(file_count_set) > 1:
-        raise RuntimeError(_("Expected the same number of files for each checksum"))
+    def __init__(self, bag_dir, algorithms, encoding="utf-8"):
+        self.bag_dir = bag_dir
+        self.algorithms = list(get_hashers(algorithms))
+        self.encoding = encoding
+        #: Maps tag file paths relative to bag_dir to {algorithm: hexdigest}
+        self.digests = {}
 
-    for algorithm, values in manifest_data.items():
-        with open_text_file(f"manifest-{algorithm}.txt", "w", encoding=encoding) as manifest:
-            for digest, filename in values:
-                manifest.write(f"{digest}  {encode_filename(filename)}\n")
+    @contextmanager
+    def open(self, filename):
+        """Opens a tag file for writing bytes, recording its digests when closed"""
+        with open(os.path.join(self.bag_dir, filename), "wb") as f:
+            writer = HashingWriter(f, self.algorithms)
+            yield writer
+        self.digests[filename] = writer.hexdigests()
 
-    if not byte_value_set or not file_count_set:
-        LOGGER.warning(_("No files processed. Returning (0, 0) for bytes and file counts."))
-        return 0, 0
+    def write(self, filename, data):
+        with self.open(filename) as f:
+            f.write(data)
 
-    return byte_value_set.pop(), file_count_set.pop()
+    def reuse(self, filename, digests):
+        """
+        Records previously computed digests for a tag file which has not
+        changed. They are ignored unless they cover every algorithm.
+        """
+        if all(alg in digests for alg in self.algorithms):
+            self.digests[filename] = {alg: digests[alg] for alg in self.algorithms}
 
+    def save(self):
+        """Writes the tag manifests, returning the digests of the files they list"""
+        tag_files = [f for f in find_tag_files(self.bag_dir) if not re.match(r"^tagmanifest-.+\.txt$", f)]
+
+        for f in tag_files:
+            if f not in self.digests:
+                self.digests[f], byte_count = hash_file(os.path.join(self.bag_dir, f), self.algorithms)
+
+        tag_digests = {f: self.digests[f] for f in tag_files}
+
+        for alg in self.algorithms:
+            tagmanifest_file = os.path.join(self.bag_dir, f"tagmanifest-{alg}.txt")
+            LOGGER.info(_("Creating %s"), tagmanifest_file)
+
+            with open(tagmanifest_file, "wb") as tagmanifest:
+                tagmanifest.write(format_tagmanifest(alg, tag_digests, self.encoding))
+
+        return tag_digests
 
-def make_tagmanifest_file(alg, bag_dir, encoding="utf-8"):
-    tagmanifest_file = os.path.join(bag_dir, f"tagmanifest-{alg}.txt")
-    LOGGER.info(_("Creating %s"), tagmanifest_file)
 
-    checksums = []
-    m = hashlib.new(alg)
+def format_manifest(entries, encoding="utf-8"):
+    """
+    Returns the contents of a payload manifest for (path, digest) entries,
+    sorted into the order in which make_manifests() walks the payload
+    """
+    entries = sorted(entries, key=lambda i: walk_order_key(i[0]))
+    return "".join(f"{digest}  {encode_filename(path)}\n" for path, digest in entries).encode(encoding)
 
-    for f in find_tag_files(bag_dir):
-        if not re.match(r"^tagmanifest-.+\.txt$", f):
-            with open(os.path.join(bag_dir, f), "rb") as fh:
-                for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
-                    m.update(block)
-            checksums.append((m.hexdigest(), f))
 
-    with open_text_file(os.path.join(bag_dir, tagmanifest_file), mode="w", encoding=encoding) as tagmanifest:
-        for digest, filename in checksums:
-            tagmanifest.write(f"{digest} {filename}\n")
+def format_tagmanifest(alg, tag_digests, encoding="utf-8"):
+    """Returns the contents of a tag manifest for {filename: {algorithm: hexdigest}}"""
+    return "".join(
+        f"{tag_digests[filename][alg]} {filename}\n" for filename in sorted(tag_digests)
+    ).encode(encoding)
 
 
 def generate_manifest_lines(filename, algorithms=DEFAULT_CHECKSUMS):
-    LOGGER.info(_("Generating manifest lines for file %s"), filename)
+    log_level = file_log_level()
+    if LOGGER.isEnabledFor(log_level):
+        LOGGER.log(log_level, _("Generating manifest lines for file %s"), filename)
 
     # For performance, we'll read the file only once and pass it block
     # by block to every requested hash algorithm:
@@ -0,0 +1,280 @@
+"""
+Machine-readable metrics for bag creation and validation.
+
+make_bag() and Bag.validate() accept metrics=, a filename or a MetricsFile,
+and record a FixityRun for the operation: the bytes and files hashed, the
+time spent in each phase and on each algorithm, the peak memory use, how
+busy the workers were and the errors found. The file is rewritten when the
+operation finishes, whether or not it succeeds, in JSON if its name ends in
+.json and otherwise in the Prometheus text format, ready for node-exporter's
+textfile collector.
+
+The workers' CPU time and peak memory use are read from this process's
+resource usage, which only counts worker processes once they have exited
+and been reaped. They are left out when the workers outlive the operation,
+as those of an executor supplied by the caller do, or are not this
+process's children, as with the forkserver start method.
+
+The figures are gathered from the progress events the operation reports
+anyway (see progress.py), so recording them adds nothing to the hashing
+itself. The workers hash every algorithm from the same blocks, so the time
+attributed to each algorithm is the hashing time divided in proportion to
+its measured cost (see hashing.hash_throughput()).
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from bagit_modules.concurrency import reaps_workers
+from bagit_modules.errors import BagValidationError, ChecksumMismatch, FileMissing, UnexpectedFile
+from bagit_modules.hashing import hash_throughput
+from bagit_modules.progress import as_progress, observe
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+#: Phases whose files and bytes count towards the totals read
+READ_PHASES = ("hashing", "copying")
+
+#: Error counts recorded for the details of a failed validation
+ERROR_TYPES = {
+    ChecksumMismatch: "checksum_mismatch",
+    FileMissing: "file_missing",
+    UnexpectedFile: "unexpected_file",
+}
+
+#: Descriptions of the Prometheus metrics
+METRIC_HELP = {
+    "bagit_success": "Whether the operation succeeded",
+    "bagit_start_time_seconds": "Unix time at which the operation started",
+    "bagit_duration_seconds": "Wall-clock duration of the operation",
+    "bagit_read_bytes": "Bytes of files read and hashed",
+    "bagit_hashed_files": "Number of files hashed",
+    "bagit_phase_duration_seconds": "Wall-clock duration of each phase of the operation",
+    "bagit_algorithm_duration_seconds": "Share of the hashing time spent on each algorithm",
+    "bagit_peak_rss_bytes": "Peak resident set size of the main process and of the largest worker process",
+    "bagit_workers": "Number of workers hashing files",
+    "bagit_worker_utilization_ratio": "CPU time used while hashing as a share of the workers' available time",
+    "bagit_errors": "Number of errors found, by type",
+}
+
+
+class FixityRun(object):
+    """
+    The measurements of one operation on a bag.
+
+    Its progress, a progress.Progress, must be given to the operation; it
+    passes every event on to the caller's own progress callback, if any.
+    """
+
+    def __init__(self, operation, path, progress=None):
+        self.operation = operation
+        self.path = path
+        self.algorithms = []
+        self.workers = 1
+        self.workers_reaped = True
+        self.success = None
+        self.started = time.time()
+        self.duration = 0.0
+        self.bytes_read = 0
+        self.files_hashed = 0
+        self.phases = {}
+        self.errors = {}
+        self.peak_rss = {}
+        self.worker_utilization = None
+
+        self._busy = 0.0
+        self._read_seconds = 0.0
+        self._cpu_started = None
+        self._clock_started = time.monotonic()
+
+        self.progress = observe(progress, self._observe)
+
+    def set_workers(self, processes, executor=None, start_method=None):
+        """Records the number and kind of workers the operation hashes with"""
+        if executor is not None:
+            self.workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+        else:
+            self.workers = processes or os.cpu_count() or 1
+        self.workers_reaped = reaps_workers(processes, executor, start_method)
+
+    def finish(self, error=None):
+        """Records the end of the operation, and the error which ended it if it failed"""
+        self.duration = time.monotonic() - self._clock_started
+        self.success = error is None
+
+        if isinstance(error, BagValidationError) and error.details:
+            for detail in error.details:
+                key = ERROR_TYPES.get(type(detail), "invalid")
+                self.errors[key] = self.errors.get(key, 0) + 1
+        elif isinstance(error, BagValidationError):
+            self.errors["invalid"] = 1
+        elif error is not None:
+            self.errors["error"] = 1
+
+        if resource is not None:
+            # ru_maxrss is in kilobytes, except on macOS where it is in bytes:
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak_rss["main"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+            if self.workers_reaped:
+                self.peak_rss["workers"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+        if self._read_seconds and self.workers_reaped:
+            self.worker_utilization = min(1.0, self._busy / (self._read_seconds * self.workers))
+
+    @property
+    def algorithm_seconds(self):
+        """Returns {algorithm: seconds}, dividing the hashing time by each algorithm's cost"""
+        read_seconds = sum(self.phases.get(i, 0.0) for i in READ_PHASES)
+        rates = hash_throughput(self.algorithms) if read_seconds else {}
+        costs = {alg: 1.0 / rate for alg, rate in rates.items()}
+        total = sum(costs.values())
+        return {alg: read_seconds * cost / total for alg, cost in costs.items()}
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "bag": self.path,
+            "success": self.success,
+            "started": self.started,
+            "duration_seconds": self.duration,
+            "bytes_read": self.bytes_read,
+            "files_hashed": self.files_hashed,
+            "phase_seconds": dict(self.phases),
+            "algorithm_seconds": self.algorithm_seconds,
+            "peak_rss_bytes": dict(self.peak_rss),
+            "workers": self.workers,
+            "worker_utilization": self.worker_utilization,
+            "errors": dict(self.errors),
+        }
+
+    def _observe(self, event):
+        if event.phase in READ_PHASES:
+            if event.kind == "start":
+                self._cpu_started = _cpu_seconds()
+            elif event.kind == "end":
+                self.bytes_read += event.bytes_done
+                self.files_hashed += event.files_done
+                self._read_seconds += event.elapsed
+                if self._cpu_started is not None:
+                    self._busy += _cpu_seconds() - self._cpu_started
+
+        if event.kind == "end":
+            self.phases[event.phase] = self.phases.get(event.phase, 0.0) + event.elapsed
+
+
+class MetricsFile(object):
+    """
+    A file holding the metrics of every run recorded to it, rewritten in
+    full after each one so that readers never see a partial file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.runs = []
+
+    def add(self, run):
+        self.runs.append(run)
+        self.write()
+
+    def write(self):
+        if self.path.endswith(".json"):
+            data = json.dumps([run.as_dict() for run in self.runs], indent=2, sort_keys=True) + "\n"
+        else:
+            data = format_prometheus(self.runs)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".bagit-metrics-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+@contextmanager
+def collect_metrics(metrics, operation, path, progress=None):
+    """
+    Yields a FixityRun for an operation on the bag at path, adding it to
+    metrics, a filename or MetricsFile, when the block exits. If metrics is
+    None the run only passes progress on and nothing is written.
+    """
+    run = FixityRun(operation, path, progress)
+    if metrics is None:
+        run.progress = as_progress(progress)
+        yield run
+        return
+
+    if not isinstance(metrics, MetricsFile):
+        metrics = MetricsFile(metrics)
+
+    try:
+        yield run
+    except Exception as e:
+        run.finish(e)
+        metrics.add(run)
+        raise
+    run.finish()
+    metrics.add(run)
+
+
+def format_prometheus(runs):
+    """Returns the metrics of runs in the Prometheus text exposition format"""
+    samples = {}
+
+    def sample(name, labels, value):
+        if value is not None:
+            samples.setdefault(name, []).append((labels, value))
+
+    for run in runs:
+        labels = {"operation": run.operation, "bag": run.path}
+        sample("bagit_success", labels, int(bool(run.success)))
+        sample("bagit_start_time_seconds", labels, run.started)
+        sample("bagit_duration_seconds", labels, run.duration)
+        sample("bagit_read_bytes", labels, run.bytes_read)
+        sample("bagit_hashed_files", labels, run.files_hashed)
+        for phase, seconds in run.phases.items():
+            sample("bagit_phase_duration_seconds", dict(labels, phase=phase), seconds)
+        for alg, seconds in run.algorithm_seconds.items():
+            sample("bagit_algorithm_duration_seconds", dict(labels, algorithm=alg), seconds)
+        for process, byte_count in run.peak_rss.items():
+            sample("bagit_peak_rss_bytes", dict(labels, process=process), byte_count)
+        sample("bagit_workers", labels, run.workers)
+        sample("bagit_worker_utilization_ratio", labels, run.worker_utilization)
+        for error_type in list(ERROR_TYPES.values()) + ["invalid", "error"]:
+            sample("bagit_errors", dict(labels, type=error_type), run.errors.get(error_type, 0))
+
+    lines = []
+    for name, values in samples.items():
+        lines.append("# HELP %s %s" % (name, METRIC_HELP[name]))
+        lines.append("# TYPE %s gauge" % name)
+        for labels, value in values:
+            label_text = ",".join('%s="%s"' % (k, _escape_label(v)) for k, v in labels.items())
+            lines.append("%s{%s} %s" % (name, label_text, _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def _cpu_seconds():
+    if resource is None:
+        return time.process_time()
+    usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return sum(i.ru_utime + i.ru_stime for i in usage)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
@@ -1,11 +1,17 @@
 import argparse
 import re
 
+from bagit_modules.concurrency import START_METHODS
 from bagit_modules.constants import DEFAULT_CHECKSUMS
 from bagit_modules.docs import read_global_docs
+from bagit_modules.hashcore import CACHE_POLICIES
+from bagit_modules.profiling import PROFILE_MODES
 from bagit_modules.hashing import CHECKSUM_ALGOS
+from bagit_modules.throttle import io_priority
+from bagit_modules.logging import LOG_MODES
 from bagit_modules.translation_catalog import _
 from bagit_modules.versioning import get_version
+from bagit_modules.workers import HASH_ORDERS
 from bagit_modules.constants import STANDARD_BAG_INFO_HEADERS
 
 
@@ -14,6 +20,49 @@ class BagArgumentParser(argparse.ArgumentParser):
         argparse.ArgumentParser.__init__(self, *args, **kwargs)
         self.set_defaults(bag_info={})
 
+    def format_help(self):
+        # The version and documentation are only looked up for --help:
+        if self.description is None:
+            self.description = "bagit-python version %s\n\n%s\n" % (get_version(), read_global_docs().strip())
+        return argparse.ArgumentParser.format_help(self)
+
+
+def parse_byte_rate(value):
+    """Parses a number of bytes with an optional K, M, G or T (powers of 1024) suffix"""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$", value, re.IGNORECASE)
+    if not match or not float(match.group(1)):
+        raise argparse.ArgumentTypeError(_("Invalid byte rate: %s") % value)
+    return float(match.group(1)) * 1024 ** " KMGT".index(match.group(2).upper() or " ")
+
+
+def parse_processes(value):
+    """Parses a number of processes, or "auto" to let the planner choose"""
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(_("Invalid number of processes: %s") % value)
+
+
+def parse_ionice(value):
+    """Parses an I/O scheduling class, optionally followed by ":" and a level"""
+    try:
+        io_priority(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def parse_file_rate(value):
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        raise argparse.ArgumentTypeError(_("Invalid file rate: %s") % value)
+    return rate
+
 
 class BagHeaderAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -23,20 +72,150 @@ class BagHeaderAction(argparse.Action):
 
 
 def make_parser():
-    parser = BagArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        description="bagit-python version %s\n\n%s\n" % (get_version(), read_global_docs().strip()),
-    )
+    parser = BagArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
         "--processes",
-        type=int,
+        type=parse_processes,
         dest="processes",
         default=1,
         help=_(
-            "Use multiple processes to calculate checksums faster (default: %(default)s)"
+            "Use multiple processes to calculate checksums faster, or auto to"
+            " choose between processes, threads and a single process to suit"
+            " the size of the payload (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--device-processes",
+        type=int,
+        metavar="N",
+        help=_(
+            "Use at most this many processes to read from each storage device"
+            " at once, spreading them across every device the payload spans"
+        ),
+    )
+    parser.add_argument(
+        "--start-method",
+        choices=START_METHODS,
+        help=_(
+            "How worker processes are started (default: the platform's"
+            " default). spawn and forkserver workers only import the hashing"
+            " code, which starts them faster than importing all of bagit"
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=_(
+            "Traverse the payload only once, overlapping hashing with the"
+            " filesystem walk, and report the time spent in each phase"
+        ),
+    )
+    parser.add_argument(
+        "--destination",
+        help=_(
+            "Leave the source directory untouched and create the bag in this"
+            " directory instead, hashing each file as it is copied"
+        ),
+    )
+    parser.add_argument(
+        "--archive",
+        help=_(
+            "Leave the source directory untouched and write the bag straight"
+            " into this tar (.tar, .tar.gz, .tar.bz2, .tar.xz) or zip file"
+        ),
+    )
+    parser.add_argument(
+        "--cache",
+        choices=CACHE_POLICIES,
+        default="normal",
+        help=_(
+            "How payload files are read: normal leaves the page cache to the"
+            " kernel, drop evicts each file from the page cache once it has"
+            " been hashed and direct bypasses it with O_DIRECT"
+            " (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--order",
+        choices=HASH_ORDERS,
+        default="path",
+        help=_(
+            "The order in which payload files are read: path as listed, inode"
+            " by inode number or physical by their position on disk, which"
+            " reduces seeking on spinning disks (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--max-bytes-per-second",
+        type=parse_byte_rate,
+        metavar="RATE",
+        help=_(
+            "Limit the combined rate at which all processes read payload"
+            " files, in bytes per second with an optional K, M, G or T suffix"
+        ),
+    )
+    parser.add_argument(
+        "--max-files-per-second",
+        type=parse_file_rate,
+        metavar="RATE",
+        help=_("Limit the combined rate at which all processes open payload files"),
+    )
+    parser.add_argument(
+        "--nice",
+        type=int,
+        help=_("Lower the CPU priority of this process and its workers by this increment"),
+    )
+    parser.add_argument(
+        "--ionice",
+        type=parse_ionice,
+        metavar="CLASS[:LEVEL]",
+        help=_(
+            "Set the I/O scheduling class of this process and its workers: idle,"
+            " best-effort or realtime, optionally followed by a level from 0"
+            " to 7 (Linux only)"
         ),
     )
     parser.add_argument("--log", help=_("The name of the log file (default: stdout)"))
+    parser.add_argument(
+        "--log-mode",
+        choices=LOG_MODES,
+        default="file",
+        help=_(
+            "file logs a line for every file hashed; summary logs those lines"
+            " only at DEBUG and the progress of hashing every few seconds"
+            " (default: file)"
+        ),
+    )
+    parser.add_argument(
+        "--events",
+        metavar="FILE",
+        help=_(
+            "Append a JSON object for every phase and every file hashed to"
+            " FILE, or to stdout if FILE is -"
+        ),
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help=_(
+            "Write the metrics of every bag created or validated to FILE: JSON"
+            " if its name ends in .json, otherwise the Prometheus text format"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=_("Log the time taken by each phase of creating or validating every bag"),
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=PROFILE_MODES,
+        help=_(
+            "What --profile records: phases, or cprofile to also profile this"
+            " process and every worker merged into one report (default:"
+            " phases). Implies --profile"
+        ),
+    )
     parser.add_argument(
         "--quiet",
         action="store_true",
@@ -46,8 +225,8 @@ def make_parser():
         "--validate",
         action="store_true",
         help=_(
-            "Validate existing bags in the provided directories instead of"
-            " creating new ones"
+            "Validate existing bags in the provided directories, or tar and zip"
+            " files, instead of creating new ones"
         ),
     )
     parser.add_argument(
@@ -68,6 +247,15 @@ def make_parser():
             " without performing checksum validation to detect corruption."
         ),
     )
+    parser.add_argument(
+        "--algorithms",
+        metavar="POLICY",
+        help=_(
+            "Modify --validate behaviour to verify only some of the manifests:"
+            " all (the default), strongest, fastest on this machine, or a"
+            " comma-separated list of algorithms such as sha256,sha512"
+        ),
+    )
 
     checksum_args = parser.add_argument_group(
         _("Checksum Algorithms"),
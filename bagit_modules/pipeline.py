@@ -0,0 +1,353 @@
+"""
+Single-pass bag creation and validation.
+
+For creation the source directory is traversed exactly once: the traversal
+records any permission problems and feeds every readable file straight to the
+hashing workers as it is discovered. Manifests, Payload-Oxum and tag manifests
+are then produced from the results held in memory instead of walking the
+payload again or reading the tag files back from disk.
+
+When copying from a separate, possibly read-only, source directory each file
+is hashed while it is copied so the source is read only once.
+
+For validation the manifest entries are hashed immediately while a background
+thread walks and stats the payload directory, so completeness and Payload-Oxum
+are checked from the same metadata walk without delaying the first hash.
+"""
+
+import itertools
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.concurrency import WORKER_CHUNK_SIZE, map_by_group, map_with_workers, shares_process_state
+from bagit_modules.errors import BagError
+from bagit_modules.hashcore import hash_batch, read_blocks
+from bagit_modules.hashing import get_hashers
+from bagit_modules.logging import LOGGER, file_log_level
+from bagit_modules.progress import as_progress
+from bagit_modules.throttle import install_throttle
+from bagit_modules.workers import (
+    group_by_device,
+    hash_files,
+    linked_inode,
+    log_message,
+    sort_paths,
+    unpack_batches,
+)
+
+#: Linux ioctl request number used to reflink one file to another
+FICLONE = 0x40049409
+
+
+class SourceScan(object):
+    """
+    Walks a directory once, yielding the readable files while recording the
+    entries which do not have the permissions needed to bag them in place
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        #: Relative paths of every directory seen, including empty ones
+        self.directories = []
+        self.unreadable_dirs = []
+        self.unwritable_dirs = []
+        self.unreadable_files = []
+        self.unwritable_files = []
+        #: Whether the traversal has ended, and so found every permission problem
+        self.finished = False
+
+    def files(self):
+        """Yields the relative paths of readable files in deterministic order"""
+        for dir_path, dir_names, filenames in os.walk(self.directory):
+            dir_names.sort()
+            filenames.sort()
+
+            for dn in dir_names:
+                full_path = os.path.join(dir_path, dn)
+                self.directories.append(os.path.relpath(full_path, self.directory))
+                if not os.access(full_path, os.R_OK):
+                    self.unreadable_dirs.append(full_path)
+                if not os.access(full_path, os.W_OK):
+                    self.unwritable_dirs.append(full_path)
+
+            for fn in filenames:
+                full_path = os.path.join(dir_path, fn)
+                readable = os.access(full_path, os.R_OK)
+                if not readable:
+                    self.unreadable_files.append(full_path)
+                if not os.access(full_path, os.W_OK):
+                    self.unwritable_files.append(full_path)
+                if readable:
+                    rel_path = os.path.relpath(full_path, self.directory)
+                    yield rel_path.replace(os.path.sep, "/")
+
+        self.finished = True
+
+    def permissions(self):
+        return {
+            "unreadable_dirs": self.unreadable_dirs,
+            "unwritable_dirs": self.unwritable_dirs,
+            "unreadable_files": self.unreadable_files,
+            "unwritable_files": self.unwritable_files,
+        }
+
+
+class BackgroundStatWalk(threading.Thread):
+    """
+    Walks a directory tree in a background thread, recording the path of
+    every file relative to base_dir along with its size
+    """
+
+    def __init__(self, base_dir, directory):
+        super(BackgroundStatWalk, self).__init__(name="bagit-stat-walk", daemon=True)
+        self.base_dir = base_dir
+        self.directory = directory
+        #: List of (relative path, size in bytes) tuples
+        self.files = []
+        self.elapsed = 0.0
+        self.error = None
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            for dir_path, dir_names, filenames in os.walk(self.directory):
+                for fn in filenames:
+                    full_path = os.path.join(dir_path, os.path.normpath(fn))
+                    rel_path = os.path.relpath(full_path, start=self.base_dir)
+                    self.files.append((rel_path, os.stat(full_path).st_size))
+        except Exception as e:  # Re-raised in the calling thread by results()
+            self.error = e
+        finally:
+            self.elapsed = time.perf_counter() - started
+
+    def results(self):
+        """Waits for the walk to finish and returns the collected files"""
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.files
+
+
+def copy_payload_file(
+    rel_path, base_dir, dest_dir, algorithms, cache="normal", throttle=None, log_level=None
+):
+    """
+    Copies a single file from base_dir to dest_dir, hashing it on the way.
+
+    Where the filesystem supports it the copy is a reflink, which shares the
+    source's extents without copying any data, and the source is then read
+    once for hashing. Otherwise each block is hashed and written out from the
+    same buffer. Either way the source is read exactly once, following the
+    cache policy within the limits of throttle, which may be None. The file
+    is logged at log_level, by default logging.file_log_level().
+
+    Returns (rel_path, {algorithm: hexdigest}, byte count).
+    """
+    if log_level is None:
+        log_level = file_log_level()
+    if LOGGER.isEnabledFor(log_level):
+        LOGGER.log(log_level, _("Copying and generating manifest lines for file %s"), rel_path)
+
+    if throttle is not None:
+        throttle.enter_worker()
+
+    src_path = os.path.join(base_dir, rel_path)
+    dest_path = os.path.join(dest_dir, rel_path)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+
+    hashers = list(get_hashers(algorithms).items())
+    total_bytes = 0
+
+    with open(dest_path, "wb") as dest:
+        with open(src_path, "rb") as src:
+            cloned = _reflink(src, dest)
+
+        for block in read_blocks(src_path, cache, throttle):
+            total_bytes += len(block)
+            for alg, hasher in hashers:
+                hasher.update(block)
+            if not cloned:
+                dest.write(block)
+
+    shutil.copystat(src_path, dest_path)
+
+    return rel_path, {alg: h.hexdigest() for alg, h in hashers}, total_bytes
+
+
+def _reflink(src, dest):
+    """Attempts to reflink src to dest, returning True if it succeeded"""
+    try:
+        import fcntl
+
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def hash_payload(
+    base_dir,
+    rel_paths,
+    algorithms,
+    processes,
+    dest_dir=None,
+    executor=None,
+    cache="normal",
+    throttle=None,
+    order="path",
+    device_processes=None,
+    start_method=None,
+    progress=None,
+    profiler=None,
+):
+    """
+    Hashes every file produced by the rel_paths iterable, which is consumed
+    lazily so that workers start hashing while the traversal is still running.
+    Results are returned in the order the paths were produced, and hard
+    links to a file which has already been hashed are not read again.
+
+    If dest_dir is provided each file is also copied there as it is hashed.
+    The work is run on executor if one is provided, and files are read
+    following the cache policy within the limits of throttle, if provided.
+    Any order (see workers.HASH_ORDERS) other than "path", and limiting the
+    workers reading from each device to device_processes, require the whole
+    traversal to finish before hashing starts. A new pool starts its
+    processes with start_method (see concurrency.START_METHODS). The work
+    is reported to progress, a progress.Progress or callback, as a
+    "hashing" or "copying" phase whose totals are unknown unless the
+    traversal has finished first. The workers are profiled if profiler, a
+    profiling.Profiler, asks them to.
+
+    Returns a list of (rel_path, {algorithm: hexdigest}, byte count) tuples.
+    """
+    progress = as_progress(progress)
+
+    if device_processes and dest_dir is None:
+        rel_paths = list(rel_paths)
+        algorithms = list(get_hashers(algorithms))
+        results = hash_files(
+            base_dir,
+            rel_paths,
+            algorithms,
+            processes=processes,
+            executor=executor,
+            kind="create",
+            cache=cache,
+            throttle=throttle,
+            order=order,
+            device_processes=device_processes,
+            start_method=start_method,
+            progress=progress,
+            profiler=profiler,
+        )
+
+        payload = []
+        for rel_path, (digests, byte_count, error) in zip(rel_paths, results):
+            if error is not None:
+                raise BagError(error)
+            payload.append((rel_path, {alg: d.hex() for alg, d in zip(algorithms, digests)}, byte_count))
+        return payload
+
+    files_total = None
+    if order != "path" or device_processes:
+        rel_paths = sort_paths(base_dir, rel_paths, order)
+        files_total = len(rel_paths)
+
+    pool_options = {"start_method": start_method, "profiler": profiler}
+    if throttle is not None:
+        if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+            # The executor's processes cannot inherit a shared throttle:
+            throttle = throttle.split(getattr(executor, "_max_workers", None) or os.cpu_count() or 1)
+        elif executor is None and processes != 1:
+            # The new pool can only inherit a schedule created in its own context:
+            throttle = throttle.for_pool(start_method)
+            pool_options.update(initializer=install_throttle, initargs=(throttle,))
+
+    if dest_dir is not None:
+        worker = partial(
+            copy_payload_file,
+            base_dir=base_dir,
+            dest_dir=dest_dir,
+            algorithms=algorithms,
+            cache=cache,
+            throttle=throttle,
+            log_level=file_log_level(),
+        )
+        if progress.callback is not None:
+            pool_options["on_result"] = lambda result: progress.advance(1, result[2])
+
+        with progress.phase("copying", files_total):
+            if device_processes:
+                groups = group_by_device(base_dir, rel_paths)
+                results = map_by_group(
+                    worker, groups, device_processes, processes=processes, executor=executor, **pool_options
+                )
+                copied = {i[0]: i for i in results}
+                return [copied[i] for i in rel_paths]
+            return map_with_workers(worker, rel_paths, processes=processes, executor=executor, **pool_options)
+
+    hashers = get_hashers(algorithms)
+    algorithms = list(hashers)
+    message = log_message("create", shares_process_state(processes, executor, start_method))
+
+    # The paths are not known in advance, so each batch carries its own but
+    # the results still come back as compact raw digests:
+    chunks = []
+    all_paths = []
+    first_paths = {}
+    links = {}
+
+    def unique_paths():
+        # Hard links are only hashed through the first path to their inode:
+        for rel_path in rel_paths:
+            all_paths.append(rel_path)
+            inode = linked_inode(os.path.join(base_dir, rel_path))
+            if inode in first_paths:
+                links[rel_path] = first_paths[inode]
+                continue
+            if inode is not None:
+                first_paths[inode] = rel_path
+            yield rel_path
+
+    def batches():
+        rel_path_iter = unique_paths()
+        while True:
+            chunk = list(itertools.islice(rel_path_iter, WORKER_CHUNK_SIZE))
+            if not chunk:
+                return
+            chunks.append(chunk)
+            yield base_dir, chunk, algorithms, message, cache, throttle
+
+    if progress.callback is not None:
+        pool_options["on_result"] = lambda batch: progress.advance(len(batch[1]), sum(batch[1]))
+
+    with progress.phase("hashing", files_total):
+        results = map_with_workers(
+            hash_batch, batches(), processes=processes, executor=executor, chunksize=1, **pool_options
+        )
+    file_results = unpack_batches(results, [h.digest_size for h in hashers.values()])
+
+    payload = {}
+    for rel_path, (digests, byte_count, error) in zip(itertools.chain.from_iterable(chunks), file_results):
+        if error is not None:
+            raise BagError(error)
+        payload[rel_path] = (rel_path, {alg: d.hex() for alg, d in zip(algorithms, digests)}, byte_count)
+
+    for rel_path, source in links.items():
+        payload[rel_path] = (rel_path,) + payload[source][1:]
+
+    return [payload[i] for i in all_paths]
+
+
+def walk_order_key(path):
+    """
+    Sort key reproducing the order in which io.walk() yields paths: the files
+    in a directory come before the contents of its subdirectories.
+    """
+    parts = path.split("/")
+    return [(1, i) for i in parts[:-1]] + [(0, parts[-1])]
@@ -0,0 +1,213 @@
+"""
+Choosing how to run the hashing of a payload when processes="auto".
+
+Starting a pool of processes takes longer than hashing a small bag, while a
+large one is hashed several times faster by one worker per CPU. The planner
+estimates the time each way of running the job would take from the size of
+the payload, the measured hashing throughput and the CPUs this process may
+actually use, and picks the cheapest:
+
+* serial: everything is hashed in this process;
+* threads: hashlib releases the GIL while hashing large buffers, so threads
+  share the hashing but not the per-file work, without any startup cost;
+* processes: a pool shares all of the work, but each process takes time to
+  start and every result is sent back to the parent.
+
+The model only covers the CPU: it assumes the storage can keep up.
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.hashing import hash_throughput
+from bagit_modules.logging import LOGGER
+
+#: The ways of running a job, in order of preference when they cost the same
+EXECUTION_MODES = ("serial", "threads", "processes")
+
+#: Seconds taken to start each worker process
+PROCESS_STARTUP_SECONDS = 0.02
+
+#: Seconds taken to start each worker thread
+THREAD_STARTUP_SECONDS = 0.0002
+
+#: Seconds of interpreter work per file (opening, logging and bookkeeping)
+FILE_OVERHEAD_SECONDS = 0.0001
+
+#: Seconds taken to send one file's result from a worker process
+RESULT_OVERHEAD_SECONDS = 0.00002
+
+#: Payloads which one worker hashes within this many seconds are always
+#: hashed serially, without measuring the hashing throughput
+SERIAL_THRESHOLD_SECONDS = 0.05
+
+#: Assumed bytes per second per algorithm before the throughput is measured
+ASSUMED_HASH_RATE = 500 * 1024 * 1024
+
+
+class ExecutionPlan(object):
+    """How a hashing job will be run: its mode and number of workers"""
+
+    def __init__(self, mode, workers, file_count, byte_count, estimated_seconds):
+        self.mode = mode
+        self.workers = workers
+        self.file_count = file_count
+        self.byte_count = byte_count
+        self.estimated_seconds = estimated_seconds
+
+    def __repr__(self):
+        return "ExecutionPlan(mode=%r, workers=%r)" % (self.mode, self.workers)
+
+
+def available_cpus():
+    """
+    Returns the number of CPUs this process may use, taking the CPU affinity
+    mask and any cgroup CPU quota into account
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+
+    return cpus
+
+
+def cgroup_cpu_quota():
+    """
+    Returns the CPU quota of this process's cgroup as a number of CPUs, or
+    None if it is not limited
+    """
+    for quota_file, period_file in _cgroup_quota_files():
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if period_file is not None:
+                with open(period_file) as f:
+                    values.append(f.read().strip())
+        except (OSError, IOError):
+            continue
+
+        # cgroup v2 holds "quota period" in one file, v1 uses two; the quota
+        # is "max" or -1 when there is none:
+        if len(values) != 2 or values[0] in ("max", "-1"):
+            return None
+        try:
+            return int(values[0]) / int(values[1])
+        except (ValueError, ZeroDivisionError):
+            return None
+
+    return None
+
+
+def _cgroup_quota_files():
+    cgroup_path = ""
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    cgroup_path = line[3:].strip().lstrip("/")
+    except (OSError, IOError):
+        pass
+
+    if cgroup_path:
+        yield os.path.join("/sys/fs/cgroup", cgroup_path, "cpu.max"), None
+    yield "/sys/fs/cgroup/cpu.max", None
+    yield "/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+    yield "/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us"
+
+
+def measure_tree(directory):
+    """Returns the number of files under directory and their total size in bytes"""
+    file_count = byte_count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                byte_count += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+            file_count += 1
+    return file_count, byte_count
+
+
+def plan_execution(file_count, byte_count, algorithms, cpus=None):
+    """
+    Returns the ExecutionPlan expected to hash file_count files holding
+    byte_count bytes with algorithms fastest on cpus CPUs (by default those
+    available to this process)
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    algorithms = list(algorithms) or ["sha256"]
+
+    file_seconds = file_count * FILE_OVERHEAD_SECONDS
+    hash_seconds = byte_count * len(algorithms) / ASSUMED_HASH_RATE
+    workers = max(1, min(cpus, file_count))
+
+    if workers == 1 or file_seconds + hash_seconds < SERIAL_THRESHOLD_SECONDS:
+        return ExecutionPlan("serial", 1, file_count, byte_count, file_seconds + hash_seconds)
+
+    # Hashing the algorithms one after another takes the sum of their times:
+    rates = hash_throughput(algorithms)
+    hash_seconds = sum(byte_count / rates.get(alg, ASSUMED_HASH_RATE) for alg in algorithms)
+
+    costs = {
+        "serial": (1, file_seconds + hash_seconds),
+        "threads": (workers, workers * THREAD_STARTUP_SECONDS + file_seconds + hash_seconds / workers),
+        "processes": (
+            workers,
+            workers * PROCESS_STARTUP_SECONDS
+            + (file_seconds + hash_seconds) / workers
+            + file_count * RESULT_OVERHEAD_SECONDS,
+        ),
+    }
+    mode = min(EXECUTION_MODES, key=lambda i: costs[i][1])
+    return ExecutionPlan(mode, costs[mode][0], file_count, byte_count, costs[mode][1])
+
+
+@contextmanager
+def planned_workers(processes, executor, algorithms, measure):
+    """
+    Resolves processes="auto" for a hashing job, yielding the processes and
+    executor to use for it.
+
+    measure is called to return the file and byte counts of the payload.
+    Any other processes value, or an executor supplied by the caller, is
+    used as it is. Worker threads started for the plan are shut down when
+    the block exits.
+    """
+    if processes != "auto":
+        yield processes, executor
+        return
+
+    if executor is not None:
+        yield 1, executor
+        return
+
+    file_count, byte_count = measure()
+    plan = plan_execution(file_count, byte_count, algorithms)
+    LOGGER.info(
+        _(
+            "Hashing %(file_count)d files (%(byte_count)d bytes) with %(workers)d %(mode)s worker(s),"
+            " estimated to take %(seconds).2fs"
+        ),
+        {
+            "file_count": file_count,
+            "byte_count": byte_count,
+            "workers": plan.workers,
+            "mode": plan.mode,
+            "seconds": plan.estimated_seconds,
+        },
+    )
+
+    if plan.mode == "threads":
+        with ThreadPoolExecutor(max_workers=plan.workers) as thread_executor:
+            yield plan.workers, thread_executor
+    else:
+        yield plan.workers, None
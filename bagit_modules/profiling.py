@@ -0,0 +1,208 @@
+"""
+Profiling bag creation and validation.
+
+make_bag() and Bag.validate() accept profile=. "phases" (or True) logs the
+time taken by each phase of the operation, such as loading the manifests,
+checking Payload-Oxum and completeness, hashing, checking the fixity and
+writing the manifests. "cprofile" also runs cProfile in this process and in
+every worker, and merges the workers' statistics into a single report, so
+that time spent reading, hashing, parsing manifests and passing results
+between processes can be told apart without attaching a profiler to each
+process.
+
+Worker processes profile each task they run and write their accumulated
+statistics to a temporary directory, which is merged and removed when the
+operation ends. Worker threads keep theirs in memory.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.logging import LOGGER
+from bagit_modules.progress import observe
+from bagit_modules.timing import PhaseTimer
+
+#: The kinds of profile which can be requested
+PROFILE_MODES = ("phases", "cprofile")
+
+#: Number of functions listed in a cProfile report
+PROFILE_LIMIT = 30
+
+#: Statistics of worker threads, by profile directory
+_thread_stats = {}
+_thread_stats_lock = threading.Lock()
+
+#: The cProfile.Profile of this worker process and the directory it is saved to
+_worker_profile = None
+
+
+class Profiler(object):
+    """
+    Collects the phase timings, and in "cprofile" mode the merged cProfile
+    statistics, of an operation. After it has stopped, timer holds the
+    phases and stats, a pstats.Stats, the profile.
+    """
+
+    def __init__(self, mode="phases", limit=PROFILE_LIMIT):
+        if mode is True:
+            mode = "phases"
+        if mode not in PROFILE_MODES:
+            raise ValueError(_("Unknown profile mode: %s") % mode)
+
+        self.mode = mode
+        self.limit = limit
+        self.timer = PhaseTimer()
+        self.stats = None
+        self.worker_count = 0
+        self.running = False
+        self._profile = None
+        self._directory = None
+
+    def start(self):
+        self.running = True
+        if self.mode == "cprofile":
+            # Only imported when needed, as pstats is slow to import:
+            import cProfile
+
+            self._directory = tempfile.mkdtemp(prefix="bagit-profile-")
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        self.running = False
+        if self._profile is None:
+            return
+
+        import pstats
+
+        self._profile.disable()
+        self.stats = pstats.Stats(self._profile)
+        try:
+            for filename in sorted(os.listdir(self._directory)):
+                self.stats.add(os.path.join(self._directory, filename))
+                self.worker_count += 1
+        finally:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        # The workers' statistics files no longer exist:
+        self.stats.files = []
+
+        with _thread_stats_lock:
+            thread_profiles = _thread_stats.pop(self._directory, [])
+        for thread_id, profile in thread_profiles:
+            self.stats.add(profile)
+        self.worker_count += len({thread_id for thread_id, profile in thread_profiles})
+
+        self._profile = self._directory = None
+
+    @contextmanager
+    def phase(self, name):
+        """Times a phase which does not report its own progress"""
+        with self.timer.phase(name):
+            yield
+
+    def observe(self, progress=None):
+        """
+        Returns a progress.Progress recording the end of each phase and
+        passing every event on to progress, a callback or Progress
+        """
+        def record(event):
+            if event.kind == "end":
+                self.timer.add(event.phase, event.elapsed)
+
+        return observe(progress, record)
+
+    def wrap(self, func):
+        """Returns func, made to profile itself in workers when profiling with cProfile"""
+        if self._directory is None:
+            return func
+        return ProfiledCall(func, self._directory, os.getpid())
+
+    def report(self, subject):
+        self.timer.log_summary(subject)
+
+        if self.stats is not None:
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats("cumulative").print_stats(self.limit)
+            LOGGER.info(
+                _("Profile of %(subject)s, including %(workers)d workers:\n%(report)s"),
+                {"subject": subject, "workers": self.worker_count, "report": stream.getvalue()},
+            )
+
+
+class ProfiledCall(object):
+    """
+    A picklable wrapper which runs func under cProfile in worker processes
+    and threads, saving the statistics where the Profiler can merge them.
+    Calls made in the thread which started the Profiler are already profiled.
+    """
+
+    def __init__(self, func, directory, parent_pid):
+        self.func = func
+        self.directory = directory
+        self.parent_pid = parent_pid
+
+    def __call__(self, *args, **kwargs):
+        global _worker_profile
+        import cProfile
+
+        if os.getpid() == self.parent_pid:
+            if threading.current_thread() is threading.main_thread():
+                return self.func(*args, **kwargs)
+            profile = cProfile.Profile()
+        else:
+            if _worker_profile is None or _worker_profile[1] != self.directory:
+                _worker_profile = (cProfile.Profile(), self.directory)
+            profile = _worker_profile[0]
+
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active in this thread
+            return self.func(*args, **kwargs)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._save(profile)
+
+    def _save(self, profile):
+        if os.getpid() == self.parent_pid:
+            profile.create_stats()
+            with _thread_stats_lock:
+                _thread_stats.setdefault(self.directory, []).append((threading.get_ident(), profile))
+        else:
+            # Rewritten after every task, as pool workers may be terminated:
+            profile.dump_stats(os.path.join(self.directory, "%d.prof" % os.getpid()))
+
+
+def as_profiler(profile):
+    """Returns a Profiler for profile: None, False, True, a mode or a Profiler"""
+    if profile is None or profile is False or isinstance(profile, Profiler):
+        return profile or None
+    return Profiler(profile)
+
+
+@contextmanager
+def profiling(profile, subject):
+    """
+    Yields the Profiler for profile (see as_profiler()), or None if nothing
+    is to be profiled, logging its report about subject when the block
+    exits. A Profiler which is already running is left for its owner to
+    stop and report.
+    """
+    profiler = as_profiler(profile)
+    if profiler is None or profiler.running:
+        yield profiler
+        return
+
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.report(subject)
@@ -0,0 +1,219 @@
+"""
+Reporting the progress of long-running operations.
+
+make_bag(), Bag.save() and Bag.validate() accept progress=, a function
+which is called with a ProgressEvent when each phase of the operation starts
+and ends and, while files are being hashed, with the files and bytes done so
+far, the current throughput and the estimated time remaining.
+
+Updates are made in the calling process as each batch of results comes back
+from the workers, so the workers' read and hash loop is unchanged, and are
+passed on at most once per interval seconds. An exception raised by the
+callback aborts the operation, which lets a scheduler cancel a job.
+
+In the "summary" log mode (see logging.LOG_MODES) the same events are
+summarized in the log instead of logging a line for every file.
+"""
+
+import time
+from contextlib import contextmanager
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.logging import LOGGER, SUMMARY_INTERVAL, get_log_mode
+
+#: Default number of seconds between two updates
+PROGRESS_INTERVAL = 1.0
+
+#: The kinds of ProgressEvent
+PROGRESS_EVENTS = ("start", "update", "end")
+
+
+class ProgressEvent(object):
+    """
+    A report on one phase of an operation.
+
+    kind is "start", "update" or "end". files_total and bytes_total are None
+    when they are not known in advance, such as while the traversal feeding
+    the pipeline is still running. throughput is the byte rate since the
+    previous event of the phase.
+    """
+
+    def __init__(self, kind, phase, files_done, files_total, bytes_done, bytes_total, elapsed, throughput):
+        self.kind = kind
+        self.phase = phase
+        self.files_done = files_done
+        self.files_total = files_total
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.elapsed = elapsed
+        self.throughput = throughput
+
+    @property
+    def eta(self):
+        """Seconds until the phase ends at its average rate so far, or None if unknown"""
+        if self.kind == "end":
+            return 0.0
+        if self.bytes_total is None or not self.bytes_done or not self.elapsed:
+            return None
+        return max(0.0, (self.bytes_total - self.bytes_done) * self.elapsed / self.bytes_done)
+
+    def __repr__(self):
+        return "ProgressEvent(kind=%r, phase=%r, files_done=%r, bytes_done=%r)" % (
+            self.kind,
+            self.phase,
+            self.files_done,
+            self.bytes_done,
+        )
+
+
+class Progress(object):
+    """
+    Tracks the phases of one operation, passing ProgressEvents to callback
+    with updates no more than interval seconds apart. A Progress without a
+    callback does nothing.
+    """
+
+    def __init__(self, callback=None, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self._phase = None
+
+    @contextmanager
+    def phase(self, name, files_total=None, bytes_total=None):
+        """Reports the start of a phase and, when the block exits, its end"""
+        if self.callback is None:
+            yield self
+            return
+
+        outer = self._phase
+        self._phase = {
+            "name": name,
+            "files_total": files_total,
+            "bytes_total": bytes_total,
+            "files_done": 0,
+            "bytes_done": 0,
+            "started": time.monotonic(),
+        }
+        self._phase["reported"] = (self._phase["started"], 0)
+        try:
+            self._report("start")
+            yield self
+            self._report("end")
+        finally:
+            self._phase = outer
+
+    def add(self, name, elapsed):
+        """Reports a phase timed elsewhere, e.g. by a background thread, as having ended"""
+        if self.callback is not None:
+            self.callback(ProgressEvent("end", name, 0, None, 0, None, elapsed, 0.0))
+
+    def advance(self, files=0, byte_count=0):
+        """Records files and bytes done in the current phase, reporting them if an update is due"""
+        current = self._phase
+        if current is None:
+            return
+        current["files_done"] += files
+        current["bytes_done"] += byte_count
+        if time.monotonic() - current["reported"][0] >= self.interval:
+            self._report("update")
+
+    def _report(self, kind):
+        current = self._phase
+        now = time.monotonic()
+        last_time, last_bytes = current["reported"]
+        throughput = (current["bytes_done"] - last_bytes) / (now - last_time) if now > last_time else 0.0
+        current["reported"] = (now, current["bytes_done"])
+
+        self.callback(
+            ProgressEvent(
+                kind,
+                current["name"],
+                current["files_done"],
+                current["files_total"],
+                current["bytes_done"],
+                current["bytes_total"],
+                now - current["started"],
+                throughput,
+            )
+        )
+
+
+class ProgressSummary(object):
+    """
+    Logs the progress of hashing and copying files at INFO, no more than
+    once per interval seconds, and a summary when they end
+    """
+
+    def __init__(self, interval=SUMMARY_INTERVAL):
+        self.interval = interval
+        self._logged = 0.0
+
+    def __call__(self, event):
+        if event.phase not in ("hashing", "copying") or event.kind == "start":
+            return
+
+        if event.kind == "end":
+            LOGGER.info(
+                _("Finished %(phase)s %(files)d files (%(bytes)d bytes) in %(elapsed).2fs, %(rate).1f MB/s"),
+                {
+                    "phase": event.phase,
+                    "files": event.files_done,
+                    "bytes": event.bytes_done,
+                    "elapsed": event.elapsed,
+                    "rate": event.bytes_done / event.elapsed / 1e6 if event.elapsed else 0.0,
+                },
+            )
+            return
+
+        now = time.monotonic()
+        if now - self._logged < self.interval:
+            return
+        self._logged = now
+
+        eta = event.eta
+        LOGGER.info(
+            _(
+                "%(phase)s: %(files)d of %(file_total)s files, %(bytes)d of %(byte_total)s bytes,"
+                " %(rate).1f MB/s, %(eta)s remaining"
+            ),
+            {
+                "phase": event.phase.capitalize(),
+                "files": event.files_done,
+                "file_total": "?" if event.files_total is None else event.files_total,
+                "bytes": event.bytes_done,
+                "byte_total": "?" if event.bytes_total is None else event.bytes_total,
+                "rate": event.throughput / 1e6,
+                "eta": "?" if eta is None else "%.0fs" % eta,
+            },
+        )
+
+
+def as_progress(progress):
+    """Returns a Progress for progress, which may be None, a callback or a Progress"""
+    if isinstance(progress, Progress):
+        return progress
+    if progress is not None and not callable(progress):
+        raise TypeError("progress must be callable")
+    return Progress(progress)
+
+
+def observe(progress, observer):
+    """
+    Returns a Progress passing each event to observer, then on to progress,
+    a callback or Progress
+    """
+    caller = as_progress(progress)
+
+    def forward(event):
+        observer(event)
+        if caller.callback is not None:
+            caller.callback(event)
+
+    return Progress(forward, caller.interval)
+
+
+def log_summaries(progress):
+    """Returns progress, summarizing its events in the log in the "summary" log mode"""
+    if get_log_mode() == "summary":
+        return observe(progress, ProgressSummary())
+    return as_progress(progress)
@@ -7,6 +7,12 @@ from bagit_modules.string_ops import force_unicode
 
 
 def make_tag_file(bag_info_path, bag_info):
+    with open_text_file(bag_info_path, "w") as f:
+        f.write(format_tag_file(bag_info))
+
+
+def format_tag_file(bag_info):
+    """Returns the text of a tag file containing the provided tags"""
     headers = sorted(bag_info.keys())
     output_lines = []
 
@@ -18,16 +24,20 @@ def make_tag_file(bag_info_path, bag_info):
             sanitized_txt = force_unicode(txt).replace("\n", "").replace("\r", "")
             output_lines.append(f"{h}: {sanitized_txt}")
 
-    with open_text_file(bag_info_path, "w") as f:
-        f.write("\n".join(output_lines))
+    return "\n".join(output_lines)
 
 
 def load_tag_file(tag_file_name, encoding="utf-8-sig"):
     with open_text_file(tag_file_name, "r", encoding=encoding) as tag_file:
-        tags = {}
-        for name, value in _parse_tags(tag_file):
-            tags.setdefault(name, []).append(value)
-        return {k: v[0] if len(v) == 1 else v for k, v in tags.items()}
+        return read_tag_file(tag_file)
+
+
+def read_tag_file(tag_file):
+    """Returns the tags in an open text file, as load_tag_file() does"""
+    tags = {}
+    for name, value in _parse_tags(tag_file):
+        tags.setdefault(name, []).append(value)
+    return {k: v[0] if len(v) == 1 else v for k, v in tags.items()}
 
 
 def _parse_tags(tag_file):
@@ -49,7 +59,7 @@ def _parse_tags(tag_file):
 
         # Yield the last tag before starting a new one
         if tag_name:
-            yield tag_name, tag_value
+            yield tag_name, tag_value.strip()
 
         # Check for invalid tags
         if ":" not in stripped_line:
@@ -57,7 +67,8 @@ def _parse_tags(tag_file):
                 _("%(filename)s contains invalid tag: %(line)s") % {"line": stripped_line, "filename": filename})
 
         tag_name, tag_value = stripped_line.split(":", 1)
+        tag_name = tag_name.strip()
 
     # Yield any remaining tag after the loop
     if tag_name:
-        yield tag_name, tag_value
+        yield tag_name, tag_value.strip()
@@ -0,0 +1,296 @@
+"""
+Throttling the payload reads of background fixity checks.
+
+A Throttle limits the combined bytes and files per second read by every
+worker hashing for one bag, whether they are threads, processes started for
+the job or the processes of a caller's executor, and can lower the CPU and
+I/O priority of worker processes so that user-facing reads of the same
+storage go first.
+
+The limits are enforced by reserving time on a schedule: each read books the
+next free slot, sleeping until it starts if it lies in the future. The
+schedule lives in shared memory which pool workers inherit when they start;
+tasks sent to them afterwards only carry the throttle's id.
+"""
+
+import collections
+import itertools
+import os
+import threading
+import time
+import weakref
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.concurrency import get_pool_context, posix_multiprocessing_worker_initializer
+from bagit_modules.logging import LOGGER
+
+#: I/O scheduling classes accepted for ionice, as used by ioprio_set(2)
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+#: ioprio_set(2) system call numbers, which Python does not wrap
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+
+#: Throttles known to this process, by id
+_throttles = weakref.WeakValueDictionary()
+
+#: Number of throttles a worker of a caller's executor keeps between tasks
+LOCAL_THROTTLE_LIMIT = 8
+
+#: Throttles created in this process for a caller's executor, by id. They
+#: must outlive the individual tasks that refer to them, so the most recently
+#: restored ones are kept alive by _recent_throttles; older runs' are dropped.
+_local_throttles = weakref.WeakValueDictionary()
+_recent_throttles = collections.deque(maxlen=LOCAL_THROTTLE_LIMIT)
+
+#: Ids of throttles whose priorities have been applied to this process
+_prioritized = set()
+
+_ids = itertools.count()
+
+
+class Throttle(object):
+    """
+    Limits on the combined rate at which workers read payload files, and the
+    priority of worker processes.
+
+    bytes_per_second and files_per_second cap the total across all workers;
+    either may be None for no limit. nice is an increment applied with
+    os.setpriority() and ionice an I/O scheduling class, "idle",
+    "best-effort" or "realtime", optionally followed by ":" and a level from
+    0 (highest) to 7. Priorities apply to worker processes only, never to the
+    calling process or its threads, since they cannot be raised again.
+
+    The shared schedule is created in the multiprocessing context of
+    start_method, by default the platform's; see for_pool().
+    """
+
+    def __init__(
+        self,
+        bytes_per_second=None,
+        files_per_second=None,
+        nice=None,
+        ionice=None,
+        shared=True,
+        start_method=None,
+    ):
+        if bytes_per_second is not None and bytes_per_second <= 0:
+            raise ValueError(_("The byte rate limit must be greater than 0"))
+        if files_per_second is not None and files_per_second <= 0:
+            raise ValueError(_("The file rate limit must be greater than 0"))
+        if ionice is not None:
+            io_priority(ionice)
+
+        self.id = (os.getpid(), next(_ids))
+        self.bytes_per_second = bytes_per_second
+        self.files_per_second = files_per_second
+        self.nice = nice
+        self.ionice = ionice
+        self.owner_pid = os.getpid()
+        self.shared = shared
+        self.start_method = None
+
+        # The times at which the next byte and the next file may be read:
+        if shared:
+            context = get_pool_context(start_method)
+            self.start_method = context.get_start_method()
+            self._schedule = context.Array("d", 2)
+            self._lock = self._schedule.get_lock()
+        else:
+            self._schedule = [0.0, 0.0]
+            self._lock = threading.Lock()
+
+        _throttles[self.id] = self
+
+    def __repr__(self):
+        return "Throttle(bytes_per_second=%r, files_per_second=%r, nice=%r, ionice=%r)" % (
+            self.bytes_per_second,
+            self.files_per_second,
+            self.nice,
+            self.ionice,
+        )
+
+    def __reduce__(self):
+        from multiprocessing.context import get_spawning_popen
+
+        # The shared schedule can only be pickled while starting a worker
+        # process; afterwards the worker finds it by id:
+        schedule = self._schedule if self.shared and get_spawning_popen() is not None else None
+        return _restore_throttle, (
+            self.id,
+            self.bytes_per_second,
+            self.files_per_second,
+            self.nice,
+            self.ionice,
+            self.owner_pid,
+            schedule,
+        )
+
+    def for_pool(self, start_method=None):
+        """
+        Returns a throttle which a new pool starting its processes with
+        start_method can inherit: this one if its schedule was created in
+        the same multiprocessing context, otherwise a copy of its limits with
+        a schedule of its own in the pool's context
+        """
+        if not self.shared or get_pool_context(start_method).get_start_method() == self.start_method:
+            return self
+        return Throttle(
+            bytes_per_second=self.bytes_per_second,
+            files_per_second=self.files_per_second,
+            nice=self.nice,
+            ionice=self.ionice,
+            start_method=start_method,
+        )
+
+    def split(self, workers):
+        """
+        Returns an unshared throttle allowing each of workers an equal share
+        of the rates, for processes which cannot inherit the shared schedule
+        """
+        return Throttle(
+            bytes_per_second=self.bytes_per_second and self.bytes_per_second / workers,
+            files_per_second=self.files_per_second and self.files_per_second / workers,
+            nice=self.nice,
+            ionice=self.ionice,
+            shared=False,
+        )
+
+    def file(self):
+        """Waits until another file may be opened"""
+        if self.files_per_second:
+            self._reserve(1, 1 / self.files_per_second)
+
+    def consume(self, byte_count):
+        """Records that byte_count bytes were read, waiting if they exceed the rate"""
+        if self.bytes_per_second:
+            self._reserve(0, byte_count / self.bytes_per_second)
+
+    def _reserve(self, index, duration):
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._schedule[index], now)
+            self._schedule[index] = start + duration
+
+        if start > now:
+            time.sleep(start - now)
+
+    def enter_worker(self):
+        """
+        Applies the priorities the first time a worker process uses this
+        throttle. When the files are read in the calling process, serially
+        or by threads, the priorities are not applied and a warning is
+        logged instead (see lower_priority()).
+        """
+        if self.id in _prioritized:
+            return
+        _prioritized.add(self.id)
+
+        if os.getpid() != self.owner_pid:
+            lower_priority(self.nice, self.ionice)
+        elif self.nice or self.ionice:
+            LOGGER.warning(
+                _(
+                    "Not changing the priority of process %d, which reads the files itself:"
+                    " nice and ionice only apply to worker processes"
+                ),
+                os.getpid(),
+            )
+
+
+def _restore_throttle(throttle_id, bytes_per_second, files_per_second, nice, ionice, owner_pid, schedule):
+    throttle = _throttles.get(throttle_id) or _local_throttles.get(throttle_id)
+    if throttle is not None:
+        return throttle
+
+    throttle = Throttle.__new__(Throttle)
+    throttle.id = throttle_id
+    throttle.bytes_per_second = bytes_per_second
+    throttle.files_per_second = files_per_second
+    throttle.nice = nice
+    throttle.ionice = ionice
+    throttle.owner_pid = owner_pid
+    throttle.shared = schedule is not None
+    throttle.start_method = None
+
+    if schedule is not None:
+        throttle._schedule = schedule
+        throttle._lock = schedule.get_lock()
+        _throttles[throttle_id] = throttle
+    else:
+        # A worker of a caller's executor, which only ever sees split()
+        # throttles, keeps its share for the remaining tasks:
+        throttle._schedule = [0.0, 0.0]
+        throttle._lock = threading.Lock()
+        _local_throttles[throttle_id] = throttle
+        _recent_throttles.append(throttle)
+
+    return throttle
+
+
+def install_throttle(throttle):
+    """
+    Pool initializer which makes a throttle available to the tasks of a new
+    worker: receiving it while the worker starts is enough to register it
+    """
+    if os.name == "posix":
+        posix_multiprocessing_worker_initializer()
+
+
+def lower_priority(nice=None, ionice=None):
+    """
+    Adds nice to the scheduling priority of this process and sets its I/O
+    scheduling class to ionice, logging a warning for any which cannot be
+    changed. Processes started afterwards inherit both.
+    """
+    if nice:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, os.getpriority(os.PRIO_PROCESS, 0) + nice)
+        except (AttributeError, OSError) as e:
+            LOGGER.warning(_("Unable to change the priority of process %(pid)d: %(error)s"), {
+                "pid": os.getpid(), "error": e
+            })
+
+    if ionice:
+        try:
+            set_io_priority(ionice)
+        except OSError as e:
+            LOGGER.warning(_("Unable to change the I/O priority of process %(pid)d: %(error)s"), {
+                "pid": os.getpid(), "error": e
+            })
+
+
+def io_priority(ionice):
+    """Returns the (class, level) to pass to ioprio_set(2) for ionice, raising ValueError if it is invalid"""
+    name, _sep, level = str(ionice).partition(":")
+    if name not in IONICE_CLASSES:
+        raise ValueError(_("Unknown I/O scheduling class: %s") % name)
+    if level and not (level.isdigit() and 0 <= int(level) <= 7):
+        raise ValueError(_("I/O priority levels must be between 0 and 7, not %s") % level)
+    return IONICE_CLASSES[name], int(level or 0)
+
+
+def set_io_priority(ionice):
+    """Sets the I/O scheduling class and level of this process with ioprio_set(2)"""
+    import platform
+
+    io_class, level = io_priority(ionice)
+
+    syscall = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not syscall or not platform.system() == "Linux":
+        raise OSError(_("I/O priorities are not supported on this platform"))
+
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    # IOPRIO_WHO_PROCESS for this process:
+    if libc.syscall(syscall, 1, 0, (io_class << 13) | level) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
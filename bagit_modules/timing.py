@@ -0,0 +1,39 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.logging import LOGGER
+
+
+class PhaseTimer(object):
+    """Accumulates the wall-clock time spent in each named phase of an operation"""
+
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, elapsed):
+        """Records time measured elsewhere, e.g. by a background thread"""
+        self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+    @property
+    def total(self):
+        return sum(self.durations.values())
+
+    def log_summary(self, subject):
+        LOGGER.info(
+            _("Phase timings for %(subject)s: %(timings)s (total %(total).3fs)"),
+            {
+                "subject": subject,
+                "timings": ", ".join("%s=%.3fs" % i for i in self.durations.items()),
+                "total": self.total,
+            },
+        )
@@ -1,6 +1,29 @@
-import gettext
-
 from bagit_modules.io import find_locale_dir
 
-TRANSLATION_CATALOG = gettext.translation("bagit-python", localedir=find_locale_dir(), fallback=True)
-_ = TRANSLATION_CATALOG.gettext
+_catalog = None
+
+
+def get_translation_catalog():
+    """
+    Returns the message catalog, which is loaded the first time a message is
+    translated since importing gettext and locale noticeably slows down
+    importing bagit
+    """
+    global _catalog
+
+    if _catalog is None:
+        import gettext
+
+        _catalog = gettext.translation("bagit-python", localedir=find_locale_dir(), fallback=True)
+
+    return _catalog
+
+
+def _(message):
+    return get_translation_catalog().gettext(message)
+
+
+def __getattr__(name):
+    if name == "TRANSLATION_CATALOG":
+        return get_translation_catalog()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
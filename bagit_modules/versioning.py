@@ -1,11 +1,26 @@
-from pkg_resources import get_distribution, DistributionNotFound
-
 from bagit_modules.module import MODULE_NAME
 
+_version = None
+
 
 def get_version():
-    try:
-        return get_distribution(MODULE_NAME).version
-    except DistributionNotFound:
-        return "0.0.dev0"
+    """Returns the installed version, looked up the first time it is needed"""
+    global _version
+
+    if _version is None:
+        # importlib.metadata is much cheaper to import than pkg_resources, but
+        # still only worth importing when the version is actually used:
+        try:
+            from importlib.metadata import PackageNotFoundError, version
+        except ImportError:  # Python < 3.8
+            from pkg_resources import DistributionNotFound as PackageNotFoundError, get_distribution
+
+            def version(name):
+                return get_distribution(name).version
+
+        try:
+            _version = version(MODULE_NAME)
+        except PackageNotFoundError:
+            _version = "0.0.dev0"
 
+    return _version
@@ -0,0 +1,343 @@
+"""
+Compact messages between the hashing workers and the parent process.
+
+Sending every worker a tuple per file holding its path, the expected hashes
+and the algorithm list, and getting hex strings and those hashes back, costs
+as much as hashing small files. Instead each job's path table is installed in
+every worker once, through the pool initializer or directly when the workers
+are threads, and work is handed out as (job id, start, stop) index ranges.
+Each batch returns one byte string of concatenated raw digests, an array of
+sizes and any read errors, and the parent compares the raw digest bytes.
+
+When a caller supplies a process-based executor the table cannot be
+installed up front, so each batch carries its slice of the table instead.
+
+Hard-linked paths share one inode, so only the first path found for each
+(st_dev, st_ino) is hashed and its results are reused for the others.
+
+Files can also be hashed in the order they are stored rather than the order
+they are listed, which saves seeking on spinning disks and tape caches. The
+results are always returned in the order the paths were given, so the
+manifests are unaffected.
+
+When a payload spans several devices, such as separate disks mounted or
+linked into the bag, the batches can be grouped by st_dev and each device
+given its own number of workers, so that one device's files cannot occupy
+every worker while the others sit idle.
+"""
+
+import itertools
+import math
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.concurrency import map_by_group, map_with_workers, shares_process_state
+from bagit_modules.hashcore import hash_batch, hash_range, install_table, remove_table
+from bagit_modules.hashing import get_hashers
+from bagit_modules.logging import LOGGER, file_log_level
+from bagit_modules.progress import as_progress
+
+#: Largest number of files in a single batch
+MAX_BATCH_SIZE = 256
+
+#: Orders in which files can be hashed: path keeps the order they were given
+#: in, inode sorts them by device and inode number and physical by the disk
+#: position of their first extent, falling back to the inode where the
+#: filesystem cannot report it
+HASH_ORDERS = ("path", "inode", "physical")
+
+#: Linux ioctl request number used to map the extents of a file
+FS_IOC_FIEMAP = 0xC020660B
+
+#: struct fiemap, followed by a single struct fiemap_extent
+_FIEMAP_HEADER = struct.Struct("=QQLLLL")
+_FIEMAP_EXTENT = struct.Struct("=QQQ2QL3L")
+
+_job_ids = itertools.count()
+
+
+def log_message(kind, shared_logging=True):
+    """
+    Returns the (level, message) workers log for each file in "create" or
+    "verify" jobs, or None if it would not be shown: when messages at the
+    level for each file (see logging.file_log_level()) are disabled or when
+    the workers are processes which do not share this process's logging
+    configuration
+    """
+    level = file_log_level()
+    if not shared_logging or not LOGGER.isEnabledFor(level):
+        return None
+    if kind == "create":
+        return level, _("Generating manifest lines for file %s")
+    return level, _("Verifying checksum for file %s")
+
+
+def linked_inode(full_path):
+    """
+    Returns (st_dev, st_ino) for a file with more than one hard link, or
+    None for files with a single link and those which cannot be read
+    """
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino) if st.st_nlink > 1 else None
+
+
+def physical_offset(full_path):
+    """
+    Returns the position on disk of the first extent of a file, using the
+    Linux FIEMAP ioctl, or None if it cannot be determined
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    # Map from offset 0 to the end of the file, returning one extent:
+    _FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+
+    try:
+        with open(full_path, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+
+    mapped_extents = _FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    return _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)[1]
+
+
+def disk_order_key(full_path, st, order):
+    """
+    Returns a sort key placing a file, whose os.stat() result is st, in the
+    given order (see HASH_ORDERS)
+    """
+    if st is None:
+        return (-1, 0, 0)
+    if order == "physical":
+        offset = physical_offset(full_path)
+        if offset is not None:
+            return (st.st_dev, 0, offset)
+    return (st.st_dev, 1, st.st_ino)
+
+
+def sort_paths(base_dir, rel_paths, order="path"):
+    """Returns rel_paths, relative to base_dir, sorted into order (see HASH_ORDERS)"""
+    if order == "path":
+        return list(rel_paths)
+
+    keys = {}
+    for rel_path in rel_paths:
+        full_path = os.path.join(base_dir, rel_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            st = None
+        keys[rel_path] = disk_order_key(full_path, st, order)
+
+    return sorted(keys, key=keys.__getitem__)
+
+
+def group_by_device(base_dir, rel_paths):
+    """Returns a list of the rel_paths, relative to base_dir, on each device, in order"""
+    groups = {}
+    for rel_path in rel_paths:
+        try:
+            device = os.stat(os.path.join(base_dir, rel_path)).st_dev
+        except OSError:
+            device = None
+        groups.setdefault(device, []).append(rel_path)
+    return list(groups.values())
+
+
+def hash_files(
+    base_dir,
+    rel_paths,
+    algorithms,
+    processes=1,
+    executor=None,
+    kind="verify",
+    cache="normal",
+    throttle=None,
+    order="path",
+    device_processes=None,
+    start_method=None,
+    progress=None,
+    profiler=None,
+):
+    """
+    Hashes every path in rel_paths, relative to base_dir, with algorithms.
+
+    Returns a list holding a (digests, size, error) tuple for each path, in
+    order, where digests is a tuple of raw digest bytes in the same order as
+    the supported algorithms and error is None unless the file could not be
+    read. kind selects the per-file log message, cache the page cache
+    policy used to read the files and throttle, if provided, the limits on
+    reading them. Hard links to the same file are read only once, and the
+    files are read in order (see HASH_ORDERS). If device_processes is given
+    no more than that many workers read from each device at once. A new
+    pool starts its processes with start_method (see
+    concurrency.START_METHODS). The work is reported as a "hashing" phase
+    to progress, a progress.Progress or callback, if one is provided, and
+    the workers are profiled if profiler, a profiling.Profiler, asks them to.
+    """
+    progress = as_progress(progress)
+    all_paths = list(rel_paths)
+
+    # The result for each path is taken from the first path to its inode:
+    rel_paths = []
+    sources = []
+    first_paths = {}
+    order_keys = []
+    byte_count = 0
+    sort = order != "path" or bool(device_processes)
+    for rel_path in all_paths:
+        full_path = os.path.join(base_dir, rel_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            st = None
+        inode = (st.st_dev, st.st_ino) if st is not None and st.st_nlink > 1 else None
+
+        if inode in first_paths:
+            LOGGER.debug(_("Reusing the digests of hard link %(source)s for %(path)s"), {
+                "source": rel_paths[first_paths[inode]], "path": rel_path
+            })
+            sources.append(first_paths[inode])
+            continue
+        if inode is not None:
+            first_paths[inode] = len(rel_paths)
+        sources.append(len(rel_paths))
+        rel_paths.append(rel_path)
+        if st is not None:
+            byte_count += st.st_size
+        if order != "path":
+            order_keys.append(disk_order_key(full_path, st, order))
+        elif sort:
+            order_keys.append((-1,) if st is None else (st.st_dev,))
+
+    if sort:
+        # Hash in storage order, or at least with each device's files
+        # together, then put the results back in the given order:
+        permutation = sorted(range(len(rel_paths)), key=order_keys.__getitem__)
+        positions = {old: new for new, old in enumerate(permutation)}
+        rel_paths = [rel_paths[i] for i in permutation]
+        sources = [positions[i] for i in sources]
+        order_keys = [order_keys[i] for i in permutation]
+
+    hashers = get_hashers(algorithms)
+    algorithms = list(hashers)
+    digest_sizes = [h.digest_size for h in hashers.values()]
+    message = log_message(kind, shares_process_state(processes, executor, start_method))
+    if throttle is not None and executor is None and processes != 1:
+        # The new pool can only inherit a schedule created in its own context:
+        throttle = throttle.for_pool(start_method)
+    table = (base_dir, rel_paths, algorithms, message, cache, throttle)
+
+    if executor is not None:
+        workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+    else:
+        workers = processes or os.cpu_count() or 1
+
+    # Enough batches to keep every worker busy until the end of the job:
+    batch_size = max(1, min(MAX_BATCH_SIZE, math.ceil(len(rel_paths) / (workers * 4))))
+
+    # Batches never span devices, so that the workers on each can be limited:
+    device_ranges = []
+    if device_processes:
+        for _device, keys in itertools.groupby(enumerate(order_keys), key=lambda i: i[1][0]):
+            indexes = [i for i, key in keys]
+            device_ranges.append([
+                (start, min(start + batch_size, indexes[-1] + 1))
+                for start in range(indexes[0], indexes[-1] + 1, batch_size)
+            ])
+        LOGGER.debug(_("Hashing files from %(devices)d devices with up to %(processes)d workers each"), {
+            "devices": len(device_ranges), "processes": device_processes
+        })
+    else:
+        device_ranges.append(
+            [
+                (start, min(start + batch_size, len(rel_paths)))
+                for start in range(0, len(rel_paths), batch_size)
+            ]
+        )
+
+    def report(batch):
+        sizes = batch[1]
+        progress.advance(len(sizes), sum(sizes))
+
+    def run(func, groups, **pool_options):
+        pool_options["profiler"] = profiler
+        if progress.callback is not None:
+            pool_options["on_result"] = report
+        with progress.phase("hashing", len(rel_paths), byte_count):
+            if device_processes:
+                return map_by_group(func, groups, device_processes, **pool_options)
+            return map_with_workers(func, groups[0], chunksize=1, **pool_options)
+
+    job_id = (os.getpid(), next(_job_ids))
+
+    if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+        # The executor's processes cannot inherit a shared throttle:
+        if throttle is not None:
+            throttle = throttle.split(workers)
+        batches = run(
+            hash_batch,
+            [
+                [
+                    (base_dir, rel_paths[start:stop], algorithms, message, cache, throttle)
+                    for start, stop in ranges
+                ]
+                for ranges in device_ranges
+            ],
+            executor=executor,
+        )
+    elif executor is None and processes != 1:
+        batches = run(
+            hash_range,
+            [[(job_id, start, stop) for start, stop in ranges] for ranges in device_ranges],
+            processes=processes,
+            initializer=install_table,
+            initargs=(job_id, table),
+            start_method=start_method,
+        )
+    else:
+        # Serial hashing and worker threads share this process's table:
+        install_table(job_id, table, worker=False)
+        try:
+            batches = run(
+                hash_range,
+                [[(job_id, start, stop) for start, stop in ranges] for ranges in device_ranges],
+                executor=executor,
+            )
+        finally:
+            remove_table(job_id)
+
+    results = list(unpack_batches(batches, digest_sizes))
+    return [results[i] for i in sources]
+
+
+def unpack_batches(batches, digest_sizes):
+    """
+    Yields a (digests, size, error) tuple for each file in the results of
+    hash_batch(), given the digest size of each algorithm
+    """
+    record_size = sum(digest_sizes)
+
+    for digests, sizes, errors in batches:
+        for offset, size in enumerate(sizes):
+            if offset in errors:
+                yield None, size, errors[offset]
+                continue
+
+            position = offset * record_size
+            file_digests = []
+            for digest_size in digest_sizes:
+                file_digests.append(digests[position:position + digest_size])
+                position += digest_size
+            yield tuple(file_digests), size, None
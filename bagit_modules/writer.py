@@ -0,0 +1,308 @@
+"""
+Writing bags from payload supplied by the caller.
+
+BagWriter builds a bag in a new directory or straight into a tar or zip
+archive from payload files which are added one at a time as bytes or
+readable streams. Each file is hashed while it is written and the manifest
+entries are kept in memory, so nothing has to be read back when the
+manifests, bag-info.txt and tag manifests are written on close.
+"""
+
+import os
+import shutil
+import stat
+
+from bagit_modules.translation_catalog import _
+from bagit_modules.archive import ArchiveWriter, archive_bag_name, archive_format
+from bagit_modules.bagging import BAGIT_TXT, _make_bag_info, _report_directory_permissions, _set_checksums
+from bagit_modules.constants import HASH_BLOCK_SIZE
+from bagit_modules.errors import BagError
+from bagit_modules.hashing import get_hashers, hash_bytes
+from bagit_modules.logging import LOGGER
+from bagit_modules.manifests import TagManifestBuilder, format_manifest, format_tagmanifest
+from bagit_modules.pipeline import SourceScan
+from bagit_modules.tagging import format_tag_file
+
+
+class BagWriter(object):
+    """
+    Context manager which writes a new bag from payload files added with
+    add_file(), for example:
+
+        with BagWriter("/path/to/bag", bag_info={"Source-Organization": "..."}) as bag:
+            bag.add_file("exports/report.csv", report_bytes)
+            bag.add_file("renders/frame-0001.png", render_stream)
+
+    target is a directory, which must not exist or be empty, or an archive:
+    either a path ending with an archive suffix (see archive_format()) or a
+    writable binary file object, in which case archive_type is required.
+    The members of an archive are placed under a directory named bag_name,
+    which defaults to the archive file name without its suffix.
+
+    The tag files are written when the context exits normally or close() is
+    called. If the context exits with an exception the partial bag is
+    removed instead, as long as BagWriter created it.
+    """
+
+    def __init__(
+        self, target, bag_info=None, checksums=None, encoding="utf-8", archive_type=None, bag_name=None
+    ):
+        self.bag_info = bag_info
+        self.encoding = encoding
+        self.checksums = list(get_hashers(_set_checksums(None, checksums)))
+        self.total_bytes = 0
+        self.total_files = 0
+        self.closed = False
+
+        self._manifest_data = {alg: [] for alg in self.checksums}
+        self._paths = set()
+        self._created = False
+
+        if isinstance(target, str):
+            target = os.path.abspath(target)
+            if archive_type is None and not os.path.isdir(target):
+                archive_type = archive_format(target)
+        elif archive_type is None:
+            raise BagError(_("Unable to determine the archive format for %s") % target)
+
+        self.target = target
+        self.archive_type = archive_type
+
+        if archive_type is None:
+            self.archive = None
+            self._create_directory(target)
+            self.data_dir = os.path.join(target, "data")
+        else:
+            if bag_name is None:
+                bag_name = archive_bag_name(target) if isinstance(target, str) else "bag"
+            self.bag_name = bag_name
+            self._created = isinstance(target, str) and not os.path.exists(target)
+            self.archive = ArchiveWriter(target, archive_type, algorithms=self.checksums)
+
+            bagit_txt = BAGIT_TXT.encode("utf-8")
+            self.archive.add_directory(bag_name)
+            self.archive.add_bytes(f"{bag_name}/bagit.txt", bagit_txt)
+            self.archive.add_directory(f"{bag_name}/data")
+            self._tag_digests = {"bagit.txt": hash_bytes(bagit_txt, self.checksums)}
+
+    def _create_directory(self, bag_dir):
+        if not os.path.exists(bag_dir):
+            os.makedirs(os.path.join(bag_dir, "data"))
+            self._created = True
+        elif not os.path.isdir(bag_dir) or os.listdir(bag_dir):
+            raise RuntimeError(_("The bag destination %s must be an empty directory") % bag_dir)
+        else:
+            os.mkdir(os.path.join(bag_dir, "data"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _payload_path(self, path):
+        """Validates a path relative to data/, returning it '/'-separated"""
+        parts = path.replace(os.path.sep, "/").split("/")
+        if not path or os.path.isabs(path) or ".." in parts or "" in parts:
+            raise BagError(_('Path "%s" is unsafe') % path)
+        return "/".join(i for i in parts if i != ".")
+
+    def add_file(self, path, data, size=None, mtime=None, mode=None):
+        """
+        Adds a payload file at path, relative to the data directory. data is
+        either a bytes-like object or a binary file object which is read to
+        the end. For file objects backed by a regular file the size, mtime and
+        mode default to the file's own. Returns {algorithm: hexdigest}.
+        """
+        if self.closed:
+            raise BagError(_("Cannot add files to a closed bag"))
+
+        path = self._payload_path(path)
+        rel_path = "data/" + path
+        if rel_path in self._paths:
+            raise BagError(_("%s has already been added to the bag") % rel_path)
+        self._paths.add(rel_path)
+
+        if hasattr(data, "read") and hasattr(data, "fileno"):
+            try:
+                st = os.fstat(data.fileno())
+            except (OSError, ValueError):
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                size = st.st_size - data.tell() if size is None else size
+                mtime = st.st_mtime if mtime is None else mtime
+                mode = stat.S_IMODE(st.st_mode) if mode is None else mode
+
+        LOGGER.info(_("Adding %s to the bag"), rel_path)
+
+        if self.archive is not None:
+            arcname = f"{self.bag_name}/{rel_path}"
+            if hasattr(data, "read"):
+                digests, byte_count = self.archive.add_stream(
+                    arcname, data, size, self.checksums, mtime=mtime, mode=mode or 0o644
+                )
+            else:
+                data = bytes(data)
+                self.archive.add_bytes(arcname, data, mtime=mtime, mode=mode or 0o644)
+                digests, byte_count = hash_bytes(data, self.checksums), len(data)
+        else:
+            digests, byte_count = self._write_file(os.path.join(self.data_dir, path), data)
+            if mode is not None:
+                os.chmod(os.path.join(self.data_dir, path), mode)
+            if mtime is not None:
+                os.utime(os.path.join(self.data_dir, path), (mtime, mtime))
+
+        for alg, digest in digests.items():
+            self._manifest_data[alg].append((rel_path, digest))
+        self.total_bytes += byte_count
+        self.total_files += 1
+
+        return digests
+
+    def _write_file(self, full_path, data):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        hashers = list(get_hashers(self.checksums).items())
+        total_bytes = 0
+
+        if hasattr(data, "read"):
+            blocks = iter(lambda: data.read(HASH_BLOCK_SIZE), b"")
+        else:
+            blocks = [data]
+
+        with open(full_path, "wb") as f:
+            for block in blocks:
+                total_bytes += len(block)
+                for alg, hasher in hashers:
+                    hasher.update(block)
+                f.write(block)
+
+        return {alg: h.hexdigest() for alg, h in hashers}, total_bytes
+
+    def add_directory(self, path, mtime=None, mode=None):
+        """Adds a directory, which may be empty, to the payload"""
+        path = self._payload_path(path)
+
+        if self.archive is not None:
+            self.archive.add_directory(f"{self.bag_name}/data/{path}", mtime=mtime, mode=mode or 0o755)
+        else:
+            full_path = os.path.join(self.data_dir, path)
+            os.makedirs(full_path, exist_ok=True)
+            if mode is not None:
+                os.chmod(full_path, mode)
+            if mtime is not None:
+                os.utime(full_path, (mtime, mtime))
+
+    def close(self):
+        """Writes the manifests, bag-info.txt and tag manifests"""
+        if self.closed:
+            return
+        self.closed = True
+
+        bag_info = _make_bag_info(self.bag_info, self.total_bytes, self.total_files)
+        bag_info_txt = format_tag_file(bag_info).encode("utf-8")
+
+        if self.archive is None:
+            tagmanifests = TagManifestBuilder(self.target, self.checksums, encoding=self.encoding)
+            for alg, entries in self._manifest_data.items():
+                tagmanifests.write(f"manifest-{alg}.txt", format_manifest(entries, self.encoding))
+            tagmanifests.write("bagit.txt", BAGIT_TXT.encode("utf-8"))
+            tagmanifests.write("bag-info.txt", bag_info_txt)
+            tagmanifests.save()
+            return
+
+        for alg, entries in self._manifest_data.items():
+            filename = f"manifest-{alg}.txt"
+            data = format_manifest(entries, self.encoding)
+            self.archive.add_bytes(f"{self.bag_name}/{filename}", data)
+            self._tag_digests[filename] = hash_bytes(data, self.checksums)
+
+        self.archive.add_bytes(f"{self.bag_name}/bag-info.txt", bag_info_txt)
+        self._tag_digests["bag-info.txt"] = hash_bytes(bag_info_txt, self.checksums)
+
+        for alg in self.checksums:
+            self.archive.add_bytes(
+                f"{self.bag_name}/tagmanifest-{alg}.txt",
+                format_tagmanifest(alg, self._tag_digests, self.encoding),
+            )
+
+        self.archive.close()
+
+    def abort(self):
+        """Discards the partially written bag"""
+        self.closed = True
+
+        if self.archive is not None:
+            try:
+                self.archive.close()
+            except Exception:  # The error which caused the abort is more useful
+                pass
+
+        if self._created:
+            if self.archive is None:
+                shutil.rmtree(self.target, ignore_errors=True)
+            elif os.path.exists(self.target):
+                os.unlink(self.target)
+
+
+def make_bag_archive(source_dir, archive, bag_info=None, checksums=None, encoding="utf-8", archive_type=None,
+                     bag_name=None):
+    """
+    Writes the contents of source_dir, which is left untouched, as a bag
+    directly into a tar or zip archive.
+
+    archive may be a path, in which case the format is taken from its suffix
+    (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz or .zip), or a writable binary
+    file object, which requires archive_type. The members are placed under a
+    top-level directory named bag_name, which defaults to the archive file
+    name without its suffix, or the name of source_dir for file objects.
+
+    Payload files are hashed while they are appended, so the source is read
+    only once. Source files which cannot be read are reported before the
+    archive is opened, so that nothing is written. Returns the Payload-Oxum as
+    a (total bytes, file count) tuple.
+    """
+    source_dir = os.path.abspath(source_dir)
+    is_path = isinstance(archive, str)
+
+    if not os.path.isdir(source_dir):
+        LOGGER.error(_("Bag directory %s does not exist"), source_dir)
+        raise RuntimeError(_("Bag directory %s does not exist") % source_dir)
+    if is_path and os.path.commonpath([source_dir, os.path.abspath(archive)]) == source_dir:
+        raise RuntimeError(_("The destination of a bag cannot be inside its source directory"))
+    if is_path and archive_type is None and archive_format(archive) is None:
+        raise BagError(_("Unable to determine the archive format for %s") % archive)
+
+    if bag_name is None and not is_path:
+        bag_name = os.path.basename(source_dir)
+
+    LOGGER.info(
+        _("Creating bag archive %(archive)s from %(source)s"), {"archive": archive, "source": source_dir}
+    )
+
+    scan = SourceScan(source_dir)
+
+    try:
+        rel_paths = list(scan.files())
+
+        # Copying only requires that the source can be read:
+        permissions = scan.permissions()
+        permissions["unwritable_dirs"] = permissions["unwritable_files"] = []
+        _report_directory_permissions(permissions)
+
+        with BagWriter(archive, bag_info=bag_info, checksums=checksums, encoding=encoding,
+                       archive_type=archive_type, bag_name=bag_name) as writer:
+            for rel_path in rel_paths:
+                with open(os.path.join(source_dir, rel_path), "rb") as f:
+                    writer.add_file(rel_path, f)
+
+            for directory in scan.directories:
+                st = os.stat(os.path.join(source_dir, directory))
+                writer.add_directory(directory, mtime=st.st_mtime, mode=stat.S_IMODE(st.st_mode))
+    except Exception:
+        LOGGER.exception(_("An error occurred creating a bag archive from %s"), source_dir)
+        raise
+
+    return writer.total_bytes, writer.total_files
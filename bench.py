@@ -1,81 +1,446 @@
 #!/usr/bin/env python3
 
 """
-This is a little benchmarking script to exercise bagit.make_bag and
-bagit.validate using 1-8 parallel processes. It will download some images
-from NASA for use in bagging the first time it is run.
+Benchmarks bag creation, manifest loading and validation on synthetic bags.
+
+The payloads are generated offline from a fixed seed, so every run measures
+the same bytes under the same names. Each shape stresses a different part of
+bagit:
+
+    tiny        many small files, where the cost per file dominates
+    huge        a few large files, where reading and hashing dominate
+    deep        long chains of nested directories
+    unicode     non-ASCII names in both NFC and NFD normalization
+    algorithms  moderate files with five checksum algorithms
+
+--scale multiplies the number of files (or, for huge, their size): the
+default run takes a minute or two, while --scale 100 makes the tiny shape
+two million files.
+
+Each operation runs in a fresh Python process, so that its peak RSS and
+system calls are its own. The read and write syscall counts come from
+/proc/self/io and are only available on Linux; they cover the main process
+and its threads, not pool worker processes, so compare them between runs
+using the same --processes. The payload is read from the page cache after
+the first run.
+
+Results are written as JSON together with the settings and environment of
+the run; --compare reports the change from an earlier results file and exits
+with status 1 if any measurement got worse by more than --threshold.
 """
 
-import ftplib
+import argparse
+import json
 import os
+import platform
+import random
 import shutil
-import timeit
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
 
-import bagit
-import bagit_modules.bagging
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
-# fetch some images from NASA to bag up
+#: The operations measured on every shape, in the order they are run
+OPERATIONS = ("create", "load", "validate", "fast", "completeness")
 
-if not os.path.isdir("bench-data"):
-    print("fetching some images to bag up from nasa")
-    os.mkdir("bench-data")
-    ftp = ftplib.FTP_TLS("nssdcftp.gsfc.nasa.gov")
-    ftp.login()
+#: Checksums used for every shape but "algorithms"
+DEFAULT_BENCH_CHECKSUMS = ["sha256", "sha512"]
 
-    ftp.cwd("/pub/misc/photo_gallery/hi-res/planetary/mars/")
-    files = []
-    ftp.retrlines("NLST", files.append)
+#: Measurements compared with --compare, where a larger value is worse
+COMPARED = ("wall_seconds", "cpu_seconds", "peak_rss_bytes", "read_syscalls", "write_syscalls")
 
-    for file in files:
-        print(("fetching %s" % file))
-        fh = open(os.path.join("bench-data", file), "wb")
-        ftp.retrbinary("RETR %s" % file, fh.write)
-        fh.close()
+#: Name stems for the unicode shape, written in both normalization forms
+UNICODE_STEMS = [
+    "café",
+    "Straße",
+    "naïve résumé",
+    "Ελληνικά",
+    "русский",
+    "日本語のファイル",
+    "한국어",
+    "עברית",
+    "emoji 😀",
+    "two  spaces",
+]
 
+BLOCK_SIZE = 1024 * 1024
 
-# create bags using 1-8 processes
 
-statement = """
-import os
-import bagit
+def make_tiny(root, scale, rng):
+    """Small files of 0-4095 bytes, a thousand per directory"""
+    for i in range(max(1, int(20000 * scale))):
+        path = os.path.join(root, "d%04d" % (i // 1000), "f%07d.txt" % i)
+        write_file(path, random_bytes(rng, rng.randrange(4096)))
 
-if os.path.isdir('bench-data/data'):
-    os.system("rm bench-data/bag*")
-    os.system("mv bench-data/data/* bench-data/")
-    os.system("rmdir bench-data/data")
 
-bagit.make_bag('bench-data', processes=%s)
-"""
+def make_huge(root, scale, rng):
+    """Three files of 128 MiB"""
+    block = random_bytes(rng, BLOCK_SIZE)
+    blocks = max(1, int(128 * scale))
+    for i in range(3):
+        path = os.path.join(root, "huge-%d.bin" % i)
+        with open(path, "wb") as f:
+            for j in range(blocks):
+                # Every block differs, so nothing can be deduplicated:
+                f.write(struct.pack("<QQ", i, j) + block[16:])
 
-for p in range(1, 9):
-    t = timeit.Timer(statement % p)
-    print(
-        ("create w/ %s processes: %.2f seconds " % (p, (10 * t.timeit(number=10) / 10)))
-    )
 
+def make_deep(root, scale, rng):
+    """Chains of 64 nested directories with a few files at every level"""
+    for chain in range(max(1, int(10 * scale))):
+        directory = os.path.join(root, "chain%03d" % chain)
+        for level in range(64):
+            directory = os.path.join(directory, "l%02d" % level)
+            for i in range(3):
+                write_file(os.path.join(directory, "f%d" % i), random_bytes(rng, rng.randrange(2048)))
 
-# validate a bag with 1-8 processes
 
-shutil.copytree("bench-data", "bench-data-bag")
-bagit_modules.bagging.make_bag("bench-data-bag")
+def make_unicode(root, scale, rng):
+    """Files with non-ASCII names, in separate NFC and NFD directories"""
+    for i in range(max(1, int(2000 * scale))):
+        stem = UNICODE_STEMS[i % len(UNICODE_STEMS)]
+        for form in ("NFC", "NFD"):
+            path = unicodedata.normalize(form, os.path.join(form, stem, "%s %05d.txt" % (stem, i)))
+            write_file(os.path.join(root, path), random_bytes(rng, rng.randrange(8192)))
 
-# validate bench-data using n processes
-statement = """
-import os
-import bagit
 
-bag = bagit.Bag('bench-data-bag')
-bag.validate(processes=%s)
-"""
+def make_algorithms(root, scale, rng):
+    """Files of 16-64 KiB"""
+    for i in range(max(1, int(2000 * scale))):
+        path = os.path.join(root, "d%02d" % (i // 100), "f%05d.bin" % i)
+        write_file(path, random_bytes(rng, rng.randrange(16384, 65536)))
+
+
+#: {name: (generator, checksums)}
+SHAPES = {
+    "tiny": (make_tiny, DEFAULT_BENCH_CHECKSUMS),
+    "huge": (make_huge, DEFAULT_BENCH_CHECKSUMS),
+    "deep": (make_deep, DEFAULT_BENCH_CHECKSUMS),
+    "unicode": (make_unicode, DEFAULT_BENCH_CHECKSUMS),
+    "algorithms": (make_algorithms, ["md5", "sha1", "sha256", "sha512", "blake2b"]),
+}
+
+
+def random_bytes(rng, n):
+    """Returns the same bytes as rng.randbytes(n), which needs Python 3.9"""
+    # getrandbits(0) raises ValueError before Python 3.9:
+    return rng.getrandbits(8 * n).to_bytes(n, "little") if n else b""
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def generate(shape, root, scale, seed):
+    """Writes the payload of shape into root, returning its (files, bytes)"""
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    generator = SHAPES[shape][0]
+    generator(root, scale, random.Random("%s-%s" % (seed, shape)))
 
-# try 1-8 parallel processes
-for p in range(1, 9):
-    t = timeit.Timer(statement % p)
-    print(
-        (
-            "validate w/ %s processes: %.2f seconds "
-            % (p, (10 * t.timeit(number=10) / 10))
+    files = byte_count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            files += 1
+            byte_count += os.path.getsize(os.path.join(dirpath, filename))
+    return files, byte_count
+
+
+def unbag(path):
+    """Turns a bag back into the directory it was made from"""
+    data_dir = os.path.join(path, "data")
+    for name in os.listdir(path):
+        if name != "data":
+            os.remove(os.path.join(path, name))
+    for name in os.listdir(data_dir):
+        os.rename(os.path.join(data_dir, name), os.path.join(path, name))
+    os.rmdir(data_dir)
+
+
+def read_proc_io():
+    """Returns the counters in /proc/self/io, or {} where it is not available"""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def cpu_seconds():
+    if resource is None:
+        return time.process_time()
+    usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return sum(i.ru_utime + i.ru_stime for i in usage)
+
+
+def peak_rss():
+    """Returns the peak RSS in bytes of this process and of its largest child"""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes:
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+def measure(spec):
+    """Runs one operation in this process, returning its measurements"""
+    import bagit_modules.bag
+    import bagit_modules.bagging
+
+    operation, path, processes = spec["operation"], spec["path"], spec["processes"]
+
+    io_before = read_proc_io()
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+
+    if operation == "create":
+        bagit_modules.bagging.make_bag(path, checksums=spec["checksums"], processes=processes)
+    elif operation == "load":
+        bagit_modules.bag.Bag(path)
+    else:
+        bag = bagit_modules.bag.Bag(path)
+        bag.validate(
+            processes=processes,
+            fast=operation == "fast",
+            completeness_only=operation == "completeness",
         )
+
+    wall = time.perf_counter() - started
+    cpu = cpu_seconds() - cpu_before
+    io_after = read_proc_io()
+    main_rss, worker_rss = peak_rss()
+
+    def io_delta(key):
+        return io_after[key] - io_before[key] if key in io_after else None
+
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_rss_bytes": main_rss,
+        "peak_worker_rss_bytes": worker_rss,
+        "read_syscalls": io_delta("syscr"),
+        "write_syscalls": io_delta("syscw"),
+        "read_bytes": io_delta("rchar"),
+        "written_bytes": io_delta("wchar"),
+    }
+
+
+def run_measured(spec):
+    """Runs measure(spec) in a new Python process"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--measure", json.dumps(spec)],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def summarize(runs):
+    """Returns the median of every measurement, with the runs it came from"""
+    summary = {}
+    for key in runs[0]:
+        values = [i[key] for i in runs if i[key] is not None]
+        summary[key] = statistics.median(values) if values else None
+    summary["runs"] = runs
+    return summary
+
+
+def run_benchmarks(args):
+    results = []
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bagit-bench-")
+    try:
+        for shape in args.shapes:
+            checksums = SHAPES[shape][1]
+            path = os.path.join(workdir, shape)
+            print("generating %s..." % shape, file=sys.stderr)
+            files, byte_count = generate(shape, path, args.scale, args.seed)
+
+            for processes in args.processes:
+                runs = {operation: [] for operation in OPERATIONS}
+                for repeat in range(args.repeat):
+                    if repeat:
+                        unbag(path)
+                    for operation in OPERATIONS:
+                        spec = {
+                            "operation": operation,
+                            "path": path,
+                            "processes": processes,
+                            "checksums": checksums,
+                        }
+                        runs[operation].append(run_measured(spec))
+
+                for operation in OPERATIONS:
+                    result = {
+                        "shape": shape,
+                        "operation": operation,
+                        "processes": processes,
+                        "checksums": checksums,
+                        "files": files,
+                        "bytes": byte_count,
+                    }
+                    result.update(summarize(runs[operation]))
+                    results.append(result)
+                    print(
+                        "%-10s %-12s processes=%-2d %8.3fs %8.1f MiB"
+                        % (
+                            shape,
+                            operation,
+                            processes,
+                            result["wall_seconds"],
+                            result["peak_rss_bytes"] / 2 ** 20,
+                        ),
+                        file=sys.stderr,
+                    )
+
+            shutil.rmtree(path)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "settings": {
+            "shapes": args.shapes,
+            "scale": args.scale,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "processes": args.processes,
+        },
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def environment():
+    import bagit_modules.versioning
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "bagit_version": bagit_modules.versioning.get_version(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def compare(baseline, current, threshold):
+    """Prints the change of every measurement from baseline, returning the number of regressions"""
+    previous = {(i["shape"], i["operation"], i["processes"]): i for i in baseline["results"]}
+    regressions = 0
+
+    for result in current["results"]:
+        key = (result["shape"], result["operation"], result["processes"])
+        if key not in previous:
+            continue
+        changes = []
+        for measurement in COMPARED:
+            old, new = previous[key].get(measurement), result.get(measurement)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            changes.append("%s %+.1f%%%s" % (measurement, (ratio - 1) * 100, flag))
+        print("%-10s %-12s processes=%-2d %s" % (key + ("; ".join(changes),)))
+
+    return regressions
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--shapes",
+        type=lambda value: value.split(","),
+        default=list(SHAPES),
+        help="Comma-separated shapes to benchmark (default: %s)" % ",".join(SHAPES),
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the size of every shape")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated payloads")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of each operation; the median is reported"
+    )
+    parser.add_argument(
+        "--processes", type=int, nargs="+", default=[1], help="Numbers of processes to measure (default: 1)"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for the generated bags (default: a temporary directory)"
+    )
+    parser.add_argument("--output", default="bench_results.json", help="File the results are written to")
+    parser.add_argument("--load", metavar="RESULTS", help="Compare saved results instead of running")
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="Report the change from an earlier results file"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative increase reported as a regression (default: 0.1)",
     )
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(json.loads(args.measure))))
+        return 0
+
+    unknown = set(args.shapes).difference(SHAPES)
+    if unknown:
+        make_parser().error("unknown shapes: %s" % ", ".join(sorted(unknown)))
+
+    if args.load:
+        with open(args.load) as f:
+            current = json.load(f)
+    else:
+        current = run_benchmarks(args)
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("results written to %s" % args.output, file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print("%d regressions" % regressions, file=sys.stderr)
+            return 1
+
+    return 0
+
 
-shutil.rmtree("bench-data-bag")
+if __name__ == "__main__":
+    sys.exit(main())
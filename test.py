@@ -5,26 +5,48 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import codecs
 import datetime
 import hashlib
+import io
+import json
 import logging
 import os
+import pickle
 import shutil
 import stat
+import subprocess
 import sys
+import tarfile
 import tempfile
+import time
 import unicodedata
 import unittest
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import join as j
 
 import mock
 from io import StringIO
 
 import bagit
+import bagit_modules.archive
 import bagit_modules.bag
 import bagit_modules.bagging
 import bagit_modules.errors
+import bagit_modules.events
+import bagit_modules.hashcore
+import bagit_modules.hashing
 import bagit_modules.io
+import bagit_modules.logging
 import bagit_modules.manifests
+import bagit_modules.metrics
+import bagit_modules.parsing
+import bagit_modules.planning
+import bagit_modules.profiling
+import bagit_modules.progress
 import bagit_modules.string_ops
+import bagit_modules.throttle
+import bagit_modules.versioning
+import bagit_modules.workers
+import bagit_modules.writer
 
 logging.basicConfig(filename="test.log", level=logging.DEBUG)
 stderr = logging.StreamHandler()
@@ -749,6 +771,869 @@ Tag-File-Character-Encoding: UTF-8
         bagit_modules.bagging.make_bag(self.tmpdir, processes=2)
         self.assertTrue(os.path.isdir(j(self.tmpdir, "data")))
 
+    def test_make_bag_pipeline(self):
+        other_dir = tempfile.mkdtemp()
+        shutil.rmtree(other_dir)
+        shutil.copytree("test-data", other_dir)
+        self.addCleanup(shutil.rmtree, other_dir)
+
+        for processes in (1, 2):
+            bag_dir = self.tmpdir if processes == 1 else other_dir
+            info = {"Bagging-Date": "1970-01-01"}
+            bagit_modules.bagging.make_bag(
+                bag_dir, bag_info=info, checksums=["md5", "sha256"], processes=processes, pipeline=True
+            )
+
+            manifest_txt = slurp_text_file(j(bag_dir, "manifest-md5.txt")).splitlines()
+            self.assertEqual(5, len(manifest_txt))
+            self.assertEqual("8e2af7a0143c7b8f4de0b3fc90f27354  data/README", manifest_txt[0])
+            self.assertIn("Payload-Oxum: 991765.5", slurp_text_file(j(bag_dir, "bag-info.txt")))
+
+            # Tag manifests are built from memory but must match what is on disk:
+            tagmanifest_txt = slurp_text_file(j(bag_dir, "tagmanifest-sha256.txt")).splitlines()
+            self.assertEqual(4, len(tagmanifest_txt))
+            for line in tagmanifest_txt:
+                digest, filename = line.split(" ", 1)
+                with open(j(bag_dir, filename), "rb") as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), digest)
+
+        self.assertEqual(
+            slurp_text_file(j(self.tmpdir, "manifest-sha256.txt")),
+            slurp_text_file(j(other_dir, "manifest-sha256.txt")),
+        )
+
+    def test_make_bag_pipeline_stops_on_permissions(self):
+        for i in range(100):
+            with open(j(self.tmpdir, "small-%03d.txt" % i), "w") as f:
+                f.write(str(i))
+        unwritable = j(self.tmpdir, "README")
+        access = os.access
+
+        def fake_access(path, mode):
+            return (path, mode) != (unwritable, os.W_OK) and access(path, mode)
+
+        # Hashing is slowed down so that the traversal ends long before it:
+        throttle = bagit_modules.throttle.Throttle(files_per_second=200)
+        events = []
+        progress = bagit_modules.progress.Progress(events.append, interval=0)
+        with mock.patch("os.access", fake_access):
+            with self.assertRaises(bagit_modules.errors.BagError) as error_catcher:
+                bagit_modules.bagging.make_bag(
+                    self.tmpdir, pipeline=True, throttle=throttle, progress=progress
+                )
+        self.assertEqual(
+            "Write permissions are required to move all files and directories", str(error_catcher.exception)
+        )
+
+        # The remaining files were not hashed and nothing was moved:
+        self.assertNotIn(("end", "hashing"), [(i.kind, i.phase) for i in events])
+        self.assertLess(max(i.files_done for i in events if i.phase == "hashing"), 100)
+        self.assertFalse(os.path.exists(j(self.tmpdir, "data")))
+
+    def test_shared_executor(self):
+        other_dir = j(tempfile.mkdtemp(), "bag")
+        shutil.copytree("test-data", other_dir)
+        self.addCleanup(shutil.rmtree, os.path.dirname(other_dir))
+
+        for executor_class in (ThreadPoolExecutor, ProcessPoolExecutor):
+            with executor_class(max_workers=2) as executor:
+                with mock.patch("multiprocessing.Pool") as pool:
+                    bag = bagit_modules.bagging.make_bag(self.tmpdir, executor=executor)
+                    self.assertTrue(bag.validate(executor=executor))
+                    self.assertTrue(bag.is_valid(pipeline=True, executor=executor))
+
+                    with open(j(self.tmpdir, "data", "README"), "a") as f:
+                        f.write("changed")
+                    self.assertFalse(bag.is_valid(executor=executor))
+                    bag.save(manifests=True, executor=executor)
+                    self.assertTrue(bag.is_valid(executor=executor))
+
+                    other = bagit_modules.bagging.make_bag(other_dir, pipeline=True, executor=executor)
+                    self.assertTrue(other.is_valid(executor=executor))
+
+                    archive = j(os.path.dirname(other_dir), "bag.zip")
+                    bagit_modules.writer.make_bag_archive(self.tmpdir, archive)
+                    self.assertTrue(bagit_modules.archive.ArchivedBag(archive).is_valid(executor=executor))
+
+                self.assertFalse(pool.called)
+
+            for path in (self.tmpdir, other_dir):
+                shutil.rmtree(path)
+                shutil.copytree("test-data", path)
+            os.unlink(archive)
+
+    def test_worker_hash_results(self):
+        rel_paths = ["README", "missing", j("si", "2584174182_ffd5c24905_b_d.jpg")]
+        expected = []
+        for rel_path in (rel_paths[0], rel_paths[2]):
+            with open(j(self.tmpdir, rel_path), "rb") as f:
+                data = f.read()
+            expected.append(((hashlib.md5(data).digest(), hashlib.sha256(data).digest()), len(data), None))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for options in ({"processes": 1}, {"processes": 2}, {"executor": executor}):
+                results = bagit_modules.workers.hash_files(
+                    self.tmpdir, rel_paths, ["md5", "sha256"], **options
+                )
+                self.assertEqual(expected, [results[0], results[2]])
+                self.assertIsNone(results[1][0])
+                self.assertIn("Could not read", results[1][2])
+
+        # Digests are compared as bytes, so the case used in manifests does not matter:
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"])
+        with open(j(self.tmpdir, "manifest-md5.txt"), "r+") as f:
+            lines = [line.split(" ", 1) for line in f.read().splitlines()]
+            f.seek(0)
+            f.write("".join("%s %s\n" % (digest.upper(), path) for digest, path in lines))
+        os.remove(j(self.tmpdir, "tagmanifest-md5.txt"))
+        bag = bagit_modules.bag.Bag(self.tmpdir)
+        self.assertTrue(bag.validate(processes=2))
+
+    def test_make_bag_copy(self):
+        dest = j(tempfile.mkdtemp(), "bag")
+        self.addCleanup(shutil.rmtree, os.path.dirname(dest))
+        os.mkdir(j(self.tmpdir, "empty"))
+        before = sorted(os.listdir(self.tmpdir))
+
+        for processes in (1, 2):
+            bag = bagit_modules.bagging.make_bag(
+                self.tmpdir, checksums=["md5", "sha256"], processes=processes, dest=dest
+            )
+            self.assertTrue(bag.is_valid())
+            self.assertEqual(before, sorted(os.listdir(self.tmpdir)))
+            self.assertTrue(os.path.isdir(j(dest, "data", "empty")))
+            self.assertIn("Payload-Oxum: 991765.5", slurp_text_file(j(dest, "bag-info.txt")))
+            copied = slurp_text_file(j(dest, "manifest-sha256.txt"))
+            shutil.rmtree(dest)
+
+        bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5", "sha256"])
+        self.assertEqual(slurp_text_file(j(self.tmpdir, "manifest-sha256.txt")), copied)
+
+        # The destination must be empty and outside the source:
+        self.assertRaises(RuntimeError, bagit_modules.bagging.make_bag, "test-data", dest=self.tmpdir)
+        self.assertRaises(
+            RuntimeError, bagit_modules.bagging.make_bag, self.tmpdir, dest=j(self.tmpdir, "bag")
+        )
+
+    def test_make_bag_archive(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        before = sorted(os.listdir(self.tmpdir))
+
+        for filename in ("bag.tar.gz", "bag.zip"):
+            archive = j(out_dir, filename)
+            oxum = bagit_modules.writer.make_bag_archive(self.tmpdir, archive, checksums=["md5", "sha256"])
+            self.assertEqual((991765, 5), oxum)
+            self.assertEqual(before, sorted(os.listdir(self.tmpdir)))
+
+            shutil.unpack_archive(archive, j(out_dir, filename + ".d"))
+            bag = bagit_modules.bag.Bag(j(out_dir, filename + ".d", "bag"))
+            self.assertTrue(bag.is_valid())
+            self.assertEqual(5, len(list(bag.payload_files())))
+
+        # Unseekable targets are written with the streaming tar mode:
+        stream = io.BytesIO()
+        bagit_modules.writer.make_bag_archive(self.tmpdir, stream, archive_type="tar", bag_name="streamed")
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            names = tar.getnames()
+        self.assertEqual("streamed/bagit.txt", names[1])
+        self.assertEqual("streamed/tagmanifest-sha512.txt", names[-1])
+
+        # The manifests match a bag made in place:
+        bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5", "sha256"])
+        self.assertEqual(
+            slurp_text_file(j(self.tmpdir, "manifest-sha256.txt")),
+            slurp_text_file(j(out_dir, "bag.zip.d", "bag", "manifest-sha256.txt")),
+        )
+
+    def test_make_bag_archive_unreadable(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        unreadable = j(self.tmpdir, "README")
+        access = os.access
+
+        def fake_access(path, mode):
+            return (path, mode) != (unreadable, os.R_OK) and access(path, mode)
+
+        # Neither a new archive nor an existing file is written:
+        archive = j(out_dir, "bag.zip")
+        for existing in (False, True):
+            if existing:
+                with open(archive, "wb") as f:
+                    f.write(b"existing")
+            with mock.patch("os.access", fake_access), mock.patch("builtins.open", wraps=open) as opened:
+                with self.assertRaises(bagit_modules.errors.BagError):
+                    bagit_modules.writer.make_bag_archive(self.tmpdir, archive)
+            # No source file was read either:
+            self.assertEqual(0, opened.call_count)
+            if existing:
+                with open(archive, "rb") as f:
+                    self.assertEqual(b"existing", f.read())
+            else:
+                self.assertFalse(os.path.exists(archive))
+
+    def test_bag_writer(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+
+        for target in ("bag", "bag.tar.gz"):
+            with bagit_modules.writer.BagWriter(j(out_dir, target), checksums=["md5"]) as writer:
+                digests = writer.add_file("exports/report.csv", b"a,b\n1,2\n")
+                writer.add_file("renders/frame.bin", io.BytesIO(b"\0" * 100000))
+                with open(j(self.tmpdir, "README"), "rb") as f:
+                    writer.add_file("README", f)
+                writer.add_directory("empty")
+
+                self.assertRaises(bagit_modules.errors.BagError, writer.add_file, "README", b"")
+                self.assertRaises(bagit_modules.errors.BagError, writer.add_file, "../escape", b"")
+
+            self.assertEqual({"md5": hashlib.md5(b"a,b\n1,2\n").hexdigest()}, digests)
+            self.assertEqual((100229, 3), (writer.total_bytes, writer.total_files))
+
+        bag = bagit_modules.bag.Bag(j(out_dir, "bag"))
+        self.assertTrue(bag.is_valid())
+        self.assertTrue(os.path.isdir(j(out_dir, "bag", "data", "empty")))
+        self.assertEqual("100229.3", bag.info["Payload-Oxum"])
+
+        bag = bagit_modules.archive.ArchivedBag(j(out_dir, "bag.tar.gz"))
+        self.assertTrue(bag.is_valid())
+        self.assertEqual(
+            slurp_text_file(j(out_dir, "bag", "manifest-md5.txt")).splitlines(),
+            bag._tag_data["manifest-md5.txt"].decode("utf-8").splitlines(),
+        )
+
+        # A bag which fails part way through is removed:
+        with self.assertRaises(ValueError):
+            with bagit_modules.writer.BagWriter(j(out_dir, "failed.zip")) as writer:
+                writer.add_file("README", b"README")
+                raise ValueError("render failed")
+        self.assertFalse(os.path.exists(j(out_dir, "failed.zip")))
+
+    def test_validate_archive(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+
+        for filename in ("bag.tar.gz", "bag.zip"):
+            archive = j(out_dir, filename)
+            bagit_modules.writer.make_bag_archive(self.tmpdir, archive, checksums=["md5", "sha1"])
+            for processes in (1, 2):
+                bag = bagit_modules.archive.ArchivedBag(archive)
+                self.assertTrue(bag.validate(processes=processes))
+            self.assertEqual("991765.5", bag.info["Payload-Oxum"])
+            self.assertRaises(bagit_modules.errors.BagError, bag.save)
+
+        # The payload is only hashed when its fixity is checked, in one pass:
+        hash_stream = bagit_modules.archive.hash_stream
+        with mock.patch("bagit_modules.archive.hash_stream", wraps=hash_stream) as hashed:
+            bag = bagit_modules.archive.ArchivedBag(j(out_dir, "bag.tar.gz"))
+            self.assertTrue(bag.validate(fast=True))
+            self.assertTrue(bag.validate(completeness_only=True))
+            self.assertEqual(0, hashed.call_count)
+            self.assertTrue(bag.validate())
+            self.assertTrue(bag.validate(algorithms="strongest"))
+            self.assertEqual(5, hashed.call_count)
+
+        # Zip archives opened by worker threads are closed when they finish:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            bag = bagit_modules.archive.ArchivedBag(j(out_dir, "bag.zip"))
+            self.assertTrue(bag.validate(executor=executor))
+        self.assertEqual({}, bagit_modules.archive._open_zip_archives)
+
+        # Rewrite the zip with one payload file altered or removed:
+        for bad_filename, skip in (("altered.zip", False), ("missing.zip", True)):
+            with zipfile.ZipFile(j(out_dir, "bag.zip")) as src:
+                with zipfile.ZipFile(j(out_dir, bad_filename), "w") as dest:
+                    for info in src.infolist():
+                        data = src.read(info)
+                        if info.filename == "bag/data/README":
+                            if skip:
+                                continue
+                            data = data.replace(b"a", b"b")
+                        dest.writestr(info, data)
+
+        bag = bagit_modules.archive.ArchivedBag(j(out_dir, "altered.zip"))
+        with self.assertRaises(bagit_modules.errors.BagValidationError) as cm:
+            bag.validate(processes=2)
+        self.assertEqual(
+            [("data/README", "md5"), ("data/README", "sha1")],
+            sorted((i.path.replace(os.sep, "/"), i.algorithm) for i in cm.exception.details),
+        )
+
+        bag = bagit_modules.archive.ArchivedBag(j(out_dir, "missing.zip"))
+        del bag.info["Payload-Oxum"]
+        with self.assertRaises(bagit_modules.errors.BagValidationError) as cm:
+            bag.validate(completeness_only=True)
+        self.assertIsInstance(cm.exception.details[0], bagit_modules.errors.FileMissing)
+
+        # Nothing was extracted:
+        self.assertEqual(
+            ["altered.zip", "bag.tar.gz", "bag.zip", "missing.zip"], sorted(os.listdir(out_dir))
+        )
+
+    def test_tagmanifest_digests(self):
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5", "sha1"])
+        bag.info["Contact-Email"] = "ehs@pobox.com"
+        bag.save()
+
+        for alg in ("md5", "sha1"):
+            tagmanifest_txt = slurp_text_file(j(self.tmpdir, "tagmanifest-%s.txt" % alg)).splitlines()
+            self.assertEqual(
+                ["bag-info.txt", "bagit.txt", "manifest-md5.txt", "manifest-sha1.txt"],
+                sorted(i.split(" ", 1)[1] for i in tagmanifest_txt),
+            )
+            # Every file must be hashed on its own rather than accumulating:
+            for line in tagmanifest_txt:
+                digest, filename = line.split(" ", 1)
+                with open(j(self.tmpdir, filename), "rb") as f:
+                    self.assertEqual(hashlib.new(alg, f.read()).hexdigest(), digest)
+
+    def test_validate_algorithm_policy(self):
+        select = bagit_modules.hashing.select_algorithms
+        self.assertEqual(["md5", "sha512"], select(["md5", "sha512"], "all"))
+        self.assertEqual(["sha512"], select(["md5", "sha256", "sha512"], "strongest"))
+        self.assertIn(select(["md5", "sha256", "sha512"], "fastest")[0], ["md5", "sha256", "sha512"])
+        self.assertEqual(["sha256"], select(["md5", "sha256"], "sha256,sha1"))
+        self.assertRaises(ValueError, select, ["md5", "sha256"], ["sha1"])
+
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5", "sha256"])
+        bag.entries["data/README"]["md5"] = "0" * 32
+
+        for pipeline in (False, True):
+            self.assertTrue(bag.validate(algorithms="strongest", pipeline=pipeline))
+            self.assertTrue(bag.validate(algorithms=["sha256"], pipeline=pipeline))
+            self.assertRaises(bagit_modules.errors.BagValidationError, bag.validate, pipeline=pipeline)
+            self.assertRaises(
+                bagit_modules.errors.BagValidationError, bag.validate, algorithms="md5", pipeline=pipeline
+            )
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, algorithms="sha1")
+
+        # Entries missing from the chosen manifest are checked with their own:
+        del bag.entries["data/README"]["sha256"]
+        self.assertEqual(["sha256", "md5"], bag._select_algorithms("strongest"))
+        self.assertRaises(bagit_modules.errors.BagValidationError, bag.validate, algorithms="strongest")
+
+    def test_cache_policy(self):
+        readme = j(self.tmpdir, "README")
+        with open(readme, "rb") as f:
+            expected = f.read()
+        for cache in bagit_modules.hashcore.CACHE_POLICIES:
+            data = b"".join(bytes(i) for i in bagit_modules.hashcore.read_blocks(readme, cache))
+            self.assertEqual(expected, data)
+        self.assertRaises(ValueError, list, bagit_modules.hashcore.read_blocks(readme, "bogus"))
+
+        with mock.patch("bagit_modules.hashcore.CACHE_DROP_INTERVAL", 4096), \
+                mock.patch("os.posix_fadvise", create=True) as fadvise:
+            bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], cache="drop")
+        advice = {i[0][3] for i in fadvise.call_args_list}
+        self.assertEqual({os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_DONTNEED}, advice)
+
+        for cache in ("normal", "drop", "direct"):
+            for pipeline in (False, True):
+                self.assertTrue(bag.validate(processes=2, cache=cache, pipeline=pipeline))
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, cache="bogus")
+        self.assertRaises(
+            bagit_modules.errors.BagError, bagit_modules.bagging.make_bag, self.tmpdir, cache="bogus"
+        )
+
+        dest = j(self.tmpdir, "..", os.path.basename(self.tmpdir) + "-copy")
+        try:
+            bag = bagit_modules.bagging.make_bag(j(self.tmpdir, "data"), dest=dest, cache="direct")
+            self.assertTrue(bag.validate(cache="direct"))
+        finally:
+            shutil.rmtree(dest, ignore_errors=True)
+
+    def test_sparse_file_hashing(self):
+        sparse = j(self.tmpdir, "sparse.img")
+        with open(sparse, "wb") as f:
+            f.truncate(16 * 1024 * 1024)
+            f.seek(5 * 1024 * 1024 + 123)
+            f.write(b"data" * 100000)
+            f.seek(12 * 1024 * 1024)
+            f.write(b"more data")
+        with open(sparse, "rb") as f:
+            contents = f.read()
+
+        fd = os.open(sparse, os.O_RDONLY)
+        try:
+            extents = list(bagit_modules.hashcore._file_extents(fd))
+        finally:
+            os.close(fd)
+        mapped = sum(length for offset, length, is_data in extents if length is not None)
+        self.assertEqual(len(contents), mapped)
+        if len(extents) == 1:
+            self.skipTest("The filesystem does not report holes in sparse files")
+        data_bytes = sum(length for offset, length, is_data in extents if is_data)
+        self.assertLess(data_bytes, len(contents) / 2)
+
+        for cache in bagit_modules.hashcore.CACHE_POLICIES:
+            self.assertEqual(
+                contents, b"".join(bytes(i) for i in bagit_modules.hashcore.read_blocks(sparse, cache))
+            )
+
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["sha256"])
+        self.assertEqual(
+            hashlib.sha256(contents).hexdigest(), bag.payload_entries()["data/sparse.img"]["sha256"]
+        )
+        self.assertTrue(bag.validate(cache="direct"))
+
+    def test_throttle(self):
+        throttle = bagit_modules.throttle.Throttle(files_per_second=20)
+        self.assertIs(throttle, pickle.loads(pickle.dumps(throttle)))
+        share = throttle.split(4)
+        self.assertEqual((5, None, False), (share.files_per_second, share.bytes_per_second, share.shared))
+        self.assertRaises(ValueError, bagit_modules.throttle.Throttle, bytes_per_second=0)
+        self.assertRaises(ValueError, bagit_modules.throttle.Throttle, ionice="bogus")
+        self.assertRaises(ValueError, bagit_modules.throttle.Throttle, ionice="idle:9")
+
+        bag = bagit_modules.bagging.make_bag(
+            self.tmpdir, checksums=["md5"], processes=2, pipeline=True, throttle=throttle
+        )
+        file_count = len(bag.entries)
+
+        # The limit applies to the workers combined, not to each of them:
+        started = time.monotonic()
+        self.assertTrue(bag.validate(processes=2, throttle=throttle))
+        self.assertGreaterEqual(time.monotonic() - started, (file_count - 1) / 20.0 * 0.9)
+
+        throttle = bagit_modules.throttle.Throttle(bytes_per_second=2 * 1024 * 1024, nice=1)
+        started = time.monotonic()
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            self.assertTrue(bag.validate(executor=executor, throttle=throttle))
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+
+        # Reading the files in this process leaves its priority alone, with a warning:
+        priority = os.getpriority(os.PRIO_PROCESS, 0)
+        with self.assertLogs(level="WARNING") as captured:
+            self.assertTrue(bag.validate(throttle=bagit_modules.throttle.Throttle(nice=1)))
+        self.assertIn("nice and ionice only apply to worker processes", "\n".join(captured.output))
+        self.assertEqual(priority, os.getpriority(os.PRIO_PROCESS, 0))
+
+        # The command line lowers its own priority, which serial hashing uses too:
+        code = (
+            "import os, sys, bagit\n"
+            "try:\n"
+            "    bagit.main()\n"
+            "except SystemExit:\n"
+            "    print(os.getpriority(0, 0))"
+        )
+        output = subprocess.check_output(
+            [sys.executable, "-c", code, "--validate", "--nice", "1", "--quiet", self.tmpdir],
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bagit.__file__))),
+        )
+        self.assertEqual(priority + 1, int(output))
+
+        # Workers of a caller's executor only keep the most recent runs' throttles:
+        for i in range(3 * bagit_modules.throttle.LOCAL_THROTTLE_LIMIT):
+            bagit_modules.throttle._restore_throttle(("other", i), None, 5, None, None, -1, None)
+        self.assertEqual(
+            bagit_modules.throttle.LOCAL_THROTTLE_LIMIT, len(bagit_modules.throttle._local_throttles)
+        )
+
+        self.assertEqual(50 * 1024 * 1024, bagit_modules.parsing.parse_byte_rate("50M"))
+        self.assertEqual(1536, bagit_modules.parsing.parse_byte_rate("1.5KiB"))
+
+    def test_hard_links_hashed_once(self):
+        original = j(self.tmpdir, "si", "2584174182_ffd5c24905_b_d.jpg")
+        for i in range(3):
+            os.link(original, j(self.tmpdir, "si", "link-%d.jpg" % i))
+
+        read_blocks = bagit_modules.hashcore.read_blocks
+        for pipeline in (False, True):
+            with mock.patch("bagit_modules.hashcore.read_blocks", wraps=read_blocks) as reads:
+                bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], pipeline=pipeline)
+            read_paths = [os.path.basename(i[0][0]) for i in reads.call_args_list]
+            self.assertEqual(5, len(read_paths))
+            self.assertNotIn("link-0.jpg", read_paths)
+
+            # Every path is still listed, with the digest of the original:
+            entries = bag.payload_entries()
+            self.assertEqual(8, len(entries))
+            self.assertEqual(
+                {entries["data/si/2584174182_ffd5c24905_b_d.jpg"]["md5"]},
+                {entries["data/si/link-%d.jpg" % i]["md5"] for i in range(3)},
+            )
+            self.assertEqual("2137204.8", bag.info["Payload-Oxum"])
+
+            with mock.patch("bagit_modules.hashcore.read_blocks", wraps=read_blocks) as reads:
+                self.assertTrue(bag.validate(pipeline=pipeline))
+            read_paths = [os.path.basename(i[0][0]) for i in reads.call_args_list]
+            linked = [i for i in read_paths if i.endswith(".jpg") and i.startswith(("2584", "link"))]
+            self.assertEqual(1, len(linked))
+
+            bag.entries["data/si/link-2.jpg"]["md5"] = "0" * 32
+            with self.assertRaises(bagit_modules.errors.BagValidationError) as error_catcher:
+                bag.validate()
+            self.assertEqual(["data/si/link-2.jpg"], [i.path for i in error_catcher.exception.details])
+
+            shutil.rmtree(self.tmpdir)
+            shutil.copytree("test-data", self.tmpdir)
+            for i in range(3):
+                os.link(original, j(self.tmpdir, "si", "link-%d.jpg" % i))
+
+    def test_hash_order(self):
+        read_blocks = bagit_modules.hashcore.read_blocks
+        inodes = []
+
+        def record_inode(full_path, *args):
+            inodes.append(os.stat(full_path).st_ino)
+            return read_blocks(full_path, *args)
+
+        manifests = set()
+        for order in bagit_modules.workers.HASH_ORDERS:
+            for pipeline in (False, True):
+                bag_dir = j(self.tmpdir, "%s-%s" % (order, pipeline))
+                shutil.copytree("test-data", bag_dir)
+                del inodes[:]
+                with mock.patch("bagit_modules.hashcore.read_blocks", side_effect=record_inode):
+                    bag = bagit_modules.bagging.make_bag(
+                        bag_dir, checksums=["md5"], pipeline=pipeline, order=order
+                    )
+                with open(j(bag_dir, "manifest-md5.txt")) as f:
+                    manifests.add(f.read())
+
+                self.assertEqual(5, len(inodes))
+                if order == "inode":
+                    self.assertEqual(sorted(inodes), inodes)
+
+                for processes in (1, 2):
+                    self.assertTrue(bag.validate(processes=processes, pipeline=pipeline, order=order))
+
+        # The manifests do not depend on the order in which files were hashed:
+        self.assertEqual(1, len(manifests))
+
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, order="random")
+        self.assertRaises(
+            bagit_modules.errors.BagError, bagit_modules.bagging.make_bag, self.tmpdir, order="random"
+        )
+
+    def test_device_processes(self):
+        for disk in ("disk-a", "disk-b"):
+            os.makedirs(j(self.tmpdir, disk))
+            for i in range(6):
+                with open(j(self.tmpdir, disk, "%d.txt" % i), "w") as f:
+                    f.write("%s %d" % (disk, i))
+        rel_paths = sorted(
+            j(disk, name) for disk in ("disk-a", "disk-b") for name in os.listdir(j(self.tmpdir, disk))
+        )
+
+        # Pretend that disk-b is a separate device:
+        real_stat = os.stat
+
+        def fake_stat(path, *args, **kwargs):
+            st = real_stat(path, *args, **kwargs)
+            if "disk-b" in str(path):
+                st = os.stat_result((st.st_mode, st.st_ino, st.st_dev + 1) + tuple(st)[3:])
+            return st
+
+        read_blocks = bagit_modules.hashcore.read_blocks
+        active = {"disk-a": 0, "disk-b": 0}
+        peaks = {"disk-a": 0, "disk-b": 0, "total": 0}
+
+        def slow_read(full_path, *args):
+            disk = os.path.basename(os.path.dirname(full_path))
+            active[disk] += 1
+            peaks[disk] = max(peaks[disk], active[disk])
+            peaks["total"] = max(peaks["total"], sum(active.values()))
+            time.sleep(0.02)
+            active[disk] -= 1
+            return read_blocks(full_path, *args)
+
+        expected = bagit_modules.workers.hash_files(self.tmpdir, rel_paths, ["md5"])
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            with mock.patch("os.stat", side_effect=fake_stat):
+                with mock.patch("bagit_modules.hashcore.read_blocks", side_effect=slow_read):
+                    results = bagit_modules.workers.hash_files(
+                        self.tmpdir, rel_paths, ["md5"], executor=executor, device_processes=1
+                    )
+        self.assertEqual(expected, results)
+        self.assertEqual({"disk-a": 1, "disk-b": 1, "total": 2}, peaks)
+
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], processes=2, device_processes=1)
+        for pipeline in (False, True):
+            self.assertTrue(bag.validate(processes=2, pipeline=pipeline, device_processes=2))
+
+        dest_dir = j(self.tmpdir, "copy")
+        copy = bagit_modules.bagging.make_bag(
+            j(self.tmpdir, "data"), dest=dest_dir, checksums=["md5"], processes=2, device_processes=1
+        )
+        self.assertEqual(bag.entries, copy.entries)
+
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, device_processes=0)
+
+    def test_processes_auto(self):
+        plan_execution = bagit_modules.planning.plan_execution
+        with mock.patch("bagit_modules.planning.hash_throughput", return_value={"sha256": 500e6}):
+            # Small bags are not worth starting workers for:
+            self.assertEqual("serial", plan_execution(5, 20000, ["sha256"], cpus=8).mode)
+            self.assertEqual("serial", plan_execution(1000, 10 ** 9, ["sha256"], cpus=1).mode)
+            # A few large files are hashed outside the GIL, many small ones are not:
+            plan = plan_execution(10, 10 ** 10, ["sha256"], cpus=8)
+            self.assertEqual(("threads", 8), (plan.mode, plan.workers))
+            plan = plan_execution(10 ** 6, 10 ** 9, ["sha256"], cpus=4)
+            self.assertEqual(("processes", 4), (plan.mode, plan.workers))
+
+        with mock.patch("os.sched_getaffinity", return_value=set(range(8)), create=True):
+            with mock.patch("bagit_modules.planning.cgroup_cpu_quota", return_value=1.5):
+                self.assertEqual(2, bagit_modules.planning.available_cpus())
+            with mock.patch("bagit_modules.planning.cgroup_cpu_quota", return_value=None):
+                self.assertEqual(8, bagit_modules.planning.available_cpus())
+
+        for mode in ("threads", "processes"):
+            plan = bagit_modules.planning.ExecutionPlan(mode, 2, 16, 10 ** 6, 1.0)
+            with mock.patch("bagit_modules.planning.plan_execution", return_value=plan):
+                bag_dir = j(self.tmpdir, mode)
+                shutil.copytree("test-data", bag_dir)
+                with self.assertLogs(level="INFO") as captured:
+                    bag = bagit_modules.bagging.make_bag(bag_dir, checksums=["md5"], processes="auto")
+                self.assertIn("with 2 %s worker(s)" % mode, "\n".join(captured.output))
+                self.assertTrue(bag.validate(processes="auto"))
+                self.assertTrue(bag.validate(processes="auto", pipeline=True))
+                bag.save(processes="auto", manifests=True)
+                self.assertTrue(bag.is_valid())
+
+        args = bagit_modules.parsing.make_parser().parse_args(["--processes", "auto", self.tmpdir])
+        self.assertEqual("auto", args.processes)
+
+    def test_progress(self):
+        events = []
+        progress = bagit_modules.progress.Progress(events.append, interval=0)
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], progress=progress)
+        self.assertEqual(
+            ["move", "hashing", "manifests", "tag files", "tag manifests"],
+            [i.phase for i in events if i.kind == "start"],
+        )
+        hashing = [i for i in events if i.phase == "hashing"]
+        self.assertIn("update", [i.kind for i in hashing])
+        self.assertEqual((5, 5, 991765, 991765), (
+            hashing[-1].files_done, hashing[-1].files_total, hashing[-1].bytes_done, hashing[-1].bytes_total
+        ))
+        self.assertEqual(0, hashing[-1].eta)
+
+        for options in ({}, {"processes": 2}, {"processes": 2, "device_processes": 1}, {"pipeline": True}):
+            events = []
+            self.assertTrue(bag.validate(progress=events.append, **options))
+            self.assertLessEqual(
+                {"oxum", "completeness", "hashing", "fixity"}, {i.phase for i in events if i.kind == "end"}
+            )
+            # Updates are rate limited, but the end of a phase always has its totals:
+            self.assertNotIn("update", [i.kind for i in events])
+            end = [i for i in events if i.phase == "hashing"][-1]
+            self.assertEqual((len(bag.entries), end.bytes_total), (end.files_done, end.bytes_done))
+
+        def cancel(event):
+            if event.phase == "hashing":
+                raise KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, bag.validate, progress=cancel)
+
+        events = []
+        dest = j(self.tmpdir, "copy")
+        bagit_modules.bagging.make_bag(
+            j(self.tmpdir, "data"), dest=dest, checksums=["md5"], progress=events.append
+        )
+        self.assertIn(("copying", 5, 991765), [(i.phase, i.files_done, i.bytes_done) for i in events])
+
+    def test_metrics(self):
+        prom = j(self.tmpdir, "bagit.prom")
+        bag = bagit_modules.bagging.make_bag(j(self.tmpdir), checksums=["md5", "sha256"], metrics=prom)
+        text = slurp_text_file(prom)
+        self.assertIn('bagit_success{operation="create",bag="%s"} 1\n' % self.tmpdir, text)
+        self.assertIn('bagit_read_bytes{operation="create",bag="%s"} 991765\n' % self.tmpdir, text)
+        self.assertIn('bagit_hashed_files{operation="create",bag="%s"} 5\n' % self.tmpdir, text)
+        for name in ("move", "hashing", "manifests", "tag files", "tag manifests"):
+            self.assertIn('bagit_phase_duration_seconds{operation="create",bag="%s",phase="%s"}' % (
+                self.tmpdir, name
+            ), text)
+        for alg in ("md5", "sha256"):
+            self.assertIn('bagit_algorithm_duration_seconds{operation="create",bag="%s",algorithm="%s"}' % (
+                self.tmpdir, alg
+            ), text)
+
+        # Several runs share a file, and failures are recorded as well:
+        metrics = bagit_modules.metrics.MetricsFile(j(self.tmpdir, "metrics.json"))
+        events = []
+        self.assertTrue(bag.validate(processes=2, metrics=metrics, progress=events.append))
+        self.assertIn("hashing", [i.phase for i in events])
+        with open(j(self.tmpdir, "data", "README"), "r+") as readme:
+            readme.write("A")
+        self.assertFalse(bag.is_valid(metrics=metrics))
+
+        with open(metrics.path) as f:
+            runs = json.load(f)
+        self.assertEqual([True, False], [i["success"] for i in runs])
+        self.assertEqual(2, runs[0]["workers"])
+        self.assertEqual(len(bag.entries), runs[0]["files_hashed"])
+        self.assertEqual({"oxum", "completeness", "hashing", "fixity"}, set(runs[0]["phase_seconds"]))
+        self.assertEqual({"checksum_mismatch": 2}, runs[1]["errors"])
+        self.assertGreater(runs[1]["peak_rss_bytes"]["main"], 0)
+        self.assertIsNotNone(runs[0]["worker_utilization"])
+
+        # The CPU time of workers which outlive the run is not counted:
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            bag.is_valid(executor=executor, metrics=metrics)
+        with open(metrics.path) as f:
+            runs = json.load(f)
+        self.assertIsNone(runs[2]["worker_utilization"])
+        self.assertNotIn("workers", runs[2]["peak_rss_bytes"])
+        run = bagit_modules.metrics.FixityRun("validate", self.tmpdir)
+        for start_method, reaped in (("fork", True), ("spawn", True), ("forkserver", False)):
+            run.set_workers(2, start_method=start_method)
+            self.assertEqual(reaped, run.workers_reaped)
+
+    def test_profile(self):
+        with self.assertLogs(level="INFO") as captured:
+            bag = bagit_modules.bagging.make_bag(
+                self.tmpdir, checksums=["md5"], processes=2, profile="cprofile"
+            )
+        output = "\n".join(captured.output)
+        self.assertIn("Phase timings for %s: move=" % self.tmpdir, output)
+        self.assertIn("including 2 workers", output)
+
+        profiler = bagit_modules.profiling.Profiler("cprofile")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertTrue(bag.validate(executor=executor, profile=profiler))
+        self.assertEqual(
+            ["load manifests", "oxum", "completeness", "hashing", "fixity"], list(profiler.timer.durations)
+        )
+        # The threads' profiles are merged with this thread's:
+        functions = {i[2] for i in profiler.stats.stats}
+        self.assertIn("hash_range", functions)
+        self.assertIn("_validate_oxum", functions)
+
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, profile="bogus")
+        self.assertFalse([i for i in os.listdir(tempfile.gettempdir()) if i.startswith("bagit-profile-")])
+
+    def test_log_mode(self):
+        bagit_modules.logging.set_log_mode("summary")
+        self.addCleanup(bagit_modules.logging.set_log_mode, "file")
+        self.assertRaises(ValueError, bagit_modules.logging.set_log_mode, "bogus")
+
+        events = j(tempfile.mkdtemp(), "events.jsonl")
+        self.addCleanup(shutil.rmtree, os.path.dirname(events))
+        with self.assertLogs(level="INFO") as captured:
+            bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], events=events)
+            self.assertTrue(bag.validate(events=events))
+        output = "\n".join(captured.output)
+        self.assertNotIn("Generating manifest lines for file", output)
+        self.assertNotIn("Verifying checksum for file", output)
+        self.assertIn("Finished hashing 5 files (991765 bytes)", output)
+
+        with open(events) as f:
+            records = [json.loads(line) for line in f]
+        files = [i for i in records if i["event"] == "file"]
+        # The payload is hashed by both, and validation hashes the tag files too:
+        self.assertEqual(2 * 5 + 3, len(files))
+        self.assertEqual(
+            {"path": "data/README", "bytes": 221, "digests": {"md5": "8e2af7a0143c7b8f4de0b3fc90f27354"}},
+            {k: files[0][k] for k in ("path", "bytes", "digests")},
+        )
+        phases = [(i["kind"], i["phase"], i["files_done"]) for i in records if i["event"] == "phase"]
+        self.assertIn(("end", "hashing", 5), phases)
+
+        with self.assertLogs(level="DEBUG") as captured:
+            bag.validate()
+        debug = [i for i in captured.output if i.startswith("DEBUG")]
+        self.assertIn("Verifying checksum for file", "\n".join(debug))
+
+    def test_events_unreadable_file(self):
+        # A dangling link cannot be read, even by root:
+        os.symlink("missing", j(self.tmpdir, "loc", "dangling"))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+        stream = StringIO()
+        with self.assertRaises(bagit_modules.errors.BagError) as cm:
+            bagit_modules.manifests.make_manifests(
+                "loc", 1, algorithms=["md5"], events=bagit_modules.events.EventLog(stream)
+            )
+        self.assertIn("Could not read loc/dangling", str(cm.exception))
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(str(cm.exception), records[-1]["error"])
+        self.assertNotIn("digests", records[-1])
+
+    def test_start_method(self):
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"])
+        for start_method in ("spawn", "forkserver"):
+            self.assertTrue(bag.validate(processes=2, start_method=start_method))
+            self.assertTrue(bag.validate(processes=2, start_method=start_method, pipeline=True))
+        self.assertRaises(bagit_modules.errors.BagError, bag.validate, start_method="bogus")
+
+        # A throttle's shared schedule is recreated in the pool's own context:
+        throttle = bagit_modules.throttle.Throttle(files_per_second=1000)
+        for start_method in ("spawn", "forkserver"):
+            self.assertTrue(bag.validate(processes=2, start_method=start_method, throttle=throttle))
+            self.assertTrue(
+                bag.validate(processes=2, start_method=start_method, throttle=throttle, pipeline=True)
+            )
+        self.assertIs(throttle, throttle.for_pool("fork"))
+        self.assertEqual("spawn", throttle.for_pool("spawn").start_method)
+
+        bag_dir = j(self.tmpdir, "data", "spawned")
+        shutil.copytree("test-data", bag_dir)
+        bag = bagit_modules.bagging.make_bag(bag_dir, checksums=["md5"], processes=2, start_method="spawn")
+        self.assertTrue(bag.is_valid())
+
+        # Spawned workers import only the hashing code they run:
+        code = (
+            "import sys, bagit_modules.hashcore; "
+            "print(' '.join(i for i in sys.argv[1:] if i in sys.modules))"
+        )
+        slow_modules = ["concurrent.futures", "gettext", "logging", "multiprocessing"]
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bagit.__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code] + slow_modules, env=env)
+        self.assertEqual("", output.decode("utf-8").strip())
+
+    def test_validate_pipeline(self):
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"], pipeline=True)
+        for processes in (1, 2):
+            self.assertTrue(bag.validate(processes=processes, pipeline=True))
+        self.assertTrue(bag.validate(fast=True, pipeline=True))
+        self.assertTrue(bag.validate(completeness_only=True, pipeline=True))
+
+        readme = j(self.tmpdir, "data", "README")
+        txt = slurp_text_file(readme)
+        with open(readme, "w") as r:
+            r.write("A" + txt[1:])
+
+        with self.assertRaises(bagit_modules.errors.BagValidationError) as error_catcher:
+            bag.validate(pipeline=True)
+        self.assertEqual("Bag validation failed", error_catcher.exception.message)
+        self.assertTrue(bag.validate(completeness_only=True, pipeline=True))
+
+        os.rename(readme, j(self.tmpdir, "data", "extra_file"))
+        with self.assertRaises(bagit_modules.errors.BagValidationError) as error_catcher:
+            bag.validate(pipeline=True)
+        self.assertEqual("Bag is incomplete", error_catcher.exception.message)
+        self.assertEqual(
+            [bagit_modules.errors.FileMissing, bagit_modules.errors.UnexpectedFile],
+            sorted((type(i) for i in error_catcher.exception.details), key=lambda i: i.__name__),
+        )
+
+    def test_validate_pipeline_stops_early(self):
+        for i in range(100):
+            with open(j(self.tmpdir, "small-%03d.txt" % i), "w") as f:
+                f.write(str(i))
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksums=["md5"])
+        with open(j(self.tmpdir, "data", "extra_file"), "w") as f:
+            f.write("extra")
+
+        # Hashing is slowed down so that the walk ends long before it:
+        throttle = bagit_modules.throttle.Throttle(files_per_second=200)
+        events = []
+        progress = bagit_modules.progress.Progress(events.append, interval=0)
+        with self.assertRaises(bagit_modules.errors.BagValidationError) as error_catcher:
+            bag.validate(pipeline=True, throttle=throttle, progress=progress)
+        self.assertIn("Payload-Oxum validation failed", error_catcher.exception.message)
+
+        # Payload-Oxum failed while the files were still being hashed:
+        phases = [(i.kind, i.phase) for i in events]
+        self.assertEqual(("start", "oxum"), phases[phases.index(("end", "walk")) + 1])
+        self.assertIn(("start", "hashing"), phases)
+        self.assertNotIn(("end", "hashing"), phases)
+        self.assertLess(max(i.files_done for i in events if i.phase == "hashing"), len(bag.entries))
+
     def test_multiple_meta_values(self):
         baginfo = {"Multival-Meta": [7, 4, 8, 6, 8]}
         bag = bagit_modules.bagging.make_bag(self.tmpdir, baginfo)
@@ -895,6 +1780,46 @@ Tag-File-Character-Encoding: UTF-8
         bag = bagit_modules.bag.Bag(self.tmpdir)
         self.assertTrue(bag.is_valid())
 
+    def test_save_baginfo_incremental(self):
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksum=["sha1", "md5"])
+        bag.info["Contact-Email"] = "ehs@pobox.com"
+
+        with mock.patch.object(bag, "_load_manifests") as load_manifests:
+            with mock.patch("bagit_modules.manifests.hash_file") as hash_file:
+                bag.save()
+
+        # Neither the payload manifests nor any other tag file were read:
+        self.assertEqual(load_manifests.call_count, 0)
+        self.assertEqual(hash_file.call_count, 0)
+
+        reloaded = bagit_modules.bag.Bag(self.tmpdir)
+        self.assertEqual(reloaded.entries, bag.entries)
+        self.assertTrue(reloaded.is_valid())
+
+        # Saving unchanged metadata leaves the bag alone:
+        tagmanifest = j(self.tmpdir, "tagmanifest-md5.txt")
+        os.utime(tagmanifest, (0, 0))
+        reloaded.save()
+        self.assertEqual(0, os.stat(tagmanifest).st_mtime)
+
+    def test_save_edited_tag_file(self):
+        with open(j(self.tmpdir, "custom-tags.txt"), "w") as f:
+            f.write("Custom: one\n")
+        bag = bagit_modules.bagging.make_bag(self.tmpdir, checksum=["sha256"])
+
+        # Edited after the bag was opened, and saved with or without other changes:
+        for info in ({}, {"Contact-Email": "ehs@pobox.com"}):
+            with open(j(self.tmpdir, "custom-tags.txt"), "a") as f:
+                f.write("Custom: two\n")
+            bag.info.update(info)
+            bag.save()
+            self.assertTrue(bagit_modules.bag.Bag(self.tmpdir).is_valid())
+
+        # A tag file removed since is dropped from the tag manifests:
+        os.remove(j(self.tmpdir, "custom-tags.txt"))
+        bag.save()
+        self.assertNotIn("custom-tags.txt", bagit_modules.bag.Bag(self.tmpdir).entries)
+
     def test_save_only_baginfo(self):
         bag = bagit_modules.bagging.make_bag(self.tmpdir)
         with open(j(self.tmpdir, "data", "newfile"), "w") as nf:
@@ -1142,6 +2067,23 @@ class TestCLI(SelfCleaningTestCase):
             mock_stderr.getvalue()
         )
 
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_archive_unsupported_options(self, mock_stderr):
+        archive = j(tempfile.mkdtemp(), "bag.zip")
+        self.addCleanup(shutil.rmtree, os.path.dirname(archive))
+        testargs = ["bagit.py", "--archive", archive, "--processes", "2", "--pipeline", self.tmpdir]
+
+        with self.assertRaises(SystemExit) as cm:
+            with mock.patch.object(sys, 'argv', testargs):
+                bagit.main()
+
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn(
+            "error: --archive cannot be combined with --processes, --pipeline",
+            mock_stderr.getvalue()
+        )
+        self.assertFalse(os.path.exists(archive))
+
     @mock.patch('sys.stderr', new_callable=StringIO)
     def test_fast_flag_without_validate(self, mock_stderr):
         bag = bagit_modules.bagging.make_bag(self.tmpdir)
@@ -1157,6 +2099,20 @@ class TestCLI(SelfCleaningTestCase):
             mock_stderr.getvalue()
         )
 
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_algorithms_flag_without_validate(self, mock_stderr):
+        testargs = ["bagit.py", "--algorithms", "strongest", self.tmpdir]
+
+        with self.assertRaises(SystemExit) as cm:
+            with mock.patch.object(sys, 'argv', testargs):
+                bagit.main()
+
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn(
+            "error: --algorithms is only allowed as an option for --validate!",
+            mock_stderr.getvalue()
+        )
+
     def test_invalid_fast_validate(self):
         bag = bagit_modules.bagging.make_bag(self.tmpdir)
         os.remove(j(self.tmpdir, "data", "loc", "2478433644_2839c5e8b8_o_d.jpg"))
@@ -1270,6 +2226,31 @@ class TestCLI(SelfCleaningTestCase):
             captured.records[-1].getMessage()
         )
 
+    def test_profile(self):
+        testargs = ["bagit.py", "--profile", self.tmpdir]
+        make_bag = mock.patch("bagit_modules.bagging.make_bag", wraps=bagit_modules.bagging.make_bag)
+
+        # Both commands are given a Profiler built from --profile, which takes no value:
+        with self.assertLogs() as captured, make_bag as mocked:
+            with self.assertRaises(SystemExit) as cm:
+                with mock.patch.object(sys, 'argv', testargs):
+                    bagit.main()
+
+        self.assertEqual(cm.exception.code, 0)
+        self.assertIsInstance(mocked.call_args[1]["profile"], bagit_modules.profiling.Profiler)
+        self.assertIn("Phase timings for %s: move=" % self.tmpdir, "\n".join(captured.output))
+
+        testargs = ["bagit.py", "--validate", "--profile-mode", "cprofile", self.tmpdir]
+        with self.assertLogs() as captured:
+            with self.assertRaises(SystemExit) as cm:
+                with mock.patch.object(sys, 'argv', testargs):
+                    bagit.main()
+
+        self.assertEqual(cm.exception.code, 0)
+        output = "\n".join(captured.output)
+        self.assertIn("Phase timings for %s: load manifests=" % self.tmpdir, output)
+        self.assertIn("Profile of %s" % self.tmpdir, output)
+
     def test_failed_create_bag(self):
         os.chmod(self.tmpdir, 0)
 
@@ -1299,6 +2280,43 @@ class TestCLI(SelfCleaningTestCase):
 
         self.assertEqual(cm.exception.code, 0)
 
+    def test_import_is_lazy(self):
+        # Scripts which run bagit once per bag pay for every module it imports:
+        slow_modules = [
+            "argparse",
+            "gettext",
+            "importlib.metadata",
+            "multiprocessing",
+            "pkg_resources",
+            "tarfile",
+            "urllib.parse",
+            "zipfile",
+        ]
+        code = "import sys, bagit; print(' '.join(i for i in sys.argv[1:] if i in sys.modules))"
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bagit.__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code] + slow_modules, env=env)
+        self.assertEqual("", output.decode("utf-8").strip())
+
+    def test_version_without_importlib_metadata(self):
+        expected = bagit_modules.versioning.get_version()
+
+        # Python 3.7 has no importlib.metadata:
+        with mock.patch("bagit_modules.versioning._version", None), \
+                mock.patch.dict(sys.modules, {"importlib.metadata": None}):
+            self.assertEqual(expected, bagit_modules.versioning.get_version())
+
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    def test_help(self, mock_stdout):
+        testargs = ["bagit.py", "--help"]
+
+        with self.assertRaises(SystemExit) as cm:
+            with mock.patch.object(sys, 'argv', testargs):
+                bagit.main()
+
+        self.assertEqual(cm.exception.code, 0)
+        self.assertIn("bagit-python version %s" % bagit.VERSION, mock_stdout.getvalue())
+        self.assertIn("Using BagIt from your Python code", mock_stdout.getvalue())
+
 
 class TestUtils(unittest.TestCase):
     def setUp(self):